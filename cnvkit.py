@@ -1,9 +1,33 @@
 #!/usr/bin/env python3
 """Command-line interface for CNVkit, the Copy Number Variation toolkit."""
+import json
 import logging
-from cnvlib import commands
+import os
+import socket
+import sys
+
+
+def run_on_server(socket_path, argv):
+    """Run a command on a 'cnvkit.py serve' server; return its exit status.
+
+    Only uses the standard library, so the client starts quickly.
+    """
+    request = {"argv": argv, "cwd": os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as stream:
+            response = json.loads(stream.readline())
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    return response["status"]
+
 
 if __name__ == '__main__':
+    server_socket = os.environ.get('CNVKIT_SERVER')
+    if server_socket and sys.argv[1:2] != ['serve']:
+        sys.exit(run_on_server(server_socket, sys.argv[1:]))
+    from cnvlib import commands
     logging.basicConfig(level=logging.INFO, format="%(message)s")
     args = commands.parse_args()
     args.func(args)
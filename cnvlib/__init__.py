@@ -3,4 +3,5 @@ from skgenome.tabio import write
 from ._version import __version__
 from .cmdutil import read_cna as read
 from .commands import *
-from .diagram import create_diagram as do_diagram
+from .commands import _lazy_function
+do_diagram = _lazy_function('diagram', 'create_diagram', 'do_diagram')
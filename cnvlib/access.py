@@ -5,19 +5,36 @@ Inaccessible regions, e.g. telomeres and centromeres, are masked out with N in
 the reference genome sequence; this script scans those to identify the
 coordinates of the accessible regions (those between the long spans of N's).
 """
+import hashlib
 import logging
+import mmap
+import os
 
 import numpy as np
 from skgenome import tabio, GenomicArray as GA
 
+from . import parallel
+
 
 def do_access(fa_fname, exclude_fnames=(), min_gap_size=5000,
-              skip_noncanonical=True):
-    """List the locations of accessible sequence regions in a FASTA file."""
-    fa_regions = get_regions(fa_fname)
-    if skip_noncanonical:
-        fa_regions = drop_noncanonical_contigs(fa_regions)
-    access_regions = GA.from_rows(fa_regions)
+              skip_noncanonical=True, processes=1, cache_dir=None):
+    """List the locations of accessible sequence regions in a FASTA file.
+
+    Parameters
+    ----------
+    processes : int
+        Number of chromosomes to scan in parallel.
+    cache_dir : str
+        Directory in which to keep the FASTA file's accessible regions, keyed
+        by the file's checksum, so the same genome is only scanned once.
+    """
+    if cache_dir:
+        access_regions = read_cached_regions(fa_fname, cache_dir, processes)
+        if skip_noncanonical:
+            access_regions = GA.from_rows(
+                drop_noncanonical_contigs(access_regions.coords()))
+    else:
+        access_regions = scan_regions(fa_fname, processes, skip_noncanonical)
     for ex_fname in exclude_fnames:
         excluded = tabio.read(ex_fname, 'bed3')
         access_regions = access_regions.subtract(excluded)
@@ -36,64 +53,190 @@ def drop_noncanonical_contigs(region_tups):
             if is_canonical_contig_name(tup[0]))
 
 
-def get_regions(fasta_fname):
-    """Find accessible sequence regions (those not masked out with 'N')."""
-    with open(fasta_fname) as infile:
-        chrom = cursor = run_start = None
-        for line in infile:
-            if line.startswith('>'):
-                # Emit the last chromosome's last run, if any
-                if run_start is not None:
-                    yield log_this(chrom, run_start, cursor)
-                # Start new chromosome
-                chrom = line.split(None, 1)[0][1:]
-                run_start = None
-                cursor = 0
-                logging.info("%s: Scanning for accessible regions", chrom)
+def get_regions(fasta_fname, processes=1):
+    """Find accessible sequence regions (those not masked out with 'N').
+
+    Yield (chrom, start, end) tuples.
+    """
+    return scan_regions(fasta_fname, processes).coords()
+
+
+def read_cached_regions(fasta_fname, cache_dir, processes=1):
+    """Read a FASTA file's accessible regions from the cache, or scan them.
+
+    The regions are cached as a BED file named by the FASTA file's checksum
+    in `cache_dir`, which is created if needed.
+    """
+    cache_fname = os.path.join(cache_dir,
+                               fasta_checksum(fasta_fname) + ".access.bed")
+    if os.path.isfile(cache_fname):
+        logging.info("Using cached accessible regions of %s: %s",
+                     fasta_fname, cache_fname)
+        return GA(tabio.bedio.read_bed3(cache_fname))
+    regions = scan_regions(fasta_fname, processes)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+        logging.info("Created directory %s", cache_dir)
+    # Write to a temporary file first, so an interrupted or concurrent run
+    # never leaves a partial cache entry
+    tmp_fname = "%s.%d.tmp" % (cache_fname, os.getpid())
+    tabio.write(regions, tmp_fname, "bed3", verbose=False)
+    os.replace(tmp_fname, cache_fname)
+    logging.info("Cached accessible regions of %s in %s",
+                 fasta_fname, cache_fname)
+    return regions
+
+
+def fasta_checksum(fasta_fname, blocksize=1 << 20):
+    """MD5 checksum of a file's contents, as a hex string."""
+    md5 = hashlib.md5()
+    with open(fasta_fname, 'rb') as handle:
+        for block in iter(lambda: handle.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def scan_regions(fasta_fname, processes=1, skip_noncanonical=False):
+    """Find the accessible regions of each chromosome in a FASTA file.
+
+    The file is memory-mapped, and each chromosome's sequence is scanned for
+    runs of 'N' characters as a whole, in parallel with `processes` > 1.
+    Sequence locations are taken from the FASTA index (.fai), if present.
+
+    Returns
+    -------
+    GenomicArray
+        The accessible regions, in the FASTA file's chromosome order.
+    """
+    index = read_fasta_index(fasta_fname)
+    if skip_noncanonical:
+        from .antitarget import is_canonical_contig_name
+        index = [row for row in index if is_canonical_contig_name(row[0])]
+    chroms, starts, ends = [], [], []
+    with parallel.pick_pool(processes) as pool:
+        jobs = [(row[0], pool.submit(_scan_chromosome, fasta_fname, *row[1:]))
+                for row in index]
+        for chrom, job in jobs:
+            chrom_starts, chrom_ends = job.result()
+            logging.info("%s: Found %d accessible regions",
+                         chrom, len(chrom_starts))
+            for start, end in zip(chrom_starts, chrom_ends):
+                logging.debug("\tAccessible region %s:%d-%d (size %d)",
+                              chrom, start, end, end - start)
+            chroms.append(np.repeat(chrom, len(chrom_starts)))
+            starts.append(chrom_starts)
+            ends.append(chrom_ends)
+    if not chroms:
+        return GA.from_rows([])
+    return GA.from_columns({"chromosome": np.concatenate(chroms).astype(object),
+                            "start": np.concatenate(starts),
+                            "end": np.concatenate(ends)})
+
+
+def read_fasta_index(fasta_fname):
+    """Locate each sequence in a FASTA file.
+
+    Use the samtools/pyfaidx index file (`fasta_fname` + '.fai') if it exists
+    and is newer than the FASTA file; otherwise, find the sequence headers.
+
+    Returns
+    -------
+    list
+        Tuples of (sequence name, byte offset of the sequence, length, bases
+        per line, bytes per line). Without an index, the length is the number
+        of bytes up to the next header, and the line lengths are None.
+    """
+    fai_fname = fasta_fname + '.fai'
+    if (os.path.isfile(fai_fname) and
+            os.stat(fai_fname).st_mtime >= os.stat(fasta_fname).st_mtime):
+        logging.info("Reading FASTA index %s", fai_fname)
+        index = []
+        with open(fai_fname) as handle:
+            for line in handle:
+                name, length, offset, linebases, linewidth = \
+                        line.split('\t')[:5]
+                index.append((name, int(offset), int(length), int(linebases),
+                              int(linewidth)))
+        return index
+
+    index = []
+    with open(fasta_fname, 'rb') as handle:
+        if not os.fstat(handle.fileno()).st_size:
+            return index
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header_start = mm.find(b'>')
+            while header_start != -1:
+                header_end = mm.find(b'\n', header_start)
+                if header_end == -1:
+                    header_end = len(mm)
+                name = mm[header_start + 1:header_end].split(None, 1)[0]
+                next_start = mm.find(b'\n>', header_end)
+                next_start = len(mm) if next_start == -1 else next_start + 1
+                offset = min(header_end + 1, next_start)
+                index.append((name.decode(), offset, next_start - offset,
+                              None, None))
+                header_start = next_start if next_start < len(mm) else -1
+    return index
+
+
+def _scan_chromosome(fasta_fname, offset, length, linebases, linewidth):
+    """Find the runs of non-N characters in one sequence of a FASTA file.
+
+    Returns
+    -------
+    tuple
+        Arrays of the start and end positions of the accessible regions.
+    """
+    with open(fasta_fname, 'rb') as handle:
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if linebases:
+                is_n = _mask_indexed(mm, offset, length, linebases, linewidth)
             else:
-                line = line.rstrip()
-                if 'N' in line:
-                    if all(c == 'N' for c in line):
-                        # Shortcut if the line is all N chars
-                        if run_start is not None:
-                            yield log_this(chrom, run_start, cursor)
-                            run_start = None
-                    else:
-                        # Slow route: line is a mix of N and non-N chars
-                        line_chars = np.array(line, dtype='c')
-                        n_indices = np.where(line_chars == b'N')[0]
-                        # Emit the first block of non-N chars, if any
-                        if run_start is not None:
-                            yield log_this(chrom, run_start, cursor + n_indices[0])
-                        elif n_indices[0] != 0:
-                            yield log_this(chrom, cursor, cursor + n_indices[0])
-                        # Emit any short intermediate blocks
-                        gap_mask = np.diff(n_indices) > 1
-                        if gap_mask.any():
-                            ok_starts = n_indices[:-1][gap_mask] + 1 + cursor
-                            ok_ends = n_indices[1:][gap_mask] + cursor
-                            for start, end in zip(ok_starts, ok_ends):
-                                yield log_this(chrom, start, end)
-                        # Account for any tailing non-N chars
-                        if n_indices[-1] + 1 < len(line_chars):
-                            run_start = cursor + n_indices[-1] + 1
-                        else:
-                            run_start = None
-                else:
-                    if run_start is None:
-                        # Start of a new run of non-N characters
-                        run_start = cursor
-                cursor += len(line)
-        # Emit the last run if it's accessible (i.e. not a telomere)
-        if run_start is not None:
-            yield log_this(chrom, run_start, cursor)
-
-
-def log_this(chrom, run_start, run_end):
-    """Log a coordinate range, then return it as a tuple."""
-    logging.info("\tAccessible region %s:%d-%d (size %d)",
-                 chrom, run_start, run_end, run_end - run_start)
-    return (chrom, run_start, run_end)
+                is_n = _mask_unindexed(mm, offset, length)
+    return _find_runs(is_n)
+
+
+def _mask_indexed(mm, offset, length, linebases, linewidth):
+    """Mark the 'N' positions of a sequence with known line lengths.
+
+    Viewing the file as a 2-D array of lines skips the line endings without
+    copying the sequence.
+    """
+    n_full, n_rest = divmod(length, linebases)
+    if offset + n_full * linewidth + n_rest > len(mm):
+        raise ValueError("FASTA index does not match the FASTA file; "
+                         "delete the .fai file or rebuild it")
+    buf = np.frombuffer(mm, dtype=np.uint8)
+    is_n = np.empty(length, dtype=np.bool_)
+    lines = np.lib.stride_tricks.as_strided(buf[offset:],
+                                            shape=(n_full, linebases),
+                                            strides=(linewidth, 1))
+    np.equal(lines, ord('N'),
+             out=is_n[:n_full * linebases].reshape(n_full, linebases))
+    rest_start = offset + n_full * linewidth
+    np.equal(buf[rest_start:rest_start + n_rest], ord('N'),
+             out=is_n[n_full * linebases:])
+    return is_n
+
+
+def _mask_unindexed(mm, offset, nbytes):
+    """Mark the 'N' positions of a sequence spanning `nbytes` of the file.
+
+    Line endings and other whitespace are dropped from the sequence.
+    """
+    chars = np.frombuffer(mm, dtype=np.uint8, count=nbytes, offset=offset)
+    return (chars == ord('N'))[chars > ord(' ')]
+
+
+def _find_runs(is_n):
+    """Find the start and end positions of runs of False values."""
+    if not len(is_n):
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    # Positions where the sequence switches between N and non-N
+    switches = np.flatnonzero(is_n[1:] != is_n[:-1]) + 1
+    edges = np.concatenate(([0], switches, [len(is_n)]))
+    first = 1 if is_n[0] else 0
+    return edges[:-1][first::2], edges[1:][first::2]
 
 
 def join_regions(regions, min_gap_size):
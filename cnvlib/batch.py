@@ -39,7 +39,9 @@ def batch_make_reference(normal_bams, target_bed, antitarget_bed,
                 target_bed = access_bed
             elif fasta:
                 # Run 'access' on the fly
-                access_arr = access.do_access(fasta)
+                access_arr = access.do_access(
+                    fasta, processes=processes,
+                    cache_dir=os.environ.get('CNVKIT_CACHE_DIR'))
                 # Take filename base from FASTA, lacking any other clue
                 target_bed = os.path.splitext(os.path.basename(fasta)
                                               )[0] + ".bed"
@@ -58,7 +60,9 @@ def batch_make_reference(normal_bams, target_bed, antitarget_bed,
                     # compared to WGS coverage); user-provided access might be
                     # something else that excludes a significant number of
                     # mapped reads.
-                    access_arr = access.do_access(fasta)
+                    access_arr = access.do_access(
+                        fasta, processes=processes,
+                        cache_dir=os.environ.get('CNVKIT_CACHE_DIR'))
                 if access_arr:
                     autobin_args = ['wgs', None, access_arr]
                 else:
@@ -144,7 +148,8 @@ def batch_make_reference(normal_bams, target_bed, antitarget_bed,
                                          do_gc=True,
                                          do_edge=(method == "hybrid"),
                                          do_rmask=True,
-                                         do_cluster=do_cluster)
+                                         do_cluster=do_cluster,
+                                         processes=processes)
     if not output_reference:
         output_reference = os.path.join(output_dir, "reference.cnn")
     core.ensure_path(output_reference)
@@ -195,7 +200,8 @@ def batch_run_sample(bam_fname, target_bed, antitarget_bed, ref_fname,
     # TODO/ENH take centering shift & apply to .cnr for use in segmetrics
     seg_metrics = segmetrics.do_segmetrics(cnarr, segments,
                                            interval_stats=['ci'], alpha=0.5,
-                                           smoothed=True, skip_low=skip_low)
+                                           smoothed=True, skip_low=skip_low,
+                                           processes=processes)
     tabio.write(seg_metrics, sample_pfx + '.cns')
 
     # Remove likely false-positive breakpoints
@@ -214,9 +220,11 @@ def batch_run_sample(bam_fname, target_bed, antitarget_bed, ref_fname,
     tabio.write(seg_bintest, sample_pfx + '.bintest.cns')
 
     if plot_scatter:
-        scatter.do_scatter(cnarr, seg_final)
-        pyplot.savefig(sample_pfx + '-scatter.png', format='png',
-                       bbox_inches="tight")
+        fig = scatter.do_scatter(cnarr, seg_final)
+        fig.savefig(sample_pfx + '-scatter.png', format='png',
+                    bbox_inches="tight")
+        # Don't keep every sample's figure open in a long-running process
+        pyplot.close(fig)
         logging.info("Wrote %s-scatter.png", sample_pfx)
 
     if plot_diagram:
@@ -24,20 +24,15 @@ def do_bintest(cnarr, segments=None, alpha=0.005, target_only=False):
     # weren't already detected (including exon-size CNAs within a 
     # larger-scale, smaller-amplitude CNA)
     resid = cnarr.residuals(segments)
-    if not resid.index.is_unique:
-        # Overlapping segments, maybe?
-        dup_idx = resid.index.duplicated(keep=False)
-        logging.warning("Segments may overlap at %d bins; dropping duplicate values",
-                        dup_idx.sum())
-        logging.debug("Duplicated indices: %s", " ".join(map(str, resid[dup_idx].head(50))))
-        resid = resid[~resid.index.duplicated()]
-        cnarr = cnarr.as_dataframe(cnarr.data.loc[resid.index])
-    if len(cnarr) != len(resid):
-        logging.info("Segments do not cover all bins (%d), only %d of them",
-                     len(cnarr), len(resid))
-        cnarr = cnarr.as_dataframe(cnarr.data.loc[resid.index])
-
-    cnarr['log2'] = resid
+    is_missing = resid.isnull().values
+    if is_missing.any():
+        # Outside all segments, or no log2 value to begin with
+        logging.info("Skipping %d/%d bins without a residual log2 value",
+                     is_missing.sum(), len(cnarr))
+        cnarr = cnarr[~is_missing]
+        resid = resid[~is_missing]
+
+    cnarr['log2'] = resid.values
     cnarr['probes'] = 1
 
     if target_only:
@@ -123,65 +123,52 @@ def absolute_threshold(cnarr, ploidy, thresholds, is_reference_male):
         GAIN(3) >=  +0.3
 
     """
-    absolutes = np.zeros(len(cnarr), dtype=np.float_)
-    for idx, row in enumerate(cnarr):
-        ref_copies = _reference_copies_pure(row.chromosome, ploidy,
-                                            is_reference_male)
-        if np.isnan(row.log2):
-            # XXX fallback
-            logging.warning("log2=nan found; replacing with neutral copy number %s",
-                            ref_copies)
-            absolutes[idx] = ref_copies
-            continue
-        cnum = 0
-        for cnum, thresh in enumerate(thresholds):
-            if row.log2 <= thresh:
-                if ref_copies != ploidy:
-                    cnum = int(cnum * ref_copies / ploidy)
-                break
-        else:
-            cnum = int(np.ceil(_log2_ratio_to_absolute_pure(row.log2,
-                                                            ref_copies)))
-        absolutes[idx] = cnum
+    log2s = cnarr['log2'].values
+    ref_copies = _reference_copies_pure_array(cnarr.chromosome, ploidy,
+                                              is_reference_male)
+    # Above the last threshold, call as if pure and diploid, rounding up
+    absolutes = np.ceil(_log2_ratio_to_absolute_pure(log2s, ref_copies))
+    is_called = np.zeros(len(cnarr), dtype=np.bool_)
+    for cnum, thresh in enumerate(thresholds):
+        is_cnum = ~is_called & (log2s <= thresh)
+        absolutes[is_cnum] = cnum
+        is_called |= is_cnum
+    is_scaled = is_called & (ref_copies != ploidy)
+    absolutes[is_scaled] = np.trunc(absolutes[is_scaled] * ref_copies[is_scaled]
+                                    / ploidy)
+    is_nan = np.isnan(log2s)
+    if is_nan.any():
+        # XXX fallback
+        logging.warning("log2=nan found in %d regions; replacing with neutral "
+                        "copy number", is_nan.sum())
+        absolutes[is_nan] = ref_copies[is_nan]
     return absolutes
 
 
 def absolute_clonal(cnarr, ploidy, purity, is_reference_male, is_sample_female):
     """Calculate absolute copy number values from segment or bin log2 ratios."""
-    absolutes = np.zeros(len(cnarr), dtype=np.float_)
-    for i, row in enumerate(cnarr):
-        # TODO by_chromosome to reduce number of calls to this
-        ref_copies, expect_copies = _reference_expect_copies(
-            row.chromosome, ploidy, is_sample_female, is_reference_male)
-        absolutes[i] = _log2_ratio_to_absolute(
-            row.log2, ref_copies, expect_copies, purity)
-    return absolutes
+    ref_copies, expect_copies = _reference_expect_arrays(
+        cnarr.chromosome, ploidy, is_sample_female, is_reference_male)
+    return _log2_ratio_to_absolute(cnarr['log2'].values, ref_copies,
+                                   expect_copies, purity)
 
 
 def absolute_pure(cnarr, ploidy, is_reference_male):
     """Calculate absolute copy number values from segment or bin log2 ratios."""
-    absolutes = np.zeros(len(cnarr), dtype=np.float_)
-    for i, row in enumerate(cnarr):
-        ref_copies = _reference_copies_pure(row.chromosome, ploidy,
-                                            is_reference_male)
-        absolutes[i] = _log2_ratio_to_absolute_pure(row.log2, ref_copies)
-    return absolutes
+    ref_copies = _reference_copies_pure_array(cnarr.chromosome, ploidy,
+                                              is_reference_male)
+    return _log2_ratio_to_absolute_pure(cnarr['log2'].values, ref_copies)
 
 
 def absolute_dataframe(cnarr, ploidy, purity, is_reference_male, is_sample_female):
     """Absolute, expected and reference copy number in a DataFrame."""
-    absolutes = np.zeros(len(cnarr), dtype=np.float_)
-    reference_copies = expect_copies = np.zeros(len(cnarr), dtype=np.int_)
-    for i, row in enumerate(cnarr):
-        ref_copies, exp_copies = _reference_expect_copies(
-            row.chromosome, ploidy, is_sample_female, is_reference_male)
-        reference_copies[i] = ref_copies
-        expect_copies[i] = exp_copies
-        absolutes[i] = _log2_ratio_to_absolute(
-            row.log2, ref_copies, exp_copies, purity)
+    ref_copies, exp_copies = _reference_expect_arrays(
+        cnarr.chromosome, ploidy, is_sample_female, is_reference_male)
+    absolutes = _log2_ratio_to_absolute(cnarr['log2'].values, ref_copies,
+                                        exp_copies, purity)
     return pd.DataFrame({'absolute': absolutes,
-                         'reference': reference_copies,
-                         'expect': expect_copies})
+                         'reference': ref_copies,
+                         'expect': exp_copies})
 
 
 def absolute_expect(cnarr, ploidy, is_sample_female):
@@ -259,6 +246,50 @@ def _reference_copies_pure(chrom, ploidy, is_reference_male):
     return ref_copies
 
 
+def _sex_chrom_masks(chroms):
+    """Flag chromosome X and Y labels (case-insensitive, with or without 'chr').
+
+    Each distinct label is checked once, as in `_reference_expect_copies`.
+    """
+    codes, labels = pd.factorize(chroms)
+    labels = pd.Index(labels, dtype=object).str.lower()
+    is_x = np.asarray(labels.isin(["chrx", "x"]))[codes]
+    is_y = np.asarray(labels.isin(["chry", "y"]))[codes]
+    return is_x, is_y
+
+
+def _reference_expect_arrays(chroms, ploidy, is_sample_female,
+                             is_reference_male):
+    """Reference and expected copies of each of the given chromosomes.
+
+    Array version of `_reference_expect_copies`.
+    """
+    is_x, is_y = _sex_chrom_masks(chroms)
+    ref_copies = np.repeat(ploidy, len(is_x))
+    exp_copies = ref_copies.copy()
+    if is_reference_male:
+        ref_copies[is_x] = ploidy // 2
+    ref_copies[is_y] = ploidy // 2
+    if is_sample_female:
+        exp_copies[is_y] = 0
+    else:
+        exp_copies[is_x | is_y] = ploidy // 2
+    return ref_copies, exp_copies
+
+
+def _reference_copies_pure_array(chroms, ploidy, is_reference_male):
+    """Reference copies of each of the given chromosomes (pure sample).
+
+    Array version of `_reference_copies_pure`.
+    """
+    is_x, is_y = _sex_chrom_masks(chroms)
+    ref_copies = np.repeat(ploidy, len(is_x))
+    if is_reference_male:
+        ref_copies[is_x] = ploidy // 2
+    ref_copies[is_y] = ploidy // 2
+    return ref_copies
+
+
 def _log2_ratio_to_absolute(log2_ratio, ref_copies, expect_copies, purity=None):
     """Transform a log2 ratio to absolute linear scale (for an impure sample).
 
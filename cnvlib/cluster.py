@@ -11,6 +11,48 @@ See:
 import logging
 
 import numpy as np
+from scipy import sparse
+
+# Max. number of bins (columns) used to compare samples to each other
+MAX_SKETCH_BINS = 20000
+
+
+def sketch_bins(matrices, max_bins=MAX_SKETCH_BINS, skip_rows=0):
+    """Subsample the bins (columns) of each samples-by-bins matrix.
+
+    Clustering only needs the broad structure shared between samples, so a
+    fixed random subset of bins is enough to place each sample in PCA space.
+    Only the sampled columns are read, which keeps memory bounded for large
+    pools stored on disk.
+
+    Parameters
+    ----------
+    matrices : list of 2D arrays
+        Blocks of bins with the same samples as rows, e.g. target and
+        antitarget log2 ratios.
+    max_bins : int
+        Total number of bins to keep across all blocks.
+    skip_rows : int
+        Drop this many leading rows (e.g. a pseudocount sample).
+
+    Returns
+    -------
+    np.ndarray
+        A samples-by-bins float matrix of at most `max_bins` columns.
+    """
+    sizes = np.array([mat.shape[1] for mat in matrices])
+    n_bins = sizes.sum()
+    if n_bins > max_bins:
+        rs = np.random.RandomState(0xA5EED)
+        keep = np.sort(rs.choice(n_bins, max_bins, replace=False))
+    else:
+        keep = np.arange(n_bins)
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    columns = []
+    for mat, start, end in zip(matrices, offsets[:-1], offsets[1:]):
+        cols = keep[(keep >= start) & (keep < end)] - start
+        columns.append(np.asarray(mat[skip_rows:, cols], dtype=np.float_))
+    return np.hstack(columns)
 
 
 def kmeans(samples, k=None):
@@ -20,21 +62,19 @@ def kmeans(samples, k=None):
         k = max(1, int(round(log(len(samples), 3))))
         # E.g. n=66 -> k=2, 16 -> 3, 47 -> 4, 141 -> 5, 421 -> 6, 1263 -> 7
 
-    print("Clustering", len(samples), "samples by k-means, where k =", k)
+    logging.info("Clustering %d samples by k-means, where k = %d",
+                 len(samples), k)
     obs = pca_sk(samples, 3)
     obs = vq.whiten(obs)  # Needed?
     _centroids, labels = vq.kmeans2(obs, k, minit="++")
-    # XXX shorter way to do this grouping?
-    from collections import defaultdict
-    clusters = defaultdict(list)
-    for idx, label in enumerate(labels):
-        clusters[label].append(idx)
-    clusters = clusters.values()
+    clusters = [np.flatnonzero(labels == label)
+                for label in np.unique(labels)]
     #plot_clusters(obs, clusters)
     return clusters
 
 
-def markov(samples, inflation=5, max_iterations=100, by_pca=True):
+def markov(samples, inflation=5, max_iterations=100, by_pca=True,
+           n_neighbors=None):
     """Markov-cluster control samples by their read depths' correlation.
 
     Each of the matrices in the resulting iterable (list) can be processed the
@@ -49,6 +89,10 @@ def markov(samples, inflation=5, max_iterations=100, by_pca=True):
         Inflation parameter for MCL. Must be >1; higher more granular clusters.
     by_pca : bool
         If true, similarity is by PCA; otherwise, by Pearson correlation.
+    n_neighbors : int
+        If given (with `by_pca`), only link each sample to this many of its
+        nearest neighbors, and run MCL on the resulting sparse graph. Memory
+        then grows linearly with the number of samples.
 
     Return
     ------
@@ -62,9 +106,12 @@ def markov(samples, inflation=5, max_iterations=100, by_pca=True):
     if by_pca:
         pca_matrix = pca_sk(samples, 2)  # pca_plain
         # Convert to similarity matrix
-        from scipy.spatial import distance
-        dists = distance.squareform(distance.pdist(pca_matrix))
-        M = 1 - (dists / dists.max())
+        if n_neighbors:
+            M = knn_similarity(pca_matrix, n_neighbors)
+        else:
+            from scipy.spatial import distance
+            dists = distance.squareform(distance.pdist(pca_matrix))
+            M = 1 - (dists / dists.max())
     else:
         M = np.corrcoef(samples)
 
@@ -73,12 +120,34 @@ def markov(samples, inflation=5, max_iterations=100, by_pca=True):
     return clusters
 
 
+def knn_similarity(points, n_neighbors):
+    """Sparse similarity graph linking each point to its nearest neighbors.
+
+    Similarity is scaled as in the dense case, ``1 - dist / max_dist``, with
+    each point linked to itself. The graph is made symmetric.
+    """
+    from scipy.spatial import cKDTree
+    n_points = len(points)
+    k = min(n_neighbors + 1, n_points)
+    dists, idx = cKDTree(points).query(points, k=k)
+    dists = dists.reshape(n_points, k)
+    idx = idx.reshape(n_points, k)
+    max_dist = dists.max()
+    sims = 1 - dists / max_dist if max_dist > 0 else np.ones_like(dists)
+    M = sparse.csr_matrix((sims.ravel(), (np.repeat(np.arange(n_points), k),
+                                          idx.ravel())),
+                          shape=(n_points, n_points))
+    return M.maximum(M.T).tocsc()
+
+
 # https://github.com/koteth/python_mcl/blob/master/mcl/mcl_clustering.py
 # https://github.com/GuyAllard/markov_clustering/blob/master/markov_clustering/mcl.py
 # https://stackoverflow.com/questions/44243525/mcl-clustering-implementation-in-python-deal-with-overlap
 def mcl(M, max_iterations, inflation, expansion=2):
-    """Markov cluster algorithm."""
-    print("M_init:\n", M)
+    """Markov cluster algorithm.
+
+    `M` may be a dense array or a SciPy sparse matrix.
+    """
     M = normalize(M)
     #print("M_norm:\n", M)
     for i in range(max_iterations):
@@ -98,6 +167,9 @@ def mcl(M, max_iterations, inflation, expansion=2):
 
 def normalize(A):
     """Normalize matrix columns."""
+    if sparse.issparse(A):
+        col_sums = np.asarray(A.sum(axis=0)).ravel()
+        return (A @ sparse.diags(1 / col_sums)).tocsc()
     return A / A.sum(axis=0)
 
 
@@ -122,11 +194,18 @@ def inflate(A, inflation):
     Use mcl's cluster validation tools 'clm dist' and 'clm info' to test the
     quality and coherency of your clusterings.
     """
+    if sparse.issparse(A):
+        return normalize(A.power(inflation))
     return normalize(np.power(A, inflation))
 
 
 def expand(A, expansion):
     """Apply cluster expansion with the given matrix power."""
+    if sparse.issparse(A):
+        result = A
+        for _i in range(expansion - 1):
+            result = result @ A
+        return result
     return np.linalg.matrix_power(A, expansion)
 
 
@@ -135,6 +214,10 @@ def converged(M, M_prev):
 
     Criterion: homogeneity(??) or no change from previous round.
     """
+    if sparse.issparse(M):
+        # Same tolerances as np.allclose
+        diff = abs(M - M_prev) - 1e-05 * abs(M_prev)
+        return diff.max() <= 1e-08
     return np.allclose(M, M_prev)
 
 
@@ -156,6 +239,9 @@ def get_clusters(M):
         number of clusters.
     """
     attractors_idx = M.diagonal().nonzero()[0]
+    if sparse.issparse(M):
+        M = M.tocsr()
+        return [M[idx].nonzero()[1] for idx in attractors_idx]
     clusters_idx = [M[idx].nonzero()[0]
                     for idx in attractors_idx]
     return clusters_idx
@@ -210,6 +296,10 @@ def prune(M, threshold=.001):
 
     """
     pruned = M.copy()
+    if sparse.issparse(pruned):
+        pruned.data[pruned.data < threshold] = 0
+        pruned.eliminate_zeros()
+        return pruned
     pruned[pruned < threshold] = 0
     return pruned
 
@@ -223,9 +313,18 @@ def pca_sk(data, n_components=None):
     n_components : int
 
     Returns: PCA-transformed data with `n_components` columns.
+
+    Uses randomized (truncated) SVD with a fixed seed when only a few
+    components are requested, so the result is reproducible and the full
+    decomposition is never computed.
     """
     from sklearn.decomposition import PCA
-    return PCA(n_components=n_components).fit_transform(data)
+    if n_components:
+        n_components = min(n_components, *data.shape)
+    svd_solver = ('randomized' if n_components and
+                  n_components < .8 * min(data.shape) else 'full')
+    return PCA(n_components=n_components, svd_solver=svd_solver,
+               random_state=0xA5EED).fit_transform(data)
 
 
 def pca_plain(data, n_components=None):
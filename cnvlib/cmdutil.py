@@ -86,3 +86,14 @@ def write_dataframe(outfname, dframe, header=True):
     with tabio.safe_write(outfname or sys.stdout) as handle:
         dframe.to_csv(handle, header=header,
                       index=False, sep='\t', float_format='%.6g')
+
+
+def write_dataframes(outfname, dframes, header=True):
+    """Write a series of pandas.DataFrames, one after another, as one table.
+
+    The column header (if any) is taken from the first DataFrame.
+    """
+    with tabio.safe_write(outfname or sys.stdout) as handle:
+        for i, dframe in enumerate(dframes):
+            dframe.to_csv(handle, header=header and not i,
+                          index=False, sep='\t', float_format='%.6g')
@@ -3,10 +3,9 @@ import logging
 
 import numpy as np
 import pandas as pd
-from scipy.stats import median_test
 from skgenome import GenomicArray
 
-from . import core, descriptives, params, smoothing
+from . import descriptives, params, smoothing
 from .segmetrics import segment_mean
 
 
@@ -82,28 +81,100 @@ class CopyNumArray(GenomicArray):
         tuple
             Pairs of: (gene name, CNA of rows with same name)
         """
-        ignore += params.ANTITARGET_ALIASES
-        for _chrom, subgary in self.by_chromosome():
-            prev_idx = 0
-            for gene, gene_idx in subgary._get_gene_map().items():
-                if gene not in ignore:
-                    if not len(gene_idx):
-                        logging.warning("Specified gene name somehow missing: "
-                                        "%s", gene)
-                        continue
-                    start_idx = gene_idx[0]
-                    end_idx = gene_idx[-1] + 1
-                    if prev_idx < start_idx:
-                        # Include intergenic regions
-                        yield params.ANTITARGET_NAME, subgary.as_dataframe(
-                                subgary.data.loc[prev_idx:start_idx])
-                    yield gene, subgary.as_dataframe(
-                            subgary.data.loc[start_idx:end_idx])
-                    prev_idx = end_idx
-            if prev_idx < len(subgary) - 1:
-                # Include the telomere
-                yield params.ANTITARGET_NAME, subgary.as_dataframe(
-                        subgary.data.loc[prev_idx:])
+        for name, start, end in zip(*self.gene_runs(ignore)):
+            yield name, self.as_dataframe(self.data.iloc[start:end])
+
+    def gene_runs(self, ignore=params.IGNORE_GENE_NAMES, blocks=None):
+        """Locate the run of bins covered by each gene, as in `by_gene`.
+
+        A gene's run extends from its first to its last bin within a block of
+        consecutive bins (by default, a chromosome); the bins between runs are
+        grouped into "Antitarget" runs. Each distinct gene label is split on
+        commas just once, and runs are found for the whole array at once.
+
+        Parameters
+        ----------
+        ignore : list or tuple of str
+            Gene names to treat as "Antitarget" bins, as in `by_gene`.
+        blocks : array
+            Label for each bin; runs do not extend across changes in the label.
+            By default, the chromosome names.
+
+        Returns
+        -------
+        tuple
+            Arrays of: gene names, and the start and end row positions
+            (half-open, as for `iloc`) of each run, in genomic order.
+        """
+        ignore = tuple(ignore) + params.ANTITARGET_ALIASES
+        n_bins = len(self)
+        if blocks is None:
+            blocks = self.data['chromosome'].values
+        is_new = np.ones(n_bins, dtype=np.bool_)
+        is_new[1:] = (blocks[1:] != blocks[:-1])
+        block_starts = np.flatnonzero(is_new)
+        block_ends = np.append(block_starts[1:], n_bins)
+        block_ids = np.cumsum(is_new) - 1
+
+        # Each bin's gene labels, split on commas, as (row, gene) occurrences
+        label_codes, labels = pd.factorize(self.data['gene'])
+        parts = [label.split(',') for label in labels]
+        n_parts = np.array([len(p) for p in parts], dtype=np.int_)
+        part_codes, gene_names = pd.factorize(
+            np.array([g for p in parts for g in p], dtype=object))
+        gene_names = np.asarray(gene_names, dtype=object)
+        rows = np.flatnonzero(label_codes >= 0)
+        counts = n_parts[label_codes[rows]]
+        occ_rows = np.repeat(rows, counts)
+        occ_parts = (np.repeat(n_parts.cumsum()[label_codes[rows]] - counts,
+                               counts)
+                     + np.arange(len(occ_rows))
+                     - np.repeat(counts.cumsum() - counts, counts))
+        occ_genes = part_codes[occ_parts] if len(occ_parts) else occ_parts
+
+        # First and last occurrence of each gene within each block
+        occ_keys = block_ids[occ_rows] * len(gene_names) + occ_genes
+        keys, first_occ = np.unique(occ_keys, return_index=True)
+        _keys, last_occ = np.unique(occ_keys[::-1], return_index=True)
+        last_occ = len(occ_keys) - 1 - last_occ
+        order = np.argsort(first_occ, kind='mergesort')
+        genes = gene_names[keys[order] % max(len(gene_names), 1)]
+        run_starts = occ_rows[first_occ[order]]
+        run_ends = occ_rows[last_occ[order]] + 1
+        is_kept = np.array([g not in ignore for g in genes], dtype=np.bool_)
+        genes = genes[is_kept]
+        run_starts = run_starts[is_kept]
+        run_ends = run_ends[is_kept]
+        run_blocks = block_ids[run_starts]
+
+        # Intergenic bins: before each gene run, and at the end of each block
+        offset = run_blocks * (n_bins + 1)
+        prev_ends = np.maximum.accumulate(run_ends + offset)
+        prev_ends = np.append(-1, prev_ends[:-1]) - offset
+        gap_starts = np.maximum(prev_ends, block_starts[run_blocks])
+        tel_starts = block_starts.copy()
+        np.maximum.at(tel_starts, run_blocks, run_ends)
+        runs_thru = np.bincount(run_blocks,
+                                minlength=len(block_starts)).cumsum()
+        # Sort all runs into genomic order
+        gap_ok = (gap_starts < run_starts)
+        tel_ok = (tel_starts < block_ends)
+        n_runs = len(genes)
+        rank = np.concatenate([3 * np.arange(n_runs)[gap_ok],
+                               3 * np.arange(n_runs) + 1,
+                               3 * runs_thru[tel_ok] - 1])
+        block = np.concatenate([run_blocks[gap_ok], run_blocks,
+                                np.flatnonzero(tel_ok)])
+        order = np.lexsort((block, rank))
+        names = np.concatenate([
+            np.repeat(params.ANTITARGET_NAME, gap_ok.sum()).astype(object),
+            genes,
+            np.repeat(params.ANTITARGET_NAME, tel_ok.sum()).astype(object)])
+        starts = np.concatenate([gap_starts[gap_ok], run_starts,
+                                 tel_starts[tel_ok]])
+        ends = np.concatenate([run_starts[gap_ok], run_ends,
+                               block_ends[tel_ok]])
+        return names[order], starts[order], ends[order]
 
     # Manipulation
 
@@ -192,33 +263,44 @@ class CopyNumArray(GenomicArray):
             Another, usually smaller, copy of `self` with each gene's bins
             reduced to a single bin with appropriate values.
         """
-        def squash_rows(name, rows):
-            """Combine multiple rows (for the same gene) into one row."""
-            if len(rows) == 1:
-                return tuple(rows.iloc[0])
-            chrom = core.check_unique(rows.chromosome, 'chromosome')
-            start = rows.start.iat[0]
-            end = rows.end.iat[-1]
-            cvg = summary_func(rows.log2)
-            outrow = [chrom, start, end, name, cvg]
-            # Handle extra fields
-            # ENH - no coverage stat; do weighted average as appropriate
-            for xfield in ('depth', 'gc', 'rmask', 'spread', 'weight'):
-                if xfield in self:
-                    outrow.append(summary_func(rows[xfield]))
-            if 'probes' in self:
-                outrow.append(sum(rows['probes']))
-            return tuple(outrow)
-
-        outrows = []
-        for name, subarr in self.by_gene(ignore):
-            if not len(subarr):
-                continue
-            if name in params.ANTITARGET_ALIASES and not squash_antitarget:
-                outrows.extend(subarr.data.itertuples(index=False))
-            else:
-                outrows.append(squash_rows(name, subarr.data))
-        return self.as_rows(outrows)
+        names, starts, ends = self.gene_runs(ignore)
+        if not squash_antitarget:
+            # Keep each intergenic bin as it is, i.e. as a run of 1 bin
+            is_anti = np.isin(names, params.ANTITARGET_ALIASES)
+            sizes = np.where(is_anti, ends - starts, 1)
+            run_idx = np.repeat(np.arange(len(names)), sizes)
+            within = (np.arange(len(run_idx))
+                      - np.repeat(sizes.cumsum() - sizes, sizes))
+            names = names[run_idx]
+            starts = starts[run_idx] + within
+            ends = np.where(is_anti[run_idx], starts + 1, ends[run_idx])
+
+        outdata = self.data.iloc[starts].reset_index(drop=True)
+        # Runs of 1 bin are kept as they are
+        is_multi = (ends - starts > 1)
+        if not is_multi.any():
+            return self.as_dataframe(outdata)
+        starts = starts[is_multi]
+        ends = ends[is_multi]
+        outdata.loc[is_multi, 'end'] = self.data['end'].values[ends - 1]
+        outdata.loc[is_multi, 'gene'] = names[is_multi]
+        # ENH - no coverage stat; do weighted average as appropriate
+        for field in ('log2', 'depth', 'gc', 'rmask', 'spread', 'weight'):
+            if field in self:
+                values = self.data[field].values
+                if summary_func is descriptives.biweight_location:
+                    summary = descriptives.apply_runs_cols(
+                        descriptives.biweight_location_cols,
+                        values, starts, ends)
+                else:
+                    summary = [summary_func(values[start:end])
+                               for start, end in zip(starts, ends)]
+                outdata.loc[is_multi, field] = summary
+        if 'probes' in self:
+            probes = np.append(self.data['probes'].values, 0)
+            outdata.loc[is_multi, 'probes'] = np.add.reduceat(
+                probes, np.ravel(np.column_stack((starts, ends))))[::2]
+        return self.as_dataframe(outdata)
 
     # Chromosomal sex
 
@@ -325,6 +407,8 @@ class CopyNumArray(GenomicArray):
         use_weight = ('weight' in self)
         auto_w = auto['weight'].values if use_weight else None
 
+        from scipy.stats import median_test
+
         def compare_to_auto(vals, weights):
             # Mood's median test stat is chisq -- near 0 for similar median
             try:
@@ -432,23 +516,25 @@ class CopyNumArray(GenomicArray):
         -------
         array
             Residual log2 values from `self` relative to `segments`; same length
-            as `self`.
+            as `self`. Bins that fall outside all of the segments are NaN;
+            where segments overlap, bins are relative to the first segment.
         """
+        log2 = self.data['log2']
         if not segments:
-            resids = [subcna.log2 - subcna.log2.median()
-                      for _chrom, subcna in self.by_chromosome()]
+            groups = pd.factorize(self.data['chromosome'])[0]
+            centers = log2.groupby(groups).median().values
         elif "log2" in segments:
-            resids = [bins_lr - seg_lr
-                      for seg_lr, bins_lr in zip(
-                          segments['log2'],
-                          self.iter_ranges_of(segments, 'log2', mode='inner',
-                                              keep_empty=True))
-                      if len(bins_lr)]
+            groups = self.range_idx(segments, mode='inner')
+            centers = segments['log2'].values
         else:
-            resids = [lr - lr.median()
-                      for lr in self.iter_ranges_of(segments, 'log2',
-                                                    keep_empty=False)]
-        return pd.concat(resids) if resids else pd.Series([])
+            groups = self.range_idx(segments)
+            medians = log2.groupby(groups).median()
+            centers = np.repeat(np.nan, len(segments))
+            is_seg = (medians.index >= 0)
+            centers[medians.index[is_seg]] = medians.values[is_seg]
+        # Bins outside all segments (group -1) take the trailing NaN
+        centers = np.append(centers, np.nan)
+        return log2 - centers[groups]
 
     def smooth_log2(self, bandwidth=None, by_arm=True):
         """Smooth log2 values with a sliding window.
@@ -3,6 +3,7 @@
 #   "_cmd_*" handles I/O and arguments processing for the command
 #   "do_*" runs the command's functionality as an API
 import argparse
+import importlib
 import logging
 import os
 import sys
@@ -13,38 +14,64 @@ import warnings
 warnings.filterwarnings('ignore', message="numpy.dtype size changed")
 warnings.filterwarnings('ignore', message="numpy.ufunc size changed")
 
-# Choose a safe plotting backend supported by the current platform
-import matplotlib
-if not os.environ.get('DISPLAY'):
-    # If running headless, use a GUI-less backend
-    matplotlib.use('Agg')
-elif sys.platform == 'darwin':
-    # Prevent crash on OS X
-    # https://github.com/MTG/sms-tools/issues/36
-    matplotlib.use('TkAgg')
-
-from matplotlib import pyplot
-from matplotlib.backends.backend_pdf import PdfPages
-pyplot.ioff()
-
 import pandas as pd
 from skgenome import tabio, GenomicArray as _GA
 from skgenome.rangelabel import to_label
 
-from . import (access, antitarget, autobin, batch, bintest, call, core,
-               coverage, diagram, export, fix, heatmap, import_rna, importers,
-               metrics, parallel, reference, reports, scatter, segmentation,
-               segmetrics, target)
+# NB: Each command's modules are imported when the command is run, so that
+# starting the CLI doesn't load every command's dependencies (e.g. plotting)
+from . import core, parallel, params
 from .cmdutil import (load_het_snps, read_cna, verify_sample_sex,
-                      write_tsv, write_text, write_dataframe)
+                      write_tsv, write_text, write_dataframe, write_dataframes)
 
 from ._version import __version__
 
 
 __all__ = []
-def public(fn):
-    __all__.append(fn.__name__)
-    return fn
+def public(module_name, func_name, alias=None):
+    """Export a function of a cnvlib module as part of the API.
+
+    The module is only imported when the function is first called (see
+    `_lazy_function`).
+    """
+    name = alias or func_name
+    globals()[name] = _lazy_function(module_name, func_name, name)
+    __all__.append(name)
+
+
+def _lazy_function(module_name, func_name, name=None):
+    """Stand-in for a function of a cnvlib module, imported on first call."""
+    func = None
+
+    def api_func(*args, **kwargs):
+        nonlocal func
+        if func is None:
+            if module_name in ('batch', 'heatmap', 'scatter'):
+                _pyplot()
+            module = importlib.import_module('.' + module_name, __package__)
+            func = getattr(module, func_name)
+        return func(*args, **kwargs)
+
+    api_func.__name__ = api_func.__qualname__ = name or func_name
+    api_func.__doc__ = ("Call `cnvlib.%s.%s`, importing its module first."
+                        % (module_name, func_name))
+    return api_func
+
+
+def _pyplot():
+    """Import matplotlib's pyplot, first choosing a safe plotting backend."""
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        if not os.environ.get('DISPLAY'):
+            # If running headless, use a GUI-less backend
+            matplotlib.use('Agg')
+        elif sys.platform == 'darwin':
+            # Prevent crash on OS X
+            # https://github.com/MTG/sms-tools/issues/36
+            matplotlib.use('TkAgg')
+    from matplotlib import pyplot
+    pyplot.ioff()
+    return pyplot
 
 
 AP = argparse.ArgumentParser(
@@ -61,6 +88,8 @@ AP_subparsers = AP.add_subparsers(
 
 def _cmd_batch(args):
     """Run the complete CNVkit pipeline on one or more BAM files."""
+    _pyplot()
+    from . import batch, reference
     logging.info("CNVkit %s", __version__)
     # Validate/restrict options, beyond what argparse mutual exclusion can do
     bad_args_msg = ""
@@ -157,7 +186,7 @@ P_batch.add_argument('-m', '--seq-method', '--method',
                 sequencing ('wgs'). Determines whether and how to use antitarget
                 bins. [Default: %(default)s]""")
 P_batch.add_argument('--segment-method',
-        choices=segmentation.SEGMENT_METHODS,
+        choices=params.SEGMENT_METHODS,
         default='cbs',
         help="""Method used in the 'segment' step. [Default: %(default)s]"""),
 P_batch.add_argument('-y', '--male-reference', '--haploid-x-reference',
@@ -241,11 +270,12 @@ P_batch.set_defaults(func=_cmd_batch)
 
 # target ----------------------------------------------------------------------
 
-do_target = public(target.do_target)
+public("target", "do_target")
 
 
 def _cmd_target(args):
     """Transform bait intervals into targets more suitable for CNVkit."""
+    from . import target
     regions = tabio.read_auto(args.interval)
     regions = target.do_target(regions, args.annotate, args.short_names,
                                args.split, args.avg_size)
@@ -276,14 +306,17 @@ P_target.set_defaults(func=_cmd_target)
 
 # access ----------------------------------------------------------------------
 
-do_access = public(access.do_access)
+public("access", "do_access")
 
 
 def _cmd_access(args):
     """List the locations of accessible sequence regions in a FASTA file."""
+    from . import access
     access_arr = access.do_access(args.fa_fname, args.exclude,
-                                  args.min_gap_size)
-    tabio.write(access_arr, args.output, "bed3")
+                                  args.min_gap_size,
+                                  processes=args.processes,
+                                  cache_dir=args.cache_dir)
+    tabio.write(access_arr, args.output or sys.stdout, "bed3")
 
 
 P_access = AP_subparsers.add_parser('access', help=_cmd_access.__doc__)
@@ -296,18 +329,30 @@ P_access.add_argument("-s", "--min-gap-size", type=int, default=5000,
 P_access.add_argument("-x", "--exclude", action="append", default=[],
                 help="""Additional regions to exclude, in BED format. Can be
                 used multiple times.""")
+P_access.add_argument("-p", "--processes",
+                nargs='?', type=int, const=0, default=1,
+                help="""Number of subprocesses to scan chromosomes in parallel.
+                Without an argument, use the maximum number of available CPUs.
+                [Default: use 1 process]""")
+P_access.add_argument("-c", "--cache-dir", metavar="DIRECTORY",
+                default=os.environ.get('CNVKIT_CACHE_DIR'),
+                help="""Directory in which to cache the FASTA file's accessible
+                regions, keyed by the file's checksum, so that later runs on
+                the same genome skip the scan. Also used by 'batch -m wgs'.
+                [Default: $CNVKIT_CACHE_DIR, if set]""")
 P_access.add_argument("-o", "--output", metavar="FILENAME",
-                type=argparse.FileType('w'), default=sys.stdout,
+                type=argparse.FileType('w'),
                 help="Output file name")
 P_access.set_defaults(func=_cmd_access)
 
 
 # antitarget ------------------------------------------------------------------
 
-do_antitarget = public(antitarget.do_antitarget)
+public("antitarget", "do_antitarget")
 
 def _cmd_antitarget(args):
     """Derive off-target ("antitarget") bins from target regions."""
+    from . import access, antitarget
     targets = tabio.read_auto(args.targets)
     access = tabio.read_auto(args.access) if args.access else None
     out_arr = antitarget.do_antitarget(targets, access, args.avg_size,
@@ -337,11 +382,12 @@ P_anti.set_defaults(func=_cmd_antitarget)
 
 # autobin ---------------------------------------------------------------------
 
-do_autobin = public(autobin.do_autobin)
+public("autobin", "do_autobin")
 
 
 def _cmd_autobin(args):
     """Quickly calculate reasonable bin sizes from BAM read counts."""
+    from . import antitarget, autobin, target
     if args.method in ('hybrid', 'amplicon') and not args.targets:
         raise RuntimeError("Sequencing method %r requires targets (-t)",
                            args.method)
@@ -463,11 +509,12 @@ P_autobin.set_defaults(func=_cmd_autobin)
 
 # coverage --------------------------------------------------------------------
 
-do_coverage = public(coverage.do_coverage)
+public("coverage", "do_coverage")
 
 
 def _cmd_coverage(args):
     """Calculate coverage in the given regions from BAM read depths."""
+    from . import coverage
     pset = coverage.do_coverage(args.interval, args.bam_file, args.count,
                                 args.min_mapq, args.processes, args.fasta)
     if not args.output:
@@ -507,12 +554,14 @@ P_coverage.set_defaults(func=_cmd_coverage)
 
 # reference -------------------------------------------------------------------
 
-do_reference = public(reference.do_reference)
-do_reference_flat = public(reference.do_reference_flat)
+public("reference", "do_reference")
+public("reference", "do_reference_flat")
+public("reference", "do_reference_pool")
 
 
 def _cmd_reference(args):
     """Compile a coverage reference from the given files (normal samples)."""
+    from . import reference
     usage_err_msg = ("Give .cnn samples OR targets and (optionally) antitargets.")
     if args.targets:
         # Flat refence
@@ -520,7 +569,7 @@ def _cmd_reference(args):
         ref_probes = reference.do_reference_flat(args.targets, args.antitargets,
                                                  args.fasta,
                                                  args.male_reference)
-    elif args.references:
+    elif args.references or args.pool:
         # Pooled reference
         assert not args.targets and not args.antitargets, usage_err_msg
         filenames = []
@@ -536,11 +585,21 @@ def _cmd_reference(args):
                      len(targets), len(antitargets))
         female_samples = ((args.sample_sex.lower() not in ['y', 'm', 'male'])
                           if args.sample_sex else None)
-        ref_probes = reference.do_reference(targets, antitargets, args.fasta,
-                                            args.male_reference, female_samples,
-                                            args.do_gc, args.do_edge,
-                                            args.do_rmask, args.cluster,
-                                            args.min_cluster_size)
+        if args.pool:
+            ref_probes = reference.do_reference_pool(
+                args.pool, targets, antitargets, args.remove_samples,
+                args.fasta, args.male_reference, female_samples, args.do_gc,
+                args.do_edge, args.do_rmask, args.cluster,
+                args.min_cluster_size, args.processes)
+        else:
+            ref_probes = reference.do_reference(targets, antitargets,
+                                                args.fasta,
+                                                args.male_reference,
+                                                female_samples, args.do_gc,
+                                                args.do_edge, args.do_rmask,
+                                                args.cluster,
+                                                args.min_cluster_size,
+                                                args.processes)
     else:
         raise ValueError(usage_err_msg)
 
@@ -572,6 +631,11 @@ P_reference.add_argument('-x', '--sample-sex', '-g', '--gender',
         help="""Specify the chromosomal sex of all given samples as male or
                 female. (Default: guess each sample from coverage of X and Y
                 chromosomes).""")
+P_reference.add_argument('-p', '--processes',
+        nargs='?', type=int, const=0, default=1,
+        help="""Number of subprocesses to load and bias-correct the normal
+                samples in parallel. Give 0 or a negative value to use the
+                maximum number of available CPUs. [Default: use 1 process]""")
 P_reference.add_argument('-y', '--male-reference', '--haploid-x-reference',
         action='store_true',
         help="""Create a male reference: shift female samples' chrX
@@ -579,6 +643,20 @@ P_reference.add_argument('-y', '--male-reference', '--haploid-x-reference',
                 Otherwise, shift male samples' chrX by +1, so the reference chrX
                 average is 0.""")
 
+P_reference_pool = P_reference.add_argument_group(
+    "To update a stored pool of normal samples incrementally")
+P_reference_pool.add_argument('--pool', metavar="DIRECTORY",
+        help="""Stored pool of bias-corrected normal sample coverages, as a
+                directory of .npy files. If it exists, add the given normal
+                samples to the pool (replacing any with the same sample ID)
+                instead of reprocessing every sample; otherwise, create it.
+                The updated pool is saved back to this directory, and the
+                reference is built from all samples in the pool.""")
+P_reference_pool.add_argument('--remove-sample', metavar="SAMPLE_ID",
+        action='append', dest='remove_samples',
+        help="""Remove a sample from the pool given with --pool. Can be used
+                multiple times.""")
+
 P_reference_flat = P_reference.add_argument_group(
     "To construct a generic, \"flat\" copy number reference with neutral "
     "expected coverage")
@@ -600,7 +678,7 @@ P_reference.set_defaults(func=_cmd_reference)
 
 # fix -------------------------------------------------------------------------
 
-do_fix = public(fix.do_fix)
+public("fix", "do_fix")
 
 
 def _cmd_fix(args):
@@ -609,6 +687,7 @@ def _cmd_fix(args):
     Adjust raw coverage data according to the given reference, correct potential
     biases and re-center.
     """
+    from . import fix
     # Verify that target and antitarget are from the same sample
     tgt_raw = read_cna(args.target, sample_id=args.sample_id)
     anti_raw = read_cna(args.antitarget, sample_id=args.sample_id)
@@ -655,11 +734,12 @@ P_fix.set_defaults(func=_cmd_fix)
 
 # segment ---------------------------------------------------------------------
 
-do_segmentation = public(segmentation.do_segmentation)
+public("segmentation", "do_segmentation")
 
 
 def _cmd_segment(args):
     """Infer copy number segments from the given coverage table."""
+    from . import segmentation
     cnarr = read_cna(args.filename)
     variants = load_het_snps(args.vcf, args.sample_id, args.normal_id,
                              args.min_variant_depth, args.zygosity_freq)
@@ -691,7 +771,7 @@ P_segment.add_argument('-d', '--dataframe',
         help="""File name to save the raw R dataframe emitted by CBS or
                 Fused Lasso. (Useful for debugging.)""")
 P_segment.add_argument('-m', '--method',
-        choices=segmentation.SEGMENT_METHODS,
+        choices=params.SEGMENT_METHODS,
         default='cbs',
         help="""Segmentation method (see docs), or 'none' for chromosome
                 arm-level averages as segments. [Default: %(default)s]""")
@@ -748,11 +828,12 @@ P_segment.set_defaults(func=_cmd_segment)
 
 # call ------------------------------------------------------------------------
 
-do_call = public(call.do_call)
+public("call", "do_call")
 
 
 def _cmd_call(args):
     """Call copy number variants from segmented log2 ratios."""
+    from . import call
     if args.purity and not 0.0 < args.purity <= 1.0:
         raise RuntimeError("Purity must be between 0 and 1.")
 
@@ -859,6 +940,7 @@ def _cmd_diagram(args):
     If both the raw probes and segments are given, show them side-by-side on
     each chromosome (segments on the left side, probes on the right side).
     """
+    from . import diagram
     if not args.filename and not args.segment:
         raise ValueError("Must specify a filename as an argument or with "
                          "the '-s' option, or both. You did neither.")
@@ -920,11 +1002,13 @@ P_diagram.set_defaults(func=_cmd_diagram)
 
 # scatter ---------------------------------------------------------------------
 
-do_scatter = public(scatter.do_scatter)
+public("scatter", "do_scatter")
 
 
 def _cmd_scatter(args):
     """Plot probe log2 coverages and segmentation calls together."""
+    pyplot = _pyplot()
+    from . import scatter
     cnarr = read_cna(args.filename, sample_id=args.sample_id
                     ) if args.filename else None
     segarr = read_cna(args.segment, sample_id=args.sample_id
@@ -940,23 +1024,20 @@ def _cmd_scatter(args):
         ("fig_size", args.fig_size),
         ("antitarget_marker", args.antitarget_marker),
         ("segment_color", args.segment_color),
+        ("density", args.density),
     ) if v is not None}
 
     if args.range_list:
-        with PdfPages(args.output) as pdf_out:
-            for region in tabio.read_auto(args.range_list).coords():
-                try:
-                    if args.title is not None:
-                        scatter_opts["title"] = "%s %s" % (args.title,
-                                                           region.chromosome)
-                    scatter.do_scatter(cnarr, segarr, varr, show_range=region,
-                                       **scatter_opts)
-                except ValueError as exc:
-                    # Probably no bins in the selected region
-                    logging.warning("Not plotting region %r: %s",
-                                    to_label(region), exc)
-                pdf_out.savefig()
-                pyplot.close()
+        if not (args.output or args.output_dir):
+            raise ValueError("Option -l/--range-list requires -o/--output "
+                             "or -d/--output-dir")
+        if args.output_dir and not os.path.isdir(args.output_dir):
+            os.mkdir(args.output_dir)
+            logging.info("Created directory %s", args.output_dir)
+        scatter.do_scatter_pages(cnarr, segarr, varr,
+                                 tabio.read_auto(args.range_list),
+                                 args.output, args.output_dir, args.title,
+                                 args.processes, **scatter_opts)
     else:
         if args.title is not None:
             scatter_opts["title"] = args.title
@@ -988,13 +1069,24 @@ P_scatter.add_argument('-l', '--range-list',
                 list or 'chr:start-end' text. Creates focal plots similar to
                 -c/--chromosome for each listed region, combined into a
                 multi-page PDF.  The output filename must also be
-                specified (-o/--output).""")
+                specified (-o/--output), or else an output directory for
+                separate PNG files (-d/--output-dir).""")
 P_scatter.add_argument('-w', '--width', type=float, default=1e6,
         help="""Width of margin to show around the selected gene(s) (-g/--gene)
                 or small chromosomal region (-c/--chromosome).
                 [Default: %(default)d]""")
 P_scatter.add_argument('-o', '--output', metavar="FILENAME",
         help="Output PDF file name.")
+P_scatter.add_argument('-d', '--output-dir', metavar="DIRECTORY",
+        help="""With -l/--range-list, write each region's plot to a separate
+                PNG file in this directory, named by sample ID and the region's
+                name (e.g. gene) or coordinates.""")
+P_scatter.add_argument('-p', '--processes',
+        nargs='?', type=int, const=0, default=1,
+        help="""Number of subprocesses to plot regions in parallel, with
+                -l/--range-list and -d/--output-dir. Without an argument, use
+                the maximum number of available CPUs.
+                [Default: use 1 process]""")
 
 P_scatter_aes = P_scatter.add_argument_group("Plot aesthetics")
 P_scatter_aes.add_argument('-a', '--antitarget-marker',
@@ -1007,9 +1099,14 @@ P_scatter_aes.add_argument("--by-bin", action="store_true",
                 coordinates. All bins will be shown with equal width, no blank
                 regions will be shown, and x-axis values indicate bin number
                 (within chromosome) instead of genomic position.""")
-P_scatter_aes.add_argument('--segment-color', default=scatter.SEG_COLOR,
+P_scatter_aes.add_argument('--density', action='store_true',
+        help="""In genome-wide plots, draw bins and SNVs as an image of point
+                density instead of as individual points. Much faster for large
+                (e.g. WGS) inputs.""")
+P_scatter_aes.add_argument('--segment-color',
         help="""Plot segment lines in this color. Value can be any string
-                accepted by matplotlib, e.g. 'red' or '#CC0000'.""")
+                accepted by matplotlib, e.g. 'red' or '#CC0000'.
+                [Default: darkorange]""")
 P_scatter_aes.add_argument('--title',
         help="Plot title. [Default: sample ID, from filename or -i]")
 P_scatter_aes.add_argument('-t', '--trend', action='store_true',
@@ -1047,19 +1144,28 @@ P_scatter.set_defaults(func=_cmd_scatter)
 
 # heatmap ---------------------------------------------------------------------
 
-do_heatmap = public(heatmap.do_heatmap)
+public("heatmap", "do_heatmap")
 
 
 def _cmd_heatmap(args):
     """Plot copy number for multiple samples as a heatmap."""
-    cnarrs = []
-    for fname in args.filenames:
-        cnarr = read_cna(fname)
-        if args.adjust_xy:
-            is_sample_female = verify_sample_sex(cnarr, args.sample_sex,
-                                                 args.male_reference)
-            cnarr = cnarr.shift_xx(args.male_reference, is_sample_female)
-        cnarrs.append(cnarr)
+    pyplot = _pyplot()
+    from . import heatmap
+    if len(args.filenames) == 1 and args.filenames[0].endswith('.npz'):
+        # Saved by --save-matrix
+        cnarrs = heatmap.CohortMatrix.read(args.filenames[0])
+    else:
+        cnarrs = []
+        for fname in args.filenames:
+            cnarr = read_cna(fname)
+            if args.adjust_xy:
+                is_sample_female = verify_sample_sex(cnarr, args.sample_sex,
+                                                     args.male_reference)
+                cnarr = cnarr.shift_xx(args.male_reference, is_sample_female)
+            cnarrs.append(cnarr)
+        if args.save_matrix:
+            cnarrs = heatmap.CohortMatrix.from_cnarrs(cnarrs, args.by_bin)
+            cnarrs.write(args.save_matrix)
     heatmap.do_heatmap(cnarrs, args.chromosome, args.desaturate, args.by_bin, 
                        args.delim_sampl, args.vertical, args.title)
     if args.output:
@@ -1072,7 +1178,9 @@ def _cmd_heatmap(args):
 
 P_heatmap = AP_subparsers.add_parser('heatmap', help=_cmd_heatmap.__doc__)
 P_heatmap.add_argument('filenames', nargs='+',
-        help="Sample coverages as raw probes (.cnr) or segments (.cns).")
+        help="""Sample coverages as raw probes (.cnr) or segments (.cns), or a
+                single matrix of samples' values (.npz) saved earlier with
+                --save-matrix.""")
 P_heatmap.add_argument('-c', '--chromosome',
         help="""Chromosome (e.g. 'chr1') or chromosomal range (e.g.
                 'chr1:2333000-2444000') to display. If a range is given,
@@ -1093,6 +1201,11 @@ P_heatmap.add_argument('--no-shift-xy', dest='adjust_xy', action='store_false',
         help="Don't adjust the X and Y chromosomes according to sample sex.")
 P_heatmap.add_argument('-o', '--output', metavar="FILENAME",
         help="Output PDF file name.")
+P_heatmap.add_argument('--save-matrix', metavar="FILENAME",
+        help="""Also save the samples' values, after any X/Y adjustment and
+                --by-bin conversion, as a matrix (.npz) that can be given
+                instead of the sample files to plot the same samples again,
+                e.g. other chromosomal ranges.""")
 # P_heatmap.add_argument('-g', '--gene',
 #         help="Name of gene to display.")
 
@@ -1119,13 +1232,14 @@ P_heatmap.set_defaults(func=_cmd_heatmap)
 
 # breaks ----------------------------------------------------------------------
 
-do_breaks = public(reports.do_breaks)
+public("reports", "do_breaks")
 
 def _cmd_breaks(args):
     """List the targeted genes in which a copy number breakpoint occurs."""
+    from . import reports
     cnarr = read_cna(args.filename)
     segarr = read_cna(args.segment)
-    bpoints = do_breaks(cnarr, segarr, args.min_probes)
+    bpoints = reports.do_breaks(cnarr, segarr, args.min_probes)
     logging.info("Found %d gene breakpoints", len(bpoints))
     write_dataframe(args.output, bpoints)
 
@@ -1146,18 +1260,19 @@ P_breaks.set_defaults(func=_cmd_breaks)
 
 # genemetrics/gainloss --------------------------------------------------------
 
-do_genemetrics = public(reports.do_genemetrics)
+public("reports", "do_genemetrics")
 
 def _cmd_genemetrics(args):
     """Identify targeted genes with copy number gain or loss."""
+    from . import reports
     cnarr = read_cna(args.filename)
     segarr = read_cna(args.segment) if args.segment else None
     is_sample_female = verify_sample_sex(cnarr, args.sample_sex,
                                          args.male_reference)
     # TODO use the stats args
-    table = do_genemetrics(cnarr, segarr, args.threshold, args.min_probes,
-                           args.drop_low_coverage, args.male_reference,
-                           is_sample_female)
+    table = reports.do_genemetrics(cnarr, segarr, args.threshold,
+                                   args.min_probes, args.drop_low_coverage,
+                                   args.male_reference, is_sample_female)
     logging.info("Found %d gene-level gains and losses", len(table))
     write_dataframe(args.output, table)
 
@@ -1244,38 +1359,22 @@ P_genemetrics.set_defaults(func=_cmd_genemetrics)
 
 # Shims
 AP_subparsers._name_parser_map['gainloss'] = P_genemetrics
-do_gainloss = public(do_genemetrics)
+public("reports", "do_genemetrics", "do_gainloss")
 
 
 # sex/gender ------------------------------------------------------------------
 
+public("sex", "do_sex")
+
+
 def _cmd_sex(args):
     """Guess samples' sex from the relative coverage of chromosomes X and Y."""
+    from . import sex
     cnarrs = map(read_cna, args.filenames)
-    table = do_sex(cnarrs, args.male_reference)
+    table = sex.do_sex(cnarrs, args.male_reference, args.processes)
     write_dataframe(args.output, table, header=True)
 
 
-@public
-def do_sex(cnarrs, is_male_reference):
-    """Guess samples' sex from the relative coverage of chromosomes X and Y."""
-    def strsign(num):
-        if num > 0:
-            return "+%.3g" % num
-        return "%.3g" % num
-
-    def guess_and_format(cna):
-        is_xy, stats = cna.compare_sex_chromosomes(is_male_reference)
-        return (cna.meta["filename"] or cna.sample_id,
-                "Male" if is_xy else "Female",
-                strsign(stats['chrx_ratio']) if stats else "NA",
-                strsign(stats['chry_ratio']) if stats else "NA")
-
-    rows = (guess_and_format(cna) for cna in cnarrs)
-    columns = ["sample", "sex", "X_logratio", "Y_logratio"]
-    return pd.DataFrame.from_records(rows, columns=columns)
-
-
 P_sex = AP_subparsers.add_parser('sex', help=_cmd_sex.__doc__)
 P_sex.add_argument('filenames', nargs='+',
         help="Copy number or copy ratio files (*.cnn, *.cnr).")
@@ -1284,22 +1383,28 @@ P_sex.add_argument('-y', '--male-reference', '--haploid-x-reference',
         help="""Assume inputs were normalized to a male reference
                 (i.e. female samples will have +1 log-coverage of chrX;
                 otherwise male samples would have -1 chrX).""")
+P_sex.add_argument('-p', '--processes',
+        nargs='?', type=int, const=0, default=1,
+        help="""Number of subprocesses to compare samples with differing bins
+                in parallel. Without an argument, use the maximum number of
+                available CPUs. [Default: use 1 process]""")
 P_sex.add_argument('-o', '--output', metavar="FILENAME",
         help="Output table file name.")
 P_sex.set_defaults(func=_cmd_sex)
 
 # Shims
 AP_subparsers._name_parser_map['gender'] = P_sex
-do_gender = public(do_sex)
+public("sex", "do_sex", "do_gender")
 
 
 # metrics ---------------------------------------------------------------------
 
-do_metrics = public(metrics.do_metrics)
+public("metrics", "do_metrics")
 
 
 def _cmd_metrics(args):
     """Compute coverage deviations and other metrics for self-evaluation."""
+    from . import metrics
     if (len(args.cnarrays) > 1 and
         args.segments and len(args.segments) > 1 and
         len(args.cnarrays) != len(args.segments)):
@@ -1309,7 +1414,8 @@ def _cmd_metrics(args):
     cnarrs = map(read_cna, args.cnarrays)
     if args.segments:
         args.segments = map(read_cna, args.segments)
-    table = metrics.do_metrics(cnarrs, args.segments, args.drop_low_coverage)
+    table = metrics.do_metrics(cnarrs, args.segments, args.drop_low_coverage,
+                               args.processes)
     write_dataframe(args.output, table)
 
 
@@ -1326,6 +1432,11 @@ P_metrics.add_argument("--drop-low-coverage", action='store_true',
         help="""Drop very-low-coverage bins before calculations to reduce
                 negative "fat tail" of bin log2 values in poor-quality
                 tumor samples.""")
+P_metrics.add_argument('-p', '--processes',
+        nargs='?', type=int, const=0, default=1,
+        help="""Number of subprocesses to score samples in parallel. Without an
+                argument, use the maximum number of available CPUs.
+                [Default: use 1 process]""")
 P_metrics.add_argument('-o', '--output', metavar="FILENAME",
         help="Output table file name.")
 P_metrics.set_defaults(func=_cmd_metrics)
@@ -1333,10 +1444,11 @@ P_metrics.set_defaults(func=_cmd_metrics)
 
 # segmetrics ------------------------------------------------------------------
 
-do_segmetrics = public(segmetrics.do_segmetrics)
+public("segmetrics", "do_segmetrics")
 
 def _cmd_segmetrics(args):
     """Compute segment-level metrics from bin-level log2 ratios."""
+    from . import segmetrics
     if not 0.0 < args.alpha <= 1.0:
         raise RuntimeError("alpha must be between 0 and 1.")
 
@@ -1347,10 +1459,12 @@ def _cmd_segmetrics(args):
     # Calculate all metrics
     cnarr = read_cna(args.cnarray)
     segarr = read_cna(args.segments)
-    segarr = do_segmetrics(cnarr, segarr, args.location_stats,
-                           args.spread_stats, args.interval_stats,
-                           args.alpha, args.bootstrap, args.smooth_bootstrap,
-                           skip_low=args.drop_low_coverage)
+    segarr = segmetrics.do_segmetrics(cnarr, segarr, args.location_stats,
+                                      args.spread_stats, args.interval_stats,
+                                      args.alpha, args.bootstrap,
+                                      args.smooth_bootstrap,
+                                      skip_low=args.drop_low_coverage,
+                                      processes=args.processes)
     tabio.write(segarr, args.output or segarr.sample_id + ".segmetrics.cns")
 
 
@@ -1364,6 +1478,11 @@ P_segmetrics.add_argument("--drop-low-coverage", action='store_true',
                 negative bias in poor-quality tumor samples.""")
 P_segmetrics.add_argument('-o', '--output', metavar="FILENAME",
         help="Output table file name.")
+P_segmetrics.add_argument('-p', '--processes',
+        nargs='?', type=int, const=0, default=1,
+        help="""Number of subprocesses to bootstrap confidence intervals in
+                parallel. Give 0 or a negative value to use the maximum number
+                of available CPUs. [Default: use 1 process]""")
 
 P_segmetrics_stats = P_segmetrics.add_argument_group(
     "Statistics available")
@@ -1427,13 +1546,14 @@ P_segmetrics.set_defaults(func=_cmd_segmetrics)
 
 # bintest -----------------------------------------------------------------------
 
-do_bintest = public(bintest.do_bintest)
+public("bintest", "do_bintest")
 
 def _cmd_bintest(args):
     """Test for single-bin copy number alterations."""
+    from . import bintest
     cnarr = read_cna(args.cnarray)
     segments = read_cna(args.segment) if args.segment else None
-    sig = do_bintest(cnarr, segments, args.alpha, args.target)
+    sig = bintest.do_bintest(cnarr, segments, args.alpha, args.target)
     tabio.write(sig, args.output or sys.stdout)
 
 
@@ -1466,6 +1586,7 @@ def _cmd_import_picard(args):
     If 'antitarget' is in the input filename, the generated output filename will
     have the suffix '.antitargetcoverage.cnn', otherwise '.targetcoverage.cnn'.
     """
+    from . import importers
     for fname in args.targets:
         if not os.path.isfile(fname):
             # Legacy usage: previously accepted directory as an argument
@@ -1532,7 +1653,7 @@ P_import_seg.set_defaults(func=_cmd_import_seg)
 
 # import-theta ---------------------------------------------------------------
 
-do_import_theta = public(importers.do_import_theta)
+public("importers", "do_import_theta")
 
 
 def _cmd_import_theta(args):
@@ -1541,9 +1662,11 @@ def _cmd_import_theta(args):
     Equivalently, use the THetA results file to convert CNVkit .cns segments to
     integer copy number calls.
     """
+    from . import importers
     tumor_segs = read_cna(args.tumor_cns)
-    for i, new_cns in enumerate(do_import_theta(tumor_segs, args.theta_results,
-                                                args.ploidy)):
+    for i, new_cns in enumerate(importers.do_import_theta(tumor_segs,
+                                                          args.theta_results,
+                                                          args.ploidy)):
         tabio.write(new_cns,
                     os.path.join(args.output_dir,
                                  "%s-%d.cns" % (tumor_segs.sample_id, i + 1)))
@@ -1563,10 +1686,11 @@ P_import_theta.set_defaults(func=_cmd_import_theta)
 
 # import-rna ------------------------------------------------------------------
 
-do_import_rna = public(import_rna.do_import_rna)
+public("import_rna", "do_import_rna")
 
 def _cmd_import_rna(args):
     """Convert a cohort of per-gene log2 ratios to CNVkit .cnr format."""
+    from . import import_rna
     all_data, cnrs = import_rna.do_import_rna(
         args.gene_counts, args.format, args.gene_resource, args.correlations,
         args.normal, args.do_gc, args.do_txlen, args.max_log2)
@@ -1639,6 +1763,7 @@ def _cmd_export_bed(args):
     Input is a segmentation file (.cns) where, preferably, log2 ratios have
     already been adjusted to integer absolute values using the 'call' command.
     """
+    from . import export
     bed_tables = []
     for segfname in args.segments:
         segments = read_cna(segfname)
@@ -1700,8 +1825,10 @@ def _cmd_export_seg(args):
 
     Compatible with IGV and GenePattern.
     """
-    table = export.export_seg(args.filenames, chrom_ids=args.enumerate_chroms)
-    write_dataframe(args.output, table)
+    from . import export
+    tables = export.iter_seg(args.filenames, args.enumerate_chroms,
+                             args.processes)
+    write_dataframes(args.output, tables)
 
 P_export_seg = P_export_subparsers.add_parser('seg',
         help=_cmd_export_seg.__doc__)
@@ -1710,36 +1837,55 @@ P_export_seg.add_argument('filenames', nargs='+',
                 'segment' sub-command.""")
 P_export_seg.add_argument('--enumerate-chroms', action='store_true',
         help="""Replace chromosome names with sequential integer IDs.""")
+P_export_seg.add_argument('-p', '--processes',
+        nargs='?', type=int, const=0, default=1,
+        help="""Number of subprocesses to read input files in parallel.
+                Without an argument, use the maximum number of available CPUs.
+                [Default: use 1 process]""")
 P_export_seg.add_argument('-o', '--output', metavar="FILENAME",
         help="Output file name.")
 P_export_seg.set_defaults(func=_cmd_export_seg)
 
 
-# VCF special case: only 1 sample, for now
+# VCF special case: only 1 sample per file, for now
 def _cmd_export_vcf(args):
     """Convert segments to VCF format.
 
     Input is a segmentation file (.cns) where, preferably, log2 ratios have
     already been adjusted to integer absolute values using the 'call' command.
+    Given several segmentation files, each sample is written to its own VCF
+    file in the output directory.
     """
-    segarr = read_cna(args.segments)
-    cnarr = read_cna(args.cnr) if args.cnr else None
-    is_sample_female = verify_sample_sex(segarr, args.sample_sex,
-                                         args.male_reference)
-    header, body = export.export_vcf(segarr, args.ploidy, args.male_reference,
-                                     is_sample_female, args.sample_id, cnarr)
-    write_text(args.output, header, body)
+    from . import export
+    if args.cnr and len(args.cnr) != len(args.segments):
+        raise ValueError("Option --cnr must be given once per segments file")
+    if len(args.segments) == 1:
+        out_fnames = [args.output]
+    elif args.output or args.sample_id:
+        raise ValueError("Options -o/--output and -i/--sample-id only apply "
+                         "to a single segments file; use -d/--output-dir")
+    else:
+        if not os.path.isdir(args.output_dir):
+            os.mkdir(args.output_dir)
+            logging.info("Created directory %s", args.output_dir)
+        out_fnames = [os.path.join(args.output_dir, core.fbase(fname) + '.vcf')
+                      for fname in args.segments]
+    export.export_vcfs(args.segments, args.cnr, out_fnames, args.ploidy,
+                       args.male_reference, args.sample_sex, args.sample_id,
+                       args.processes)
 
 P_export_vcf = P_export_subparsers.add_parser('vcf',
         help=_cmd_export_vcf.__doc__)
-P_export_vcf.add_argument('segments', #nargs='1',
-        help="""Segmented copy ratio data file (*.cns), the output of the
+P_export_vcf.add_argument('segments', nargs='+',
+        help="""Segmented copy ratio data file(s) (*.cns), the output of the
                 'segment' or 'call' sub-commands.""")
 # ENH?: Incorporate left/right CI into .cns via 'segment' or 'segmetrics',
 #   potentially calculated another way besides adjacent bin boundaries
-P_export_vcf.add_argument("--cnr",
-        help="""Bin-level copy ratios (*.cnr). Used to indicate fuzzy boundaries
-                for segments in the output VCF via the CIPOS and CIEND tags.""")
+P_export_vcf.add_argument("--cnr", action='append',
+        help="""Bin-level copy ratios (*.cnr). Used to indicate fuzzy
+                boundaries for segments in the output VCF via the CIPOS and
+                CIEND tags. With several segments files, give this option once
+                per segments file, in the same order.""")
 P_export_vcf.add_argument("-i", "--sample-id", metavar="LABEL",
         help="""Sample name to write in the genotype field of the output VCF file.
                 [Default: use the sample ID, taken from the file name]""")
@@ -1756,14 +1902,23 @@ P_export_vcf.add_argument('-y', '--male-reference', '--haploid-x-reference',
                 chrX and chrY; otherwise, only chrY has half ploidy.  In CNVkit,
                 if a male reference was used, the "neutral" copy number (ploidy)
                 of chrX is 1; chrY is haploid for either reference sex.""")
+P_export_vcf.add_argument('-p', '--processes',
+        nargs='?', type=int, const=0, default=1,
+        help="""Number of subprocesses to convert samples in parallel.
+                Without an argument, use the maximum number of available CPUs.
+                [Default: use 1 process]""")
 P_export_vcf.add_argument('-o', '--output', metavar="FILENAME",
-        help="Output file name.")
+        help="Output file name (for a single segments file).")
+P_export_vcf.add_argument('-d', '--output-dir', default='.',
+        help="""Output directory for the VCF files of multiple samples, each
+                named by sample ID. [Default: %(default)s]""")
 P_export_vcf.set_defaults(func=_cmd_export_vcf)
 
 
 # THetA special case: takes tumor .cns and normal .cnr or reference.cnn
 def _cmd_export_theta(args):
     """Convert segments to THetA2 input file format (*.input)."""
+    from . import export
     tumor_cn = read_cna(args.tumor_segment)
     normal_cn = read_cna(args.reference) if args.reference else None
     table = export.export_theta(tumor_cn, normal_cn)
@@ -1825,6 +1980,7 @@ P_export_theta.set_defaults(func=_cmd_export_theta)
 # Nexus "basic" special case: can only represent 1 sample
 def _cmd_export_nb(args):
     """Convert bin-level log2 ratios to Nexus Copy Number "basic" format."""
+    from . import export
     cnarr = read_cna(args.filename)
     table = export.export_nexus_basic(cnarr)
     write_dataframe(args.output, table)
@@ -1842,6 +1998,7 @@ P_export_nb.set_defaults(func=_cmd_export_nb)
 # Nexus "Custom-OGT" special case: can only represent 1 sample
 def _cmd_export_nbo(args):
     """Convert log2 ratios and b-allele freqs to Nexus "Custom-OGT" format."""
+    from . import export
     cnarr = read_cna(args.filename)
     varr = load_het_snps(args.vcf, args.sample_id, args.normal_id,
                          args.min_variant_depth, args.zygosity_freq)
@@ -1881,8 +2038,9 @@ P_export_nbo.set_defaults(func=_cmd_export_nbo)
 
 def _cmd_export_cdt(args):
     """Convert log2 ratios to CDT format. Compatible with Java TreeView."""
+    from . import export
     sample_ids = list(map(core.fbase, args.filenames))
-    table = export.merge_samples(args.filenames)
+    table = export.iter_merged_samples(args.filenames, args.processes)
     formatter = export.EXPORT_FORMATS['cdt']
     outheader, outrows = formatter(sample_ids, table)
     write_tsv(args.output, outrows, colnames=outheader)
@@ -1892,14 +2050,20 @@ P_export_cdt = P_export_subparsers.add_parser('cdt',
 P_export_cdt.add_argument('filenames', nargs='+',
         help="""Log2 copy ratio data file(s) (*.cnr), the output of the
                 'fix' sub-command.""")
+P_export_cdt.add_argument('-p', '--processes',
+        nargs='?', type=int, const=0, default=1,
+        help="""Number of subprocesses to read input files in parallel.
+                Without an argument, use the maximum number of available CPUs.
+                [Default: use 1 process]""")
 P_export_cdt.add_argument('-o', '--output', metavar="FILENAME",
         help="Output file name.")
 P_export_cdt.set_defaults(func=_cmd_export_cdt)
 
 def _cmd_export_jtv(args):
     """Convert log2 ratios to Java TreeView's native format."""
+    from . import export
     sample_ids = list(map(core.fbase, args.filenames))
-    table = export.merge_samples(args.filenames)
+    table = export.iter_merged_samples(args.filenames, args.processes)
     formatter = export.EXPORT_FORMATS['jtv']
     outheader, outrows = formatter(sample_ids, table)
     write_tsv(args.output, outrows, colnames=outheader)
@@ -1909,25 +2073,61 @@ P_export_jtv = P_export_subparsers.add_parser('jtv',
 P_export_jtv.add_argument('filenames', nargs='+',
         help="""Log2 copy ratio data file(s) (*.cnr), the output of the
                 'fix' sub-command.""")
+P_export_jtv.add_argument('-p', '--processes',
+        nargs='?', type=int, const=0, default=1,
+        help="""Number of subprocesses to read input files in parallel.
+                Without an argument, use the maximum number of available CPUs.
+                [Default: use 1 process]""")
 P_export_jtv.add_argument('-o', '--output', metavar="FILENAME",
         help="Output file name.")
 P_export_jtv.set_defaults(func=_cmd_export_jtv)
 
 def _cmd_export_gistic(args):
+    """Convert bins to a GISTIC 2.0 markers file."""
+    from . import export
     formatter = export.EXPORT_FORMATS['gistic']
-    outdf = formatter(args.filenames)
+    outdf = formatter(args.filenames, args.processes)
     write_dataframe(args.output, outdf)
-    
+
 P_export_gistic = P_export_subparsers.add_parser('gistic',
                                               help=_cmd_export_gistic.__doc__)
 P_export_gistic.add_argument('filenames', nargs='+',
         help="""Log2 copy ratio data file(s) (*.cnr), the output of the
                 'fix' sub-command.""")
+P_export_gistic.add_argument('-p', '--processes',
+        nargs='?', type=int, const=0, default=1,
+        help="""Number of subprocesses to read input files in parallel.
+                Without an argument, use the maximum number of available CPUs.
+                [Default: use 1 process]""")
 P_export_gistic.add_argument('-o', '--output', metavar="FILENAME",
         help="Output file name.")
 P_export_gistic.set_defaults(func=_cmd_export_gistic)
 
 
+# serve -----------------------------------------------------------------------
+
+public("serve", "do_serve")
+
+
+def _cmd_serve(args):
+    """Run commands sent over a local socket, reusing already-read files.
+
+    Start a server, then set the environment variable CNVKIT_SERVER to its
+    socket path to have 'cnvkit.py' run each command on it instead of starting
+    afresh. Commands run one at a time, in the server's process.
+    """
+    from . import serve
+    serve.do_serve(args.socket, args.cache_size)
+
+P_serve = AP_subparsers.add_parser('serve', help=_cmd_serve.__doc__)
+P_serve.add_argument('socket',
+        help="Path of the Unix socket to listen on.")
+P_serve.add_argument('--cache-size', type=int, default=32,
+        help="""Number of parsed input files (e.g. references, BED files) to
+                keep for reuse by later commands. [Default: %(default)d]""")
+P_serve.set_defaults(func=_cmd_serve)
+
+
 # version ---------------------------------------------------------------------
 
 def print_version(_args):
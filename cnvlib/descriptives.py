@@ -6,10 +6,10 @@ See:
 
 """
 import sys
+import warnings
 from functools import wraps
 
 import numpy as np
-from scipy import stats
 
 
 # Decorators to coerce input and short-circuit trivial cases
@@ -103,6 +103,112 @@ def biweight_location(a, initial=None, c=6.0, epsilon=1e-3, max_iter=5):
     return result
 
 
+def biweight_location_cols(a, initial=None, c=6.0, epsilon=1e-3, max_iter=5):
+    """Compute the biweight location of each column of a 2-D array.
+
+    Equivalent to applying `biweight_location` to each column, including
+    skipping NaN values, but iterating over the whole matrix at once.
+    """
+    a = np.asfarray(a)
+    is_nan = np.isnan(a)
+    n_valid = (~is_nan).sum(axis=0)
+    if initial is None:
+        initial = _nanmedian_cols(a, n_valid)
+    result = np.array(np.broadcast_to(initial, a.shape[1:]), dtype=np.float_)
+    # Trivial columns: no values, or just one
+    result[n_valid == 0] = np.nan
+    is_single = (n_valid == 1)
+    if is_single.any():
+        result[is_single] = np.nanmax(a[:, is_single], axis=0)
+    initial = result.copy()
+    # Columns still iterating
+    active = np.flatnonzero(n_valid > 1)
+    for _i in range(max_iter):
+        if not len(active):
+            break
+        sub = a[:, active]
+        d = sub - initial[active]
+        mad = _nanmedian_cols(np.abs(d), n_valid[active])
+        w = d / np.maximum(c * mad, epsilon)
+        w = (1 - w**2)**2
+        # Omit the outlier points (and missing values)
+        mask = (w < 1)
+        w = np.where(mask, w, 0.)
+        weightsum = w.sum(axis=0)
+        # With insufficient variation, keep the initial estimate
+        with np.errstate(invalid='ignore', divide='ignore'):
+            step = np.where(weightsum == 0, 0.,
+                            np.where(mask, d * w, 0.).sum(axis=0) / weightsum)
+        result[active] = initial[active] + step
+        converged = (np.abs(step) <= epsilon)
+        initial[active] = result[active]
+        active = active[~converged]
+    return result
+
+
+def biweight_midvariance_cols(a, initial=None, c=9.0, epsilon=1e-3):
+    """Compute the biweight midvariance of each column of a 2-D array.
+
+    Equivalent to applying `biweight_midvariance` to each column, including
+    skipping NaN values, but operating on the whole matrix at once.
+    """
+    a = np.asfarray(a)
+    n_valid = (~np.isnan(a)).sum(axis=0)
+    if initial is None:
+        initial = biweight_location_cols(a)
+    # Difference of observations from initial location estimate
+    d = a - initial
+    # Weighting (avoid dividing by zero)
+    mad = _nanmedian_cols(np.abs(d), n_valid)
+    w = d / np.maximum(c * mad, epsilon)
+    # Omit the outlier points (and missing values)
+    mask = np.abs(w) < 1
+    n = mask.sum(axis=0)
+    d_ = np.where(mask, d, 0.)
+    w_ = np.where(mask, w**2, 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = np.sqrt((n * (d_**2 * (1 - w_)**4).sum(axis=0))
+                         / (np.where(mask, (1 - w_) * (1 - 5 * w_), 0.)
+                            .sum(axis=0)**2))
+    # Insufficient variation to improve on MAD
+    no_var = (np.where(mask, w, 0.).sum(axis=0) == 0)
+    result[no_var] = mad[no_var] * 1.4826
+    result[n_valid == 1] = 0
+    result[n_valid == 0] = np.nan
+    return result
+
+
+def _nanmedian_cols(a, n_valid):
+    """Median of each column, skipping NaNs; faster than np.nanmedian."""
+    if (n_valid == len(a)).all():
+        return np.median(a, axis=0)
+    with warnings.catch_warnings():
+        # All-NaN columns are OK; their median is NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(a, axis=0)
+
+
+def apply_runs_cols(func_cols, a, starts, ends):
+    """Apply a column-wise estimator to each run ``a[start:end]`` of an array.
+
+    The runs are padded with NaN into the columns of 2-D arrays, grouped by
+    length (to within a factor of 2) so that short runs aren't padded out to
+    the length of the longest one. Hence `func_cols` must skip NaN values, as
+    `biweight_location_cols` does.
+    """
+    a = np.asfarray(a)
+    sizes = ends - starts
+    result = np.empty(len(sizes))
+    size_class = np.ceil(np.log2(np.maximum(sizes, 1))).astype(np.int_)
+    for cls in np.unique(size_class):
+        in_class = np.flatnonzero(size_class == cls)
+        idx = starts[in_class] + np.arange(sizes[in_class].max())[:, None]
+        in_run = (idx < ends[in_class])
+        cols = np.where(in_run, a[np.where(in_run, idx, 0)], np.nan)
+        result[in_class] = func_cols(cols)
+    return result
+
+
 @on_array()
 def modal_location(a):
     """Return the modal value of an array's values.
@@ -115,8 +221,9 @@ def modal_location(a):
     a : np.array
         A 1-D array of floating-point values, e.g. bin log2 ratio values.
     """
+    from scipy.stats import gaussian_kde
     sarr = np.sort(a)
-    kde = stats.gaussian_kde(sarr)
+    kde = gaussian_kde(sarr)
     y = kde.evaluate(sarr)
     peak = sarr[y.argmax()]
     return peak
@@ -125,7 +232,8 @@ def modal_location(a):
 @on_weighted_array()
 def weighted_median(a, weights):
     """Weighted median of a 1-D numeric array."""
-    order = a.argsort()
+    # Stable sort, so tied values keep their order on every platform
+    order = a.argsort(kind='mergesort')
     a = a[order]
     weights = weights[order]
     midpoint = 0.5 * weights.sum()
@@ -193,7 +301,8 @@ def gapper_scale(a):
 @on_array(0)
 def interquartile_range(a):
     """Compute the difference between the array's first and third quartiles."""
-    return np.percentile(a, 75) - np.percentile(a, 25)
+    q1, q3 = np.percentile(a, [25, 75])
+    return q3 - q1
 
 
 @on_array(0)
@@ -267,14 +376,23 @@ def q_n(a):
 
     """
     # First quartile of: (|x_i - x_j|: i < j)
-    vals = []
-    for i, x_i in enumerate(a):
-        for x_j in a[i+1:]:
-            vals.append(abs(x_i - x_j))
-    quartile = np.percentile(vals, 25)
+    n = len(a)
+    if n <= 100:
+        i_upper, j_upper = np.triu_indices(n, 1)
+        quartile = np.percentile(np.abs(a[i_upper] - a[j_upper]), 25)
+    else:
+        # Select the bracketing order statistics in O(n log n), then
+        # interpolate between them as np.percentile does
+        a = np.sort(a)
+        position = .25 * (n * (n - 1) // 2 - 1)
+        k_lo = int(np.floor(position))
+        k_hi = int(np.ceil(position))
+        quartile = _kth_pairwise_diff(a, k_lo)
+        if k_hi > k_lo:
+            quartile += ((position - k_lo)
+                         * (_kth_pairwise_diff(a, k_hi) - quartile))
 
     # Cn: a scaling factor determined by sample size
-    n = len(a)
     if n <= 10:
         # ENH: warn when extrapolating beyond the data
         # ENH: simulate for values up to 10
@@ -289,3 +407,79 @@ def q_n(a):
         scale = 1.0
 
     return quartile / scale
+
+
+def _kth_pairwise_diff(y, k):
+    """Select the k-th smallest (from 0) of all pairwise differences in `y`.
+
+    Uses the selection algorithm of Croux & Rousseeuw (1992) for Q_n, taking
+    O(n log n) time instead of enumerating all n(n-1)/2 differences.
+
+    Viewing the differences ``y[j] - y[i], j > i`` of the sorted array `y` as
+    a matrix whose rows and columns are both increasing, keep a range of
+    candidate columns in each row. Each round, take the weighted median of the
+    rows' middle candidates as a trial value, count the differences below it
+    in each row by binary search, and discard the candidates on the side of
+    the trial value that cannot contain the k-th difference.
+    """
+    n = len(y)
+    rows = np.arange(n)
+    # Candidate columns in each row, inclusive
+    left = rows + 1
+    right = np.repeat(n - 1, n)
+    while True:
+        n_candidates = np.maximum(right - left + 1, 0)
+        n_left = n_candidates.sum()
+        if n_left <= n:
+            # Few enough to select among the remaining candidates directly
+            row_idx = np.repeat(rows, n_candidates)
+            row_starts = np.cumsum(n_candidates) - n_candidates
+            col_idx = (np.arange(n_left) - row_starts[row_idx]
+                       + left[row_idx])
+            k_left = k - (left - rows - 1).sum()
+            return np.partition(y[col_idx] - y[row_idx], k_left)[k_left]
+        active = np.flatnonzero(n_candidates)
+        mid_vals = y[(left[active] + right[active]) // 2] - y[active]
+        trial = _weighted_median_unsorted(mid_vals, n_candidates[active])
+        # Number of differences in each row less than / up to the trial value
+        n_less = _count_diffs_below(y, trial, 'left') - rows - 1
+        n_upto = _count_diffs_below(y, trial, 'right') - rows - 1
+        n_less_total = n_less.sum()
+        if n_less_total <= k < n_upto.sum():
+            return trial
+        if k < n_less_total:
+            right = np.minimum(right, rows + n_less)
+        else:
+            left = np.maximum(left, rows + n_upto + 1)
+
+
+def _count_diffs_below(y, value, side):
+    """Column offsets in each row of sorted `y` where ``y[j] - y[i]`` reaches
+    `value`.
+
+    With `side` 'left', count differences strictly less than `value`; with
+    'right', less than or equal to `value`. Offsets are absolute indices into
+    `y`, i.e. the count plus the row index plus 1.
+    """
+    n = len(y)
+    rows = np.arange(n)
+    pos = np.maximum(np.searchsorted(y, y + value, side), rows + 1)
+    # Rounding in y[i] + value can differ from y[j] - y[i]; nudge the
+    # boundaries to agree with the differences themselves
+    in_set = ((lambda d: d < value) if side == 'left'
+              else (lambda d: d <= value))
+    while True:
+        back = (pos > rows + 1)
+        back[back] = ~in_set(y[pos[back] - 1] - y[rows[back]])
+        fwd = (pos < n)
+        fwd[fwd] = in_set(y[pos[fwd]] - y[rows[fwd]])
+        if not (back.any() or fwd.any()):
+            return pos
+        pos = pos - back + fwd
+
+
+def _weighted_median_unsorted(a, weights):
+    """Lower weighted median, for selection rather than estimation."""
+    order = np.argsort(a, kind='mergesort')
+    cum_weights = np.cumsum(weights[order])
+    return a[order[np.searchsorted(cum_weights, .5 * cum_weights[-1])]]
@@ -109,11 +109,13 @@ def _get_gene_labels(cnarr, segarr, cnarr_is_seg, threshold, min_probes):
         probes_attr = 'probes'
     elif segarr:
         # Both segments and bin-level ratios
-        rows = reports.gene_metrics_by_segment(cnarr, segarr, threshold)
+        table = reports.gene_metrics_by_segment(cnarr, segarr, threshold)
+        rows = table.itertuples(index=False)
         probes_attr = 'segment_probes'
     else:
         # Only bin-level ratios (.cnr)
-        rows = reports.gene_metrics_by_gene(cnarr, threshold)
+        table = reports.gene_metrics_by_gene(cnarr, threshold)
+        rows = table.itertuples(index=False)
         probes_attr = 'probes'
     return [row.gene for row in rows if getattr(row, probes_attr) >= min_probes]
 
@@ -1,5 +1,8 @@
 """Export CNVkit objects and files to other formats."""
+import hashlib
+import itertools
 import logging
+import tempfile
 import time
 from collections import OrderedDict as OD
 
@@ -7,41 +10,118 @@ import numpy as np
 import pandas as pd
 from skgenome import tabio
 
-from . import call
-from .cmdutil import read_cna
+from . import call, parallel
+from .cmdutil import read_cna, verify_sample_sex, write_text
 from ._version import __version__
 
+# Max. size (samples x bins) of a merged log2 table to keep in memory; larger
+# cohorts are memory-mapped from a temporary file
+MAX_IN_MEMORY_CELLS = 5 * 10**7
+# Number of bins to format and write out at a time
+EXPORT_BLOCK_SIZE = 10000
 
-def merge_samples(filenames):
+
+def merge_samples(filenames, processes=1):
     """Merge probe values from multiple samples into a 2D table (of sorts).
 
     Input:
-        dict of {sample ID: (probes, values)}
+        list of .cnr or .cns filenames, all with the same bins
     Output:
-        list-of-tuples: (probe, log2 coverages...)
+        pandas.DataFrame: bin coordinates, gene and label, then the log2 values
+        of each sample as a column named by sample ID.
     """
-    def label_with_gene(cnarr):
-        row2label = lambda row: "{}:{}-{}:{}".format(
-            row.chromosome, row.start, row.end, row.gene)
-        return cnarr.data.apply(row2label, axis=1)
-
     if not filenames:
         return []
+    return pd.concat(iter_merged_samples(filenames, processes))
+
+
+def iter_merged_samples(filenames, processes=1, block_size=None):
+    """Merge samples' probe values, as in `merge_samples`, in blocks of bins.
+
+    Files are read in parallel if `processes` is not 1. Each sample's log2
+    values are stored as one row of a samples-by-bins matrix, which is kept on
+    disk if it's larger than `MAX_IN_MEMORY_CELLS`. All files are read and
+    checked here, so any error is raised before the output is written.
+
+    Returns
+    -------
+    generator
+        The merged table, as tables of `block_size` consecutive bins (by
+        default, `EXPORT_BLOCK_SIZE`) with the index of the whole table.
+    """
+    if block_size is None:
+        block_size = EXPORT_BLOCK_SIZE
     first_cnarr = read_cna(filenames[0])
-    out_table = first_cnarr.data.reindex(columns=["chromosome", "start", "end", "gene"])
-    out_table["label"] = label_with_gene(first_cnarr)
-    out_table[first_cnarr.sample_id] = first_cnarr["log2"]
-    for fname in filenames[1:]:
-        cnarr = read_cna(fname)
-        if not (len(cnarr) == len(out_table)
-                and (label_with_gene(cnarr) == out_table["label"]).all()):
-            raise ValueError("Mismatched row coordinates in %s" % fname)
-        # Copy the next column by sample ID
-        if cnarr.sample_id in out_table.columns:
-            raise ValueError("Duplicate sample ID: %s" % cnarr.sample_id)
-        out_table[cnarr.sample_id] = cnarr["log2"]
-        del cnarr
-    return out_table
+    bins = first_cnarr.data.reindex(columns=["chromosome", "start", "end",
+                                             "gene"]).reset_index(drop=True)
+    bins["label"] = (bins["chromosome"].astype(str)
+                     + ":" + bins["start"].astype(str)
+                     + "-" + bins["end"].astype(str)
+                     + ":" + bins["gene"].astype(str))
+    digest = _bins_digest(first_cnarr, _MERGE_COLUMNS)
+    del first_cnarr
+    log2s = _log2_matrix(len(filenames), len(bins))
+    sample_ids = []
+    with parallel.pick_pool(processes) as pool:
+        for i, (fname, result) in enumerate(zip(filenames,
+                                                pool.map(_read_log2,
+                                                         filenames))):
+            sample_id, sample_digest, log2 = result
+            if sample_digest != digest:
+                raise ValueError("Mismatched row coordinates in %s" % fname)
+            if sample_id in sample_ids:
+                raise ValueError("Duplicate sample ID: %s" % sample_id)
+            sample_ids.append(sample_id)
+            log2s[i] = log2
+    return _iter_blocks(bins, log2s, sample_ids, block_size)
+
+
+def _iter_blocks(bins, log2s, sample_ids, block_size):
+    """Yield blocks of the merged table, for `iter_merged_samples`."""
+    for start in range(0, max(len(bins), 1), block_size):
+        block = bins.iloc[start:start + block_size]
+        values = pd.DataFrame(log2s[:, start:start + block_size].T,
+                              index=block.index, columns=sample_ids)
+        yield pd.concat([block, values], axis=1)
+
+
+# Columns that must match between samples' bins for `merge_samples`
+_MERGE_COLUMNS = ("chromosome", "start", "end", "gene")
+
+
+def _read_log2(fname):
+    """Read a sample's ID, bin digest and log2 values, for `merge_samples`."""
+    cnarr = read_cna(fname)
+    return (cnarr.sample_id, _bins_digest(cnarr, _MERGE_COLUMNS),
+            cnarr["log2"].values)
+
+
+def _read_bins_digest(fname):
+    """Read a sample's digest of bin coordinates, for GISTIC markers."""
+    return _bins_digest(read_cna(fname), ("chromosome", "start", "end"))
+
+
+def _bins_digest(cnarr, columns):
+    """Fingerprint of the given columns of an array's bins, to compare samples.
+
+    Rows are hashed in a vectorized way, then the row hashes are combined, so
+    that samples' bins can be compared without sending them between processes.
+    """
+    row_hashes = pd.util.hash_pandas_object(
+        cnarr.data.reindex(columns=list(columns)), index=False)
+    return (len(cnarr),
+            hashlib.sha1(row_hashes.values.tobytes()).hexdigest())
+
+
+def _log2_matrix(n_samples, n_bins):
+    """Allocate a samples-by-bins matrix, on disk if it's too big for memory.
+
+    The backing temporary file is deleted once the array is released.
+    """
+    if n_samples * n_bins <= MAX_IN_MEMORY_CELLS:
+        return np.zeros((n_samples, n_bins))
+    return np.memmap(tempfile.TemporaryFile(prefix="cnvkit-export."),
+                     dtype=np.float_, mode='w+', shape=(n_samples, n_bins))
 
 
 # Supported formats:
@@ -49,6 +129,9 @@ def merge_samples(filenames):
 def fmt_cdt(sample_ids, table):
     """Format as CDT.
 
+    `table` is the output of `merge_samples`, or an iterable of blocks of it
+    from `iter_merged_samples`.
+
     See:
 
     - http://jtreeview.sourceforge.net/docs/JTVUserManual/ch02s11.html
@@ -59,18 +142,24 @@ def fmt_cdt(sample_ids, table):
     header2.extend(['ARRY' + str(i).zfill(3) + 'X'
                     for i in range(len(sample_ids))])
     header3 = ['EWEIGHT', '', '', ''] + ['1'] * len(sample_ids)
-    outrows = [header2, header3]
-    outtable = pd.concat([
-        pd.DataFrame.from_dict(OD([
-           ("GID", pd.Series(table.index).apply(lambda x: "GENE%dX" % x)),
-           ("CLID", pd.Series(table.index).apply(lambda x: "IMAGE:%d" % x)),
-           ("NAME", table["label"]),
-           ("GWEIGHT", 1),
-        ])),
-        table.drop(["chromosome", "start", "end", "gene", "label"],
-                   axis=1)],
-        axis=1)
-    outrows.extend(outtable.itertuples(index=False))
+
+    def format_block(block):
+        index = pd.Series(block.index.astype(str), index=block.index)
+        outtable = pd.concat([
+            pd.DataFrame.from_dict(OD([
+               ("GID", "GENE" + index + "X"),
+               ("CLID", "IMAGE:" + index),
+               ("NAME", block["label"]),
+               ("GWEIGHT", 1),
+            ])),
+            block.drop(["chromosome", "start", "end", "gene", "label"],
+                       axis=1)],
+            axis=1)
+        return outtable.itertuples(index=False)
+
+    outrows = itertools.chain([header2, header3],
+                              itertools.chain.from_iterable(
+                                  map(format_block, _table_blocks(table))))
     return outheader, outrows
 
 
@@ -80,20 +169,35 @@ def fmt_gct(sample_ids, table):
 
 
 def fmt_jtv(sample_ids, table):
-    """Format for Java TreeView."""
+    """Format for Java TreeView.
+
+    `table` is as for `fmt_cdt`.
+    """
     outheader = ["CloneID", "Name"] + sample_ids
-    outtable = pd.concat([
-        pd.DataFrame({
-            "CloneID": "IMAGE:",
-            "Name": table["label"],
-        }),
-        table.drop(["chromosome", "start", "end", "gene", "label"],
-                   axis=1)],
-        axis=1)
-    outrows = outtable.itertuples(index=False)
+
+    def format_block(block):
+        outtable = pd.concat([
+            pd.DataFrame({
+                "CloneID": "IMAGE:",
+                "Name": block["label"],
+            }),
+            block.drop(["chromosome", "start", "end", "gene", "label"],
+                       axis=1)],
+            axis=1)
+        return outtable.itertuples(index=False)
+
+    outrows = itertools.chain.from_iterable(map(format_block,
+                                                _table_blocks(table)))
     return outheader, outrows
 
 
+def _table_blocks(table):
+    """Blocks of a merged table, which may already be split into blocks."""
+    if isinstance(table, pd.DataFrame):
+        return [table]
+    return table
+
+
 # Special cases
 
 def export_nexus_basic(cnarr):
@@ -134,16 +238,39 @@ def export_nexus_ogt(cnarr, varr, min_weight=0.0):
     return out_table
 
 
-def export_seg(sample_fnames, chrom_ids=False):
+def export_seg(sample_fnames, chrom_ids=False, processes=1):
     """SEG format for copy number segments.
 
     Segment breakpoints are not the same across samples, so samples are listed
     in serial with the sample ID as the left column.
     """
-    dframes, sample_ids = zip(*(_load_seg_dframe_id(fname)
-                                for fname in sample_fnames))
-    out_table = tabio.seg.write_seg(dframes, sample_ids, chrom_ids)
-    return out_table
+    return pd.concat(iter_seg(sample_fnames, chrom_ids, processes))
+
+
+def iter_seg(sample_fnames, chrom_ids=False, processes=1):
+    """Format each sample's segments as SEG, in turn, as in `export_seg`.
+
+    Files are read in parallel if `processes` is not 1. All files are read
+    here, so any error is raised before the output is written; the returned
+    generator then formats one sample at a time.
+    """
+    with parallel.pick_pool(processes) as pool:
+        dframe_ids = list(pool.map(_load_seg_dframe_id, sample_fnames))
+    if chrom_ids in (None, True) and dframe_ids:
+        chrom_ids = tabio.seg.create_chrom_ids(dframe_ids[0][0])
+    return _iter_seg_tables(dframe_ids, chrom_ids)
+
+
+def _iter_seg_tables(dframe_ids, chrom_ids):
+    """Yield each sample's SEG table, with the first sample's columns."""
+    columns = None
+    for dframe, sample_id in dframe_ids:
+        table = tabio.seg.format_seg(dframe, sample_id, chrom_ids)
+        if columns is None:
+            columns = table.columns
+        else:
+            table = table.reindex(columns=columns)
+        yield table
 
 
 def _load_seg_dframe_id(fname):
@@ -214,6 +341,8 @@ VCF_HEADER = """\
 ##FORMAT=<ID=CN,Number=1,Type=Integer,Description="Copy number genotype for imprecise events">
 ##FORMAT=<ID=CNQ,Number=1,Type=Float,Description="Copy number genotype quality for imprecise events">
 """.format(date=time.strftime("%Y%m%d"), version=__version__)
+VCF_COLUMNS = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO",
+               "FORMAT"]
 # #CHROM  POS   ID  REF ALT   QUAL  FILTER  INFO  FORMAT  NA00001
 # 1 2827693   . CCGTGGATGCGGGGACCCGCATCCCCTCTCCCTTCACAGCTGAGTGACCCACATCCCCTCTCCCCTCGCA  C . PASS  SVTYPE=DEL;END=2827680;BKPTID=Pindel_LCS_D1099159;HOMLEN=1;HOMSEQ=C;SVLEN=-66 GT:GQ 1/1:13.9
 # 2 321682    . T <DEL>   6 PASS    IMPRECISE;SVTYPE=DEL;END=321887;SVLEN=-105;CIPOS=-56,20;CIEND=-10,62  GT:GQ 0/1:12
@@ -229,18 +358,49 @@ def export_vcf(segments, ploidy, is_reference_male, is_sample_female,
 
     Spec: https://samtools.github.io/hts-specs/VCFv4.2.pdf
     """
-    vcf_columns = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER",
-                   "INFO", "FORMAT", sample_id or segments.sample_id]
     if cnarr:
         segments = assign_ci_start_end(segments, cnarr)
-    vcf_rows = segments2vcf(segments, ploidy, is_reference_male,
-                            is_sample_female)
-    table = pd.DataFrame.from_records(vcf_rows, columns=vcf_columns)
+    table = segments2vcf(segments, ploidy, is_reference_male, is_sample_female)
+    table.columns = VCF_COLUMNS + [sample_id or segments.sample_id]
     vcf_body = table.to_csv(sep='\t', header=True, index=False,
                             float_format="%.3g")
     return VCF_HEADER, vcf_body
 
 
+def export_vcfs(segment_fnames, cnr_fnames, output_fnames, ploidy,
+                is_reference_male, sample_sex=None, sample_id=None,
+                processes=1):
+    """Convert each sample's segments to a VCF file of its own.
+
+    Samples are read, converted and written in parallel if `processes` is not
+    1. The lists `cnr_fnames` (or None) and `output_fnames` correspond to
+    `segment_fnames`; an output filename of None means standard output.
+    """
+    if cnr_fnames is None:
+        cnr_fnames = [None] * len(segment_fnames)
+    elif len(cnr_fnames) != len(segment_fnames):
+        raise ValueError("Got %d .cnr files for %d segment files"
+                         % (len(cnr_fnames), len(segment_fnames)))
+    with parallel.pick_pool(processes) as pool:
+        jobs = [pool.submit(_write_vcf, seg_fname, cnr_fname, out_fname,
+                            ploidy, is_reference_male, sample_sex, sample_id)
+                for seg_fname, cnr_fname, out_fname
+                in zip(segment_fnames, cnr_fnames, output_fnames)]
+        for job in jobs:
+            job.result()
+
+
+def _write_vcf(seg_fname, cnr_fname, out_fname, ploidy, is_reference_male,
+               sample_sex, sample_id):
+    """Convert one sample's segments (and bins) to a VCF file."""
+    segarr = read_cna(seg_fname)
+    cnarr = read_cna(cnr_fname) if cnr_fname else None
+    is_sample_female = verify_sample_sex(segarr, sample_sex, is_reference_male)
+    header, body = export_vcf(segarr, ploidy, is_reference_male,
+                              is_sample_female, sample_id, cnarr)
+    write_text(out_fname, header, body)
+
+
 def assign_ci_start_end(segarr, cnarr):
     """Assign ci_start and ci_end fields to segments.
 
@@ -262,88 +422,90 @@ def assign_ci_start_end(segarr, cnarr):
 
 
 def segments2vcf(segments, ploidy, is_reference_male, is_sample_female):
-    """Convert copy number segments to VCF records."""
-    out_dframe = segments.data.reindex(columns=["chromosome", "end", "log2", "probes"])
-    out_dframe["start"] = segments.start.replace(0, 1)
+    """Convert copy number segments to VCF records.
 
+    Returns
+    -------
+    pandas.DataFrame
+        One row per non-neutral segment, with the fixed VCF columns (see
+        `VCF_COLUMNS`) followed by the sample's genotype column.
+    """
     if "cn" in segments:
-        out_dframe["ncopies"] = segments["cn"]
+        ncopies = segments["cn"].values
         abs_expect = call.absolute_expect(segments, ploidy, is_sample_female)
     else:
         abs_dframe = call.absolute_dataframe(segments, ploidy, 1.0,
                                              is_reference_male,
                                              is_sample_female)
-        out_dframe["ncopies"] = abs_dframe["absolute"].round().astype('int')
-        abs_expect = abs_dframe["expect"]
-    idx_losses = (out_dframe["ncopies"] < abs_expect)
-
-    svlen = segments.end - segments.start
-    svlen[idx_losses] *= -1
-    out_dframe["svlen"] = svlen
-
-    out_dframe["svtype"] = "DUP"
-    out_dframe.loc[idx_losses, "svtype"] = "DEL"
-
-    out_dframe["format"] = "GT:GQ:CN:CNQ"
-    out_dframe.loc[idx_losses, "format"] = "GT:GQ" # :CN:CNQ ?
-
+        ncopies = abs_dframe["absolute"].round().values.astype('int')
+        abs_expect = abs_dframe["expect"].values
+    segs = segments.data.reindex(columns=["chromosome", "start", "end", "log2",
+                                          "probes"])
+    # Skip regions of neutral copy number (or "CNV" for subclonal?)
+    keep = ((ncopies != abs_expect) &
+            # Survive files from buggy v0.7.1 (#53)
+            segs["probes"].astype(str).str.isdigit().values)
+    segs = segs[keep]
+    ncopies = ncopies[keep]
+    is_loss = (ncopies < abs_expect[keep])
+    svtype = np.where(is_loss, "DEL", "DUP").astype(object)
+    end = _int_strs(segs["end"])
+    probes = _int_strs(segs["probes"])
+    svlen = segs["end"].values - segs["start"].values
+    svlen[is_loss] *= -1
+
+    info = ("IMPRECISE;SVTYPE=" + svtype
+            + ";END=" + end
+            + ";SVLEN=" + _int_strs(svlen)
+            + ";FOLD_CHANGE=" + _float_strs(2.0 ** segs["log2"].values)
+            + ";FOLD_CHANGE_LOG=" + _float_strs(segs["log2"].values)
+            + ";PROBES=" + probes)
     if "ci_left" in segments and "ci_right" in segments:
-        has_ci = True
         # Calculate fuzzy left&right coords for CIPOS and CIEND
         left_margin = segments["ci_left"].values - segments.start.values
         right_margin = segments.end.values - segments["ci_right"].values
-        out_dframe["ci_pos_left"] = np.r_[0, -right_margin[:-1]]
-        out_dframe["ci_pos_right"] = left_margin
-        out_dframe["ci_end_left"] = right_margin
-        out_dframe["ci_end_right"] = np.r_[left_margin[1:], 0]
-    else:
-        has_ci = False
+        ci_pos_left = np.r_[0, -right_margin[:-1]][keep]
+        ci_end_right = np.r_[left_margin[1:], 0][keep]
+        info = (info
+                + ";CIPOS=(" + _int_strs(ci_pos_left)
+                + "," + _int_strs(left_margin[keep])
+                + ");CIEND=(" + _int_strs(right_margin[keep])
+                + "," + _int_strs(ci_end_right) + ")")
+
+    # TODO XXX handle non-diploid ploidies, haploid chroms
+    # Complete deletion, 0 copies; or single copy deletion
+    loss_gt = np.where(ncopies == 0, "1/1:", "0/1:").astype(object)
+    genotype = np.where(is_loss,
+                        loss_gt + probes,
+                        "0/1:0:" + _int_strs(ncopies) + ":" + probes)
+    return pd.DataFrame({
+        "chromosome": segs["chromosome"].values,
+        "pos": segs["start"].replace(0, 1).values,
+        "id": ".",
+        "ref": "N",
+        "alt": "<" + svtype + ">",
+        "qual": ".",
+        "filter": ".",
+        "info": info,
+        "format": np.where(is_loss, "GT:GQ", "GT:GQ:CN:CNQ"),  # :CN:CNQ ?
+        "genotype": genotype,
+    })
 
-    # Reformat this data to create INFO and genotype
-    # TODO be more clever about this
-    for out_row, abs_exp in zip(out_dframe.itertuples(index=False), abs_expect):
-        if (out_row.ncopies == abs_exp or
-            # Survive files from buggy v0.7.1 (#53)
-            not str(out_row.probes).isdigit()):
-            # Skip regions of neutral copy number
-            continue  # or "CNV" for subclonal?
-
-        if out_row.ncopies > abs_exp:
-            genotype = "0/1:0:%d:%d" % (out_row.ncopies, out_row.probes)
-        elif out_row.ncopies < abs_exp:
-            # TODO XXX handle non-diploid ploidies, haploid chroms
-            if out_row.ncopies == 0:
-                # Complete deletion, 0 copies
-                gt = "1/1"
-            else:
-                # Single copy deletion
-                gt = "0/1"
-            genotype = "%s:%d" % (gt, out_row.probes)
-
-        fields = ["IMPRECISE",
-                  "SVTYPE=%s" % out_row.svtype,
-                  "END=%d" % out_row.end,
-                  "SVLEN=%d" % out_row.svlen,
-                  "FOLD_CHANGE=%f" % 2.0 ** out_row.log2,
-                  "FOLD_CHANGE_LOG=%f" % out_row.log2,
-                  "PROBES=%d" % out_row.probes
-                 ]
-        if has_ci:
-            fields.extend([
-                "CIPOS=(%d,%d)" % (out_row.ci_pos_left, out_row.ci_pos_right),
-                "CIEND=(%d,%d)" % (out_row.ci_end_left, out_row.ci_end_right),
-            ])
-        info = ";".join(fields)
-
-        yield (out_row.chromosome, out_row.start, '.', 'N',
-               "<%s>" % out_row.svtype, '.', '.',
-               info, out_row.format, genotype)
+
+def _int_strs(values):
+    """Format numbers as integer strings, like ``"%d" % value``."""
+    return np.asarray(values).astype(np.int64).astype(str).astype(object)
+
+
+def _float_strs(values):
+    """Format floats as fixed-point strings, like ``"%f" % value``."""
+    return np.char.mod("%f", np.asarray(values, dtype=np.float_)).astype(object)
 
 
 # _____________________________________________________________________________
 # GISTIC
 
-def export_gistic_markers(cnr_fnames):
+def export_gistic_markers(cnr_fnames, processes=1):
     """Generate a GISTIC 2.0 "markers" file from a set of .cnr files.
 
     GISTIC documentation:
@@ -362,29 +524,43 @@ def export_gistic_markers(cnr_fnames):
 
     GISTIC also needs an accompanying SEG file generated from corresponding .cns
     files.
+
+    Files are read in parallel if `processes` is not 1. Markers are only built
+    from the first file with each distinct set of bins.
     """
     colnames = ["ID", "CHROM", "POS"]
     out_chunks = []
-    # TODO since markers will mostly be the same,
-    #   detect duplicates & exclude them
-    # seen_marker_ids = None
-    for fname in cnr_fnames:
-        cna = read_cna(fname)
-        marker_ids = cna.labels()
-        tbl = pd.concat([
-            pd.DataFrame({
-                "ID": marker_ids,
-                "CHROM": cna.chromosome,
-                "POS": cna.start + 1,
-            }, columns=colnames),
-            pd.DataFrame({
-                "ID": marker_ids,
-                "CHROM": cna.chromosome,
-                "POS": cna.end,
-            }, columns=colnames),
-        ], ignore_index=True)
-        out_chunks.append(tbl)
-    return pd.concat(out_chunks).drop_duplicates()
+    # Markers will mostly be the same; only build them for new sets of bins
+    seen_digests = set()
+    seen_marker_ids = set()
+    with parallel.pick_pool(processes) as pool:
+        for fname, digest in zip(cnr_fnames,
+                                 pool.map(_read_bins_digest, cnr_fnames)):
+            if digest in seen_digests:
+                continue
+            seen_digests.add(digest)
+            cna = read_cna(fname)
+            marker_ids = cna.labels()
+            is_new = ~(marker_ids.isin(seen_marker_ids).values
+                       | marker_ids.duplicated().values)
+            seen_marker_ids.update(marker_ids[is_new])
+            marker_ids = marker_ids[is_new]
+            tbl = pd.concat([
+                pd.DataFrame({
+                    "ID": marker_ids,
+                    "CHROM": cna.chromosome[is_new],
+                    "POS": cna.start[is_new] + 1,
+                }, columns=colnames),
+                pd.DataFrame({
+                    "ID": marker_ids,
+                    "CHROM": cna.chromosome[is_new],
+                    "POS": cna.end[is_new],
+                }, columns=colnames),
+            ], ignore_index=True)
+            out_chunks.append(tbl)
+    if not out_chunks:
+        return pd.DataFrame(columns=colnames)
+    return pd.concat(out_chunks)
 
 
 # _____________________________________________________________________________
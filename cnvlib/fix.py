@@ -1,8 +1,10 @@
 """Supporting functions for the 'fix' command."""
 import logging
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
+from skgenome.chromsort import sorter_chrom
 
 from . import descriptives, params, smoothing
 
@@ -82,28 +84,25 @@ def load_adjust_coverages(cnarr, ref_cnarr, skip_low,
         logging.warning("WARNING: most bins have no or very low coverage; "
                         "check that the right BED file was used")
     else:
-        cnarr_index_reset = False
+        bias_keys = []
         if fix_gc:
             if 'gc' in ref_matched:
                 logging.info("Correcting for GC bias...")
-                cnarr = center_by_window(cnarr, .1, ref_matched['gc'])
-                cnarr_index_reset = True
+                bias_keys.append(ref_matched['gc'].values)
             else:
                 logging.warning("WARNING: Skipping correction for GC bias")
         if fix_edge:
             logging.info("Correcting for density bias...")
-            edge_bias = get_edge_bias(cnarr, params.INSERT_SIZE)
-            cnarr = center_by_window(cnarr, .1, edge_bias)
-            cnarr_index_reset = True
+            bias_keys.append(get_edge_bias(cnarr, params.INSERT_SIZE))
         if fix_rmask:
             if 'rmask' in ref_matched:
                 logging.info("Correcting for RepeatMasker bias...")
-                cnarr = center_by_window(cnarr, .1, ref_matched['rmask'])
-                cnarr_index_reset = True
+                bias_keys.append(ref_matched['rmask'].values)
             else:
                 logging.warning("WARNING: Skipping correction for "
                                 "RepeatMasker bias")
-        if cnarr_index_reset:
+        if bias_keys:
+            cnarr = center_by_windows(cnarr, .1, bias_keys)
             ref_matched.data.reset_index(drop=True, inplace=True)
     return cnarr, ref_matched
 
@@ -128,25 +127,55 @@ def mask_bad_bins(cnarr):
 
 def match_ref_to_sample(ref_cnarr, samp_cnarr):
     """Filter the reference bins to match the sample (target or antitarget)."""
-    # Assign each bin a unique string ID based on genomic coordinates
-    samp_labeled = samp_cnarr.data.set_index(pd.Index(samp_cnarr.coords()))
-    ref_labeled = ref_cnarr.data.set_index(pd.Index(ref_cnarr.coords()))
-    for dset, name in ((samp_labeled, "sample"),
-                       (ref_labeled, "reference")):
-        dupes = dset.index.duplicated()
+    # Assign each bin a unique integer ID based on genomic coordinates
+    samp_ids, ref_ids = _coord_ids(samp_cnarr, ref_cnarr)
+    for ids, cnarr, name in ((samp_ids, samp_cnarr, "sample"),
+                             (ref_ids, ref_cnarr, "reference")):
+        dupes = pd.Series(ids).duplicated().values
         if dupes.any():
+            dupe_coords = cnarr.data.loc[dupes, ['chromosome', 'start', 'end']]
             raise ValueError(("Duplicated genomic coordinates in {} set. Total duplicated regions: {}, starting with:\n"
-                              "{}.").format(name, len(dset.index[dupes]), "\n".join(map(str, dset.index[dupes][:10]))))
-    # Take the reference bins with IDs identical to those in the sample
-    ref_matched = ref_labeled.reindex(index=samp_labeled.index)
-    # Check for signs that the wrong reference was used
-    num_missing = pd.isnull(ref_matched.start).sum()
-    if num_missing > 0:
-        raise ValueError("Reference is missing %d bins found in %s"
-                         % (num_missing, samp_cnarr.sample_id))
-    x = ref_cnarr.as_dataframe(ref_matched.reset_index(drop=True)
-                               .set_index(samp_cnarr.data.index))
-    return x
+                              "{}.").format(name, dupes.sum(), "\n".join(
+                                  str(tuple(row)) for row in
+                                  dupe_coords[:10].itertuples(index=False))))
+    if len(ref_ids) == len(samp_ids) and (ref_ids == samp_ids).all():
+        # Same bins in the same order; no reindexing needed
+        ref_matched = ref_cnarr.data.copy()
+    else:
+        # Take the reference bins with IDs identical to those in the sample
+        ref_rows = np.full(len(samp_ids) + len(ref_ids), -1, dtype=np.int_)
+        ref_rows[ref_ids] = np.arange(len(ref_ids))
+        ref_rows = ref_rows[samp_ids]
+        # Check for signs that the wrong reference was used
+        num_missing = (ref_rows < 0).sum()
+        if num_missing > 0:
+            raise ValueError("Reference is missing %d bins found in %s"
+                             % (num_missing, samp_cnarr.sample_id))
+        ref_matched = ref_cnarr.data.take(ref_rows)
+    ref_matched.index = samp_cnarr.data.index
+    return ref_cnarr.as_dataframe(ref_matched)
+
+
+def _coord_ids(*cnarrs):
+    """Label bins with dense integer IDs, shared across the given arrays.
+
+    Bins with identical chromosome, start and end get the same ID. IDs are
+    assigned in one lexicographic sort over the coordinate arrays, instead of
+    hashing a Python tuple per bin.
+    """
+    chroms = pd.factorize(np.concatenate([np.asarray(cnarr['chromosome'])
+                                          for cnarr in cnarrs]))[0]
+    starts = np.concatenate([cnarr['start'].values for cnarr in cnarrs])
+    ends = np.concatenate([cnarr['end'].values for cnarr in cnarrs])
+    order = np.lexsort((ends, starts, chroms))
+    same_as_prev = np.ones(max(len(order) - 1, 0), dtype=np.bool_)
+    for coord in (chroms, starts, ends):
+        coord = coord[order]
+        same_as_prev &= (coord[1:] == coord[:-1])
+    is_new = np.concatenate(([True], ~same_as_prev))[:len(order)]
+    ids = np.empty(len(order), dtype=np.int_)
+    ids[order] = np.cumsum(is_new) - 1
+    return np.split(ids, np.cumsum([len(cnarr) for cnarr in cnarrs])[:-1])
 
 
 def center_by_window(cnarr, fraction, sort_key):
@@ -155,30 +184,69 @@ def center_by_window(cnarr, fraction, sort_key):
     E.g. correct GC-biased bins by windowed averaging across similar-GC
     bins; or for similar interval sizes.
     """
-    # Separate neighboring bins that could have the same key
-    # (to avoid re-centering actual CNV regions -- only want an independently
-    # sampled subset of presumably overall-CN-neutral bins)
-    df = cnarr.data.reset_index(drop=True)
-    np.random.seed(0xA5EED)
-    shuffle_order = np.random.permutation(df.index)
-    #df = df.reindex(shuffle_order)
-    df = df.iloc[shuffle_order]
-    # Apply the same shuffling to the key array as to the target probe set
-    if isinstance(sort_key, pd.Series):
-        # XXX why
-        sort_key = sort_key.values
-    sort_key = sort_key[shuffle_order]
-    # Sort the data according to the specified parameter
-    order = np.argsort(sort_key, kind='mergesort')
-    df = df.iloc[order]
-    biases = smoothing.rolling_median(df['log2'], fraction)
-    # biases = smoothing.savgol(df['log2'], fraction)
-    df['log2'] -= biases
-    fixarr = cnarr.as_dataframe(df)
-    fixarr.sort()
+    return center_by_windows(cnarr, fraction, [sort_key])
+
+
+def center_by_windows(cnarr, fraction, sort_keys):
+    """Smooth out biases according to each of the given traits, in turn.
+
+    Equivalent to calling `center_by_window` once per key, but the log2 values
+    are corrected in a single array and the bins are only rebuilt (and
+    re-sorted, if needed) once at the end.
+
+    Returns
+    -------
+    CopyNumArray
+        A copy of `cnarr` with bias-corrected log2 values, in genomic order and
+        with a fresh index. Each key must be aligned with the rows of `cnarr`.
+    """
+    log2 = cnarr['log2'].values.astype(np.float_)
+    shuffle_order = _shuffle_order(len(log2))
+    for sort_key in sort_keys:
+        center_log2_by_window(log2, fraction, sort_key, shuffle_order)
+    fixarr = cnarr.as_dataframe(cnarr.data.assign(log2=log2),
+                                reset_index=True)
+    order = _genomic_order(fixarr)
+    if (order != np.arange(len(order))).any():
+        fixarr.data = fixarr.data.take(order).reset_index(drop=True)
     return fixarr
 
 
+def center_log2_by_window(log2, fraction, sort_key, shuffle_order=None):
+    """Subtract the rolling median of log2 values ranked by sort_key, in-place.
+
+    Neighboring bins that could have the same key are separated by a fixed
+    random permutation first (to avoid re-centering actual CNV regions -- only
+    want an independently sampled subset of presumably overall-CN-neutral
+    bins), then stably sorted by the key.
+    """
+    if shuffle_order is None:
+        shuffle_order = _shuffle_order(len(log2))
+    sort_key = np.asarray(sort_key)[shuffle_order]
+    order = shuffle_order[np.argsort(sort_key, kind='mergesort')]
+    log2[order] -= smoothing.rolling_median(log2[order], fraction)
+
+
+@lru_cache(maxsize=8)
+def _shuffle_order(n_bins):
+    """Fixed-seed permutation of bin indices, shared by all corrections."""
+    order = np.random.RandomState(0xA5EED).permutation(n_bins)
+    order.flags.writeable = False
+    return order
+
+
+def _genomic_order(cnarr):
+    """Stable sort order of bins by chromosome (smart order), start and end."""
+    chroms, chrom_idx = np.unique(cnarr['chromosome'].values,
+                                  return_inverse=True)
+    chrom_rank = np.empty(len(chroms), dtype=np.int_)
+    chrom_rank[sorted(range(len(chroms)),
+                      key=lambda i: sorter_chrom(chroms[i]))] = \
+            np.arange(len(chroms))
+    return np.lexsort((cnarr['end'].values, cnarr['start'].values,
+                       chrom_rank[chrom_idx]))
+
+
 def get_edge_bias(cnarr, margin):
     """Quantify the "edge effect" of the target tile and its neighbors.
 
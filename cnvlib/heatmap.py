@@ -11,11 +11,158 @@ from skgenome.rangelabel import unpack_range
 from . import plots
 
 
-cna2df = lambda cna: cna.data.loc[:, ['start', 'end', 'log2']]
+class CohortMatrix(object):
+    """Log2 values of many samples over their shared genomic intervals.
 
-def do_heatmap(cnarrs, show_range=None, do_desaturate=False, by_bin=False, 
+    Each column is an interval between consecutive bin or segment boundaries
+    of any of the samples, so each sample has a single value (or none) over
+    it. Building this once lets a cohort be drawn as a single image, and
+    saved as a NumPy .npz archive to re-draw other regions later without
+    re-reading each sample's file.
+
+    Attributes
+    ----------
+    sample_ids : list
+    regions : pandas.DataFrame
+        The chromosome, start and end of each column, sorted by chromosome
+        in order of appearance in the samples, then by position.
+    log2 : numpy.ndarray
+        Log2 values, samples x columns, as float32; NaN where a sample has no
+        data in a column.
+    by_bin : bool
+        Whether positions are bin indices instead of genomic coordinates.
+    """
+
+    def __init__(self, sample_ids, regions, log2, by_bin=False):
+        self.sample_ids = list(sample_ids)
+        self.regions = regions
+        self.log2 = log2
+        self.by_bin = by_bin
+
+    def __len__(self):
+        return len(self.sample_ids)
+
+    @classmethod
+    def from_cnarrs(cls, cnarrs, by_bin=False):
+        """Tabulate samples' bin or segment log2 values."""
+        if by_bin:
+            cnarrs = [plots.update_binwise_positions_simple(cnarr)
+                      for cnarr in cnarrs]
+        # Each sample's (start, end, log2) arrays, grouped by chromosome
+        chrom_samples = collections.OrderedDict()
+        for i, cnarr in enumerate(cnarrs):
+            cols = [cnarr[col].values for col in ('start', 'end', 'log2')]
+            for chrom, idx in cnarr.data.groupby('chromosome',
+                                                 sort=False).indices.items():
+                chrom_samples.setdefault(chrom, []).append(
+                    (i, [col[idx] for col in cols]))
+        region_chunks = []
+        log2_chunks = []
+        for chrom, samples in chrom_samples.items():
+            edges = np.unique(np.concatenate(
+                [arr for _i, (s_starts, s_ends, _l) in samples
+                 for arr in (s_starts, s_ends)]))
+            starts, ends = edges[:-1], edges[1:]
+            log2 = np.full((len(cnarrs), len(starts)), np.nan,
+                           dtype=np.float32)
+            for i, (s_starts, s_ends, s_log2) in samples:
+                # The bin or segment (if any) covering each column
+                idx = np.searchsorted(s_starts, starts, side='right') - 1
+                is_covered = (idx >= 0)
+                idx = np.maximum(idx, 0)
+                is_covered &= (starts < s_ends[idx])
+                log2[i, is_covered] = s_log2[idx[is_covered]]
+            # Drop the gaps between all samples' bins
+            keep = ~np.isnan(log2).all(axis=0)
+            region_chunks.append(pd.DataFrame({'chromosome': chrom,
+                                               'start': starts[keep],
+                                               'end': ends[keep]}))
+            log2_chunks.append(log2[:, keep])
+        if region_chunks:
+            regions = pd.concat(region_chunks, ignore_index=True)
+            log2 = np.concatenate(log2_chunks, axis=1)
+        else:
+            regions = pd.DataFrame({'chromosome': [], 'start': [], 'end': []})
+            log2 = np.zeros((len(cnarrs), 0), dtype=np.float32)
+        return cls([cnarr.sample_id for cnarr in cnarrs], regions, log2,
+                   by_bin)
+
+    @classmethod
+    def read(cls, fname):
+        """Load a matrix from an .npz file written by `write`."""
+        with np.load(fname) as npz:
+            regions = pd.DataFrame({'chromosome': npz['chromosome'],
+                                    'start': npz['start'],
+                                    'end': npz['end']})
+            return cls([str(sid) for sid in npz['sample_ids']], regions,
+                       npz['log2'], bool(npz['by_bin']))
+
+    def write(self, fname):
+        """Save the matrix to an .npz file."""
+        with open(fname, 'wb') as outfile:
+            np.savez(outfile,
+                     sample_ids=np.array(self.sample_ids, dtype=np.str_),
+                     chromosome=self.regions['chromosome'].values.astype(
+                         np.str_),
+                     start=self.regions['start'].values,
+                     end=self.regions['end'].values,
+                     log2=self.log2,
+                     by_bin=np.array(self.by_bin))
+        logging.info("Wrote %s with %d samples and %d intervals", fname,
+                     len(self), len(self.regions))
+
+    def chromosome_sizes(self):
+        """Ordered mapping of chromosome names to their last column's end."""
+        chrom_sizes = collections.OrderedDict()
+        for chrom, ends in self.regions.groupby('chromosome',
+                                                sort=False)['end']:
+            chrom_sizes[chrom] = ends.iat[-1]
+        return chrom_sizes
+
+    def in_range(self, chrom, start=None, end=None):
+        """Columns of one chromosome, optionally trimmed to a region.
+
+        Returns
+        -------
+        tuple
+            The columns' start and end positions, and the log2 values of each
+            sample in them.
+        """
+        idx = np.flatnonzero(self.regions['chromosome'].values == chrom)
+        starts = self.regions['start'].values[idx]
+        ends = self.regions['end'].values[idx]
+        if start is not None or end is not None:
+            keep = np.ones(len(idx), dtype=np.bool_)
+            if start is not None:
+                keep &= (ends > start)
+            if end is not None:
+                keep &= (starts < end)
+            idx = idx[keep]
+            starts = np.clip(starts[keep], start, end)
+            ends = np.clip(ends[keep], start, end)
+        return starts, ends, self.log2[:, idx]
+
+
+def do_heatmap(cnarrs, show_range=None, do_desaturate=False, by_bin=False,
                delim_sampl=False, vertical=False, title=None, ax=None):
-    """Plot copy number for multiple samples as a heatmap."""
+    """Plot copy number for multiple samples as a heatmap.
+
+    The cohort is drawn as a single image, with one row per sample and each
+    column showing the log2 value of largest magnitude within that slice of
+    the plot, so that focal gains and losses stay visible. `cnarrs` may be a
+    list of CopyNumArrays or a `CohortMatrix` (with `by_bin` already applied)
+    built from them.
+    """
+    if isinstance(cnarrs, CohortMatrix):
+        matrix = cnarrs
+        if by_bin and not matrix.by_bin:
+            raise ValueError("Option --by-bin (by_bin) can't be applied to a "
+                             "matrix tabulated by genomic position")
+        by_bin = matrix.by_bin
+        cnarrs = None
+        sample_ids = matrix.sample_ids
+    else:
+        sample_ids = [c.sample_id for c in cnarrs]
     if ax is None:
         _fig, axis = plt.subplots()
     else:
@@ -23,14 +170,14 @@ def do_heatmap(cnarrs, show_range=None, do_desaturate=False, by_bin=False,
 
     # List sample names on the appropriate axis.
     if not vertical:
-        axis.set_yticks([i + 0.5 for i in range(len(cnarrs))])
-        axis.set_yticklabels([c.sample_id for c in cnarrs])
-        axis.set_ylim(0, len(cnarrs))
+        axis.set_yticks([i + 0.5 for i in range(len(sample_ids))])
+        axis.set_yticklabels(sample_ids)
+        axis.set_ylim(0, len(sample_ids))
         axis.set_ylabel('Samples')
     else:
-        axis.set_xticks([i + 0.5 for i in range(len(cnarrs))])
-        axis.set_xticklabels([c.sample_id for c in cnarrs], rotation=90)
-        axis.set_xlim(0, len(cnarrs))
+        axis.set_xticks([i + 0.5 for i in range(len(sample_ids))])
+        axis.set_xticklabels(sample_ids, rotation=90)
+        axis.set_xlim(0, len(sample_ids))
         axis.set_xlabel('Samples')
 
     if hasattr(axis, 'set_facecolor'):
@@ -42,7 +189,7 @@ def do_heatmap(cnarrs, show_range=None, do_desaturate=False, by_bin=False,
 
     if by_bin and show_range:
         try:
-            a_cnarr = next(c for c in cnarrs if 'probes' not in c)
+            a_cnarr = next(c for c in cnarrs or () if 'probes' not in c)
         except StopIteration:
             r_chrom, r_start, r_end = unpack_range(show_range)
             if r_start is not None or r_end is not None:
@@ -60,26 +207,10 @@ def do_heatmap(cnarrs, show_range=None, do_desaturate=False, by_bin=False,
     elif r_chrom:
         logging.info('Showing log2 ratios on chromosome {}'.format(r_chrom))
 
-    # Group each file's probes/segments by chromosome
-    sample_data = [collections.defaultdict(list) for _c in cnarrs]
-    # Calculate the size (max endpoint value) of each chromosome
-    chrom_sizes = collections.OrderedDict()
-    for i, cnarr in enumerate(cnarrs):
-        if by_bin:
-            cnarr = plots.update_binwise_positions_simple(cnarr)
-
-        if r_chrom:
-            subcna = cnarr.in_range(r_chrom, r_start, r_end, mode='trim')
-            sample_data[i][r_chrom] = cna2df(subcna)
-            chrom_sizes[r_chrom] = max(subcna.end.iat[-1] if subcna else 0,
-                                       chrom_sizes.get(r_chrom, 0))
-        else:
-            for chrom, subcna in cnarr.by_chromosome():
-                sample_data[i][chrom] = cna2df(subcna)
-                chrom_sizes[chrom] = max(subcna.end.iat[-1] if subcna else 0,
-                                         chrom_sizes.get(r_chrom, 0))
+    if cnarrs is not None:
+        matrix = CohortMatrix.from_cnarrs(cnarrs, by_bin)
+    chrom_sizes = matrix.chromosome_sizes()
 
-    dict_log2 = collections.OrderedDict()
     if show_range:
         # Lay out only the selected chromosome
         # Set x-axis the chromosomal positions (in Mb), title as the selection
@@ -94,76 +225,90 @@ def do_heatmap(cnarrs, show_range=None, do_desaturate=False, by_bin=False,
         axis.tick_params(which='both', direction='out')
         axis.get_xaxis().tick_bottom()
         axis.get_yaxis().tick_left()
+        pos_min = (r_start or 0) * MB
+        pos_max = (r_end or chrom_sizes.get(r_chrom, 0)) * MB
         if not vertical:
-            axis.set_xlim((r_start or 0) * MB, (r_end or chrom_sizes[r_chrom]) * MB)
+            axis.set_xlim(pos_min, pos_max)
         else:
-            axis.set_ylim((r_start or 0) * MB, (r_end or chrom_sizes[r_chrom]) * MB)
+            axis.set_ylim(pos_min, pos_max)
 
-        # Plot the individual probe/segment coverages
-        for i, sample in enumerate(sample_data):
-            sampl_crow = sample[r_chrom]
-            if not len(sampl_crow):
-                logging.warning('Sample #{} has no data points in selection {}', i+1, show_range)
-            sampl_crow['start'] *= MB
-            sampl_crow['end'] *= MB
-            dict_log2[i] = sampl_crow.set_index(['start', 'end']).log2
+        starts, ends, log2 = matrix.in_range(r_chrom, r_start, r_end)
+        starts = starts * MB
+        ends = ends * MB
+        for i in np.flatnonzero(np.isnan(log2).all(axis=1)):
+            logging.warning('Sample #%d has no data points in selection %s',
+                            i+1, show_range)
 
     else:
         # Lay out chromosome dividers and x-axis labels
         # (Just enough padding to avoid overlap with the divider line)
         chrom_offsets = plots.plot_chromosome_dividers(axis, chrom_sizes, 1, along='y' if vertical else 'x')
-        # Plot the individual probe/segment coverages
-        for i, sample in enumerate(sample_data):
-            all_crows = []
-            for chrom, curr_offset in chrom_offsets.items():
-                crow = sample[chrom]
-                if len(crow):
-                    crow['start'] += curr_offset
-                    crow['end'] += curr_offset
-                    all_crows.append(crow)
-                else:
-                    logging.warning('Sample #%d has no datapoints', i+1)
-            sampl_crow = pd.concat(all_crows, axis='index')
-            dict_log2[i] = sampl_crow.set_index(['start', 'end']).log2
-
-    log2_df = pd.DataFrame.from_dict(dict_log2)
-    # Need to explicitly insert NaN-filled rows in-between 2 discontiguous intervals
-    log2_df.reset_index(inplace=True)
-    compt = 0
-    for i in range(1, len(log2_df.index)):
-        end_previous = log2_df.iloc[i-1].end
-        start_current = log2_df.iloc[i].start
-        if end_previous != start_current:  # Discontiguous.
-            compt += 1
-            log2_df.loc[i-1+0.5, :] = [end_previous, start_current] + [np.nan] * len(cnarrs)
-    log2_df.sort_index(inplace=True)
-    logging.debug('Inserted {} empty intervals (log2 = NaN for all samples).'.format(compt))
-
-    # If no data for all samples, return an empty plot. Without this, further log2_df.end.iat[-1] causes an IndexError.
-    if not len(log2_df):
+        pos_min, pos_max = (axis.get_ylim() if vertical else axis.get_xlim())
+        offsets = matrix.regions['chromosome'].map(chrom_offsets).values
+        starts = matrix.regions['start'].values + offsets
+        ends = matrix.regions['end'].values + offsets
+        log2 = matrix.log2
+
+    # If no data for all samples, return an empty plot.
+    if not len(starts):
         return axis
 
-    # If shading='flat' (which is default) the dimensions of X and Y should be one greater than those of C.
-    start2plt = np.array(log2_df.start.to_list() + [log2_df.end.iat[-1]])
-    sampl2plt = np.array(range(len(cnarrs) + 1))
+    cmap = ListedColormap([plots.cvg2rgb(x, do_desaturate) for x in np.linspace(-1.33, 1.33, 200)])
+    # Show the background color where there's no data
+    cmap.set_bad((0, 0, 0, 0))
     if not vertical:
-        dat2plot = log2_df.drop(['start', 'end'], axis='columns').transpose()
-        x_pcolor, y_pcolor = start2plt, sampl2plt
+        extent = (pos_min, pos_max, 0, len(sample_ids))
     else:
-        dat2plot = log2_df.drop(['start', 'end'], axis='columns')
-        x_pcolor, y_pcolor = sampl2plt, start2plt
-
-    cmap = ListedColormap([plots.cvg2rgb(x, do_desaturate) for x in np.linspace(-1.33, 1.33, 200)])
-    im = axis.pcolormesh(x_pcolor, y_pcolor, dat2plot, vmin=-1.33, vmax=1.33, cmap=cmap)
+        extent = (0, len(sample_ids), pos_min, pos_max)
+    im = axis.imshow(np.full((1, 1), np.nan), extent=extent, origin='lower',
+                     aspect='auto', interpolation='nearest', vmin=-1.33,
+                     vmax=1.33, cmap=cmap)
+    # The colorbar shrinks the axis, so add it before measuring the axis
     cbar = plt.colorbar(im, ax=axis, fraction=0.04, pad=0.03, shrink=0.6)
     cbar.set_label('log2', labelpad=0)
-    
+
+    # Resample the columns to the plot's resolution. With no more columns
+    # than whole pixels, no column is skipped when the image is drawn.
+    bbox = axis.get_window_extent()
+    n_pixels = max(1, int(bbox.height if vertical else bbox.width))
+    pixel_edges = np.linspace(pos_min, pos_max, n_pixels + 1)
+    image = paint_over(starts, ends, log2, pixel_edges)
+    im.set_data(image.T if vertical else image)
+
     if delim_sampl:
         delim_method = axis.axvline if vertical else axis.axhline
-        for i in range(len(cnarrs)):
+        for i in range(len(sample_ids)):
             delim_method(i, color='k')
-    
+
     axis.invert_yaxis()
     if title:
         axis.set_title(title)
     return axis
+
+
+def paint_over(starts, ends, values, edges):
+    """Paint each row of values onto the intervals between `edges`.
+
+    Each interval takes the value of largest magnitude among the columns of
+    `values` overlapping it, as given by their sorted, non-overlapping
+    `starts` and `ends`, so a focal gain or loss narrower than an interval
+    still shows. NaN values are skipped; intervals with no values are NaN.
+
+    Returns
+    -------
+    numpy.ndarray
+        Of shape (rows of `values`, intervals between `edges`).
+    """
+    # Range of columns overlapping each interval
+    firsts = np.searchsorted(ends, edges[:-1], side='right')
+    lasts = np.searchsorted(starts, edges[1:], side='left')
+    # Reduce over each (first, last) pair; a trailing NaN column keeps every
+    # index in bounds, and empty ranges are masked out afterward
+    bounds = np.column_stack([firsts, lasts]).ravel()
+    padded = np.column_stack([values, np.full(len(values), np.nan)])
+    with np.errstate(invalid='ignore'):
+        highs = np.fmax.reduceat(padded, bounds, axis=1)[:, ::2]
+        lows = np.fmin.reduceat(padded, bounds, axis=1)[:, ::2]
+        image = np.where(np.abs(lows) > np.abs(highs), lows, highs)
+    image[:, lasts <= firsts] = np.nan
+    return image
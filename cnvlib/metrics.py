@@ -1,13 +1,24 @@
 """Robust metrics to evaluate performance of copy number estimates.
 """
+import warnings
+
 import numpy as np
 import pandas as pd
 
-from . import descriptives
+from . import descriptives, parallel
+
+# Max. number of bins x samples to hold in one matrix of residuals
+COHORT_BATCH_CELLS = 2 * 10**7
+
 
+def do_metrics(cnarrs, segments=None, skip_low=False, processes=1):
+    """Compute coverage deviations and other metrics for self-evaluation.
 
-def do_metrics(cnarrs, segments=None, skip_low=False):
-    """Compute coverage deviations and other metrics for self-evaluation."""
+    If the same segments (or none) apply to all samples, consecutive samples
+    with identical bins are scored together, column-wise over a matrix of
+    their residuals. Otherwise, each sample is scored separately, in parallel
+    if `processes` is not 1.
+    """
     # Catch if passed args are single CopyNumArrays instead of lists
     from .cnary import CopyNumArray as CNA
     if isinstance(cnarrs, CNA):
@@ -20,14 +31,127 @@ def do_metrics(cnarrs, segments=None, skip_low=False):
         segments = list(segments)
     if skip_low:
         cnarrs = (cna.drop_low_coverage() for cna in cnarrs)
-    rows = ((cna.meta.get("filename", cna.sample_id),
-             len(seg) if seg is not None else '-'
-            ) + ests_of_scale(cna.residuals(seg).values)
-            for cna, seg in zip_repeater(cnarrs, segments))
+    if len(segments) == 1:
+        rows = cohort_metrics(cnarrs, segments[0], processes)
+    else:
+        with parallel.pick_pool(processes) as pool:
+            rows = list(pool.map(_sample_metrics,
+                                 zip_repeater(cnarrs, segments)))
     colnames = ["sample", "segments", "stdev", "mad", "iqr", "bivar"]
     return pd.DataFrame.from_records(rows, columns=colnames)
 
 
+def _sample_metrics(args):
+    """Metrics of one sample's residuals."""
+    cna, seg = args
+    return (_sample_label(cna, seg)
+            + ests_of_scale(cna.residuals(seg).values))
+
+
+def _sample_label(cna, seg):
+    return (cna.meta.get("filename", cna.sample_id),
+            len(seg) if seg is not None else '-')
+
+
+def cohort_metrics(cnarrs, segments=None, processes=1):
+    """Metrics of each sample's residuals versus the same segments.
+
+    Runs of consecutive samples with identical bins are batched into one
+    bins-by-samples matrix (of at most `COHORT_BATCH_CELLS` cells), which is
+    segmented once and scored column-wise.
+
+    Returns
+    -------
+    list
+        A tuple per sample, as the rows of the `do_metrics` table.
+    """
+    rows = []
+    for batch in batch_by_bins(cnarrs):
+        rows.extend(_batch_metrics(batch, segments, processes))
+    return rows
+
+
+def batch_by_bins(cnarrs, max_cells=None):
+    """Group consecutive samples with identical bins.
+
+    Each batch holds at most `max_cells` bins x samples (by default,
+    `COHORT_BATCH_CELLS`), so that a cohort can be processed as a series of
+    matrices of bounded size. Input order is preserved.
+    """
+    if max_cells is None:
+        max_cells = COHORT_BATCH_CELLS
+    batch = []
+    for cna in cnarrs:
+        if batch and ((len(batch) + 1) * len(cna) > max_cells
+                      or not batch[0].same_coords(cna)):
+            yield batch
+            batch = []
+        batch.append(cna)
+    if batch:
+        yield batch
+
+
+def _batch_metrics(cnarrs, segments, processes):
+    """Metrics of samples sharing the same bins, as matrix columns."""
+    log2s = np.column_stack([cna['log2'].values for cna in cnarrs])
+    resids = residual_matrix(cnarrs[0], log2s, segments)
+    chunks = np.array_split(resids, max(1, min(processes or 1, len(cnarrs))),
+                            axis=1)
+    with parallel.pick_pool(processes) as pool:
+        ests = list(pool.map(ests_of_scale_cols, chunks))
+    ests = np.hstack(ests)
+    return [_sample_label(cna, segments) + tuple(est)
+            for cna, est in zip(cnarrs, ests.T)]
+
+
+def residual_matrix(cnarr, log2s, segments=None):
+    """Residuals of each column of log2 values, as in `CopyNumArray.residuals`.
+
+    Parameters
+    ----------
+    cnarr : CopyNumArray
+        Bins shared by all columns of `log2s`.
+    log2s : 2D array
+        Log2 values of each sample (column) at the bins of `cnarr` (rows).
+    segments : GenomicArray, CopyNumArray, or None
+        As in `CopyNumArray.residuals`.
+
+    Returns
+    -------
+    2D array
+        Residual log2 values, with one column per sample, aligned to the bins
+        of `cnarr`.
+    """
+    log2s = pd.DataFrame(log2s)
+    if not segments:
+        groups = pd.factorize(cnarr['chromosome'])[0]
+        centers = log2s.groupby(groups).median().values
+    elif "log2" in segments:
+        groups = cnarr.range_idx(segments, mode='inner')
+        centers = segments['log2'].values[:, None]
+    else:
+        groups = cnarr.range_idx(segments)
+        medians = log2s.groupby(groups).median()
+        centers = np.full((len(segments), log2s.shape[1]), np.nan)
+        is_seg = (medians.index >= 0)
+        centers[medians.index[is_seg]] = medians.values[is_seg]
+    # Bins outside all segments (group -1) take the trailing NaN row
+    n_cols = log2s.shape[1]
+    centers = np.vstack([np.broadcast_to(centers, (len(centers), n_cols)),
+                         np.full((1, n_cols), np.nan)])
+    return log2s.values - centers[groups]
+
+
+def _nanmedian(a):
+    """Median of each column, skipping NaNs (like `pd.Series.median`)."""
+    if not np.isnan(a).any():
+        return np.median(a, axis=0)
+    with warnings.catch_warnings():
+        # All-NaN columns are OK; their median is NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(a, axis=0)
+
+
 def zip_repeater(iterable, repeatable):
     """Repeat a single segmentation to match the number of copy ratio inputs"""
     rpt_len = len(repeatable)
@@ -49,10 +173,39 @@ def ests_of_scale(deviations):
     """Estimators of scale: standard deviation, MAD, biweight midvariance.
 
     Calculates all of these values for an array of deviations and returns them
-    as a tuple.
+    as a tuple. Missing (NaN) deviations, e.g. of bins outside all segments,
+    are skipped.
     """
+    deviations = np.asfarray(deviations)
+    deviations = deviations[~np.isnan(deviations)]
     std = np.std(deviations, dtype=np.float64)
     mad = descriptives.median_absolute_deviation(deviations)
     iqr = descriptives.interquartile_range(deviations)
     biw = descriptives.biweight_midvariance(deviations)
     return (std, mad, iqr, biw)
+
+
+def ests_of_scale_cols(deviations):
+    """Estimators of scale (as in `ests_of_scale`) of each column of a matrix.
+
+    Returns
+    -------
+    np.ndarray
+        The standard deviation, MAD, IQR and biweight midvariance of each
+        column, as 4 rows.
+    """
+    deviations = np.asfarray(deviations)
+    is_nan = np.isnan(deviations)
+    if is_nan.any():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            std = np.nanstd(deviations, axis=0, dtype=np.float64)
+    else:
+        std = np.std(deviations, axis=0, dtype=np.float64)
+    center = _nanmedian(deviations)
+    mad = _nanmedian(np.abs(deviations - center)) * 1.4826
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        q1, q3 = np.nanpercentile(deviations, [25, 75], axis=0)
+    biw = descriptives.biweight_midvariance_cols(deviations)
+    return np.vstack([std, mad, q3 - q1, biw])
@@ -1,5 +1,6 @@
 """Utilities for multi-core parallel processing."""
 import atexit
+import collections
 import tempfile
 import gzip
 import os
@@ -50,6 +51,22 @@ def pick_pool(nprocs):
             yield pool
 
 
+def map_ahead(pool, func, iterable, processes):
+    """Like `pool.map`, but only submit a few jobs ahead of the results.
+
+    The arguments in `iterable` are then generated (e.g. read from disk) and
+    sent to the workers as needed, rather than all at once.
+    """
+    max_pending = 2 * (processes if processes > 0 else os.cpu_count())
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(pool.submit(func, args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
 def rm(path):
     """Safely remove a file."""
     try:
@@ -12,3 +12,7 @@ INSERT_SIZE = 250
 IGNORE_GENE_NAMES = ("-", ".", "CGH")
 ANTITARGET_NAME = "Antitarget"
 ANTITARGET_ALIASES = (ANTITARGET_NAME, "Background")
+
+# Methods available to the 'segment' command
+SEGMENT_METHODS = ('cbs', 'flasso', 'haar', 'none',
+                   'hmm', 'hmm-tumor', 'hmm-germline')
@@ -67,6 +67,62 @@ def plot_chromosome_dividers(axis, chrom_sizes, pad=None, along='x'):
     return starts
 
 
+def plot_point_density(axis, x, y, color, alpha, zorder=None,
+                       marker_size=None):
+    """Draw many points as a raster image of their density.
+
+    Each point covers a disk of `marker_size` points in diameter -- by
+    default, the size of a '.' marker in a scatter plot -- and each pixel of
+    the image is as opaque as the stack of `alpha`-transparent points covering
+    it. The result resembles a scatter plot of the same points but costs the
+    same to draw and store however many points there are. The axis limits
+    must already be set.
+
+    Returns
+    -------
+    matplotlib.image.AxesImage
+    """
+    from matplotlib import rcParams
+    from matplotlib.colors import to_rgb
+    from scipy import ndimage
+    x_min, x_max = axis.get_xlim()
+    y_min, y_max = axis.get_ylim()
+    # One cell per pixel of the axis, at the figure's current size and DPI
+    bbox = axis.get_window_extent()
+    n_cols = max(1, int(round(bbox.width)))
+    n_rows = max(1, int(round(bbox.height)))
+    counts = np.histogram2d(y, x, bins=(n_rows, n_cols),
+                            range=((y_min, y_max), (x_min, x_max)))[0]
+    if marker_size is None:
+        # Scatter's default marker size, halved for the '.' marker
+        marker_size = .5 * rcParams['lines.markersize']
+    diameter = marker_size * axis.figure.dpi / 72
+    counts = ndimage.convolve(counts, _disk_kernel(diameter), mode='constant')
+    rgba = np.empty((n_rows, n_cols, 4))
+    rgba[..., :3] = to_rgb(color)
+    rgba[..., 3] = 1 - (1 - alpha) ** counts
+    image = axis.imshow(rgba, extent=(x_min, x_max, y_min, y_max),
+                        origin='lower', aspect='auto', interpolation='nearest',
+                        zorder=zorder)
+    # imshow may have nudged the limits to fit the image
+    axis.set_xlim(x_min, x_max)
+    axis.set_ylim(y_min, y_max)
+    return image
+
+
+def _disk_kernel(diameter, oversample=8):
+    """Fraction of each pixel covered by a disk centered on the middle pixel."""
+    radius = .5 * diameter
+    half_width = max(0, int(np.ceil(radius - .5)))
+    # Sample points spread evenly within each pixel
+    ticks = (np.arange(-half_width * oversample, (half_width + 1) * oversample)
+             + .5) / oversample - .5
+    is_inside = (ticks[:, None] ** 2 + ticks[None, :] ** 2) <= radius ** 2
+    n_pixels = 2 * half_width + 1
+    return (is_inside.reshape(n_pixels, oversample, n_pixels, oversample)
+            .mean(axis=(1, 3)))
+
+
 # ________________________________________
 # Internal supporting functions
 
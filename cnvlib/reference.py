@@ -1,16 +1,25 @@
 """Supporting functions for the 'reference' command."""
 import collections
+import json
 import logging
+import os
+import tempfile
 
 import numpy as np
 import pandas as pd
 import pyfaidx
 from skgenome import tabio, GenomicArray as GA
 
-from . import core, fix, descriptives, params
+from . import core, fix, descriptives, parallel, params
 from .cmdutil import read_cna
 from .cnary import CopyNumArray as CNA
 
+# Number of bins to summarize at once across all samples
+SUMMARY_BLOCK_SIZE = 20000
+# Max. size (samples x bins) of the pooled coverage matrices to keep in memory;
+# larger pools are memory-mapped from temporary files
+MAX_IN_MEMORY_CELLS = 5 * 10**7
+
 
 def do_reference_flat(targets, antitargets=None, fa_fname=None,
                       male_reference=False):
@@ -50,7 +59,7 @@ def bed2probes(bed_fname):
 def do_reference(target_fnames, antitarget_fnames=None, fa_fname=None,
                  male_reference=False, female_samples=None,
                  do_gc=True, do_edge=True, do_rmask=True, do_cluster=False,
-                 min_cluster_size=4):
+                 min_cluster_size=4, processes=1):
     """Compile a coverage reference from the given files (normal samples)."""
     if antitarget_fnames:
         core.assert_equal("Unequal number of target and antitarget files given",
@@ -60,37 +69,80 @@ def do_reference(target_fnames, antitarget_fnames=None, fa_fname=None,
         logging.info("No FASTA reference genome provided; "
                      "skipping GC, RM calculations")
 
-    if female_samples is None:
-        # NB: Antitargets are usually preferred for inferring sex, but might be
-        # empty files, in which case no inference can be done. Since targets are
-        # guaranteed to exist, infer from those first, then replace those
-        # values where antitargets are suitable.
-        sexes = infer_sexes(target_fnames, False)
-        if antitarget_fnames:
-            a_sexes = infer_sexes(antitarget_fnames, False)
-            for sid, a_is_xx in a_sexes.items():
-                t_is_xx = sexes.get(sid)
-                if t_is_xx is None:
-                    sexes[sid] = a_is_xx
-                elif t_is_xx != a_is_xx and a_is_xx is not None:
-                    logging.warning("Sample %s chromosomal X/Y ploidy looks "
-                                    "like %s in targets but %s in antitargets; "
-                                    "preferring antitargets",
-                                    sid,
-                                    "female" if t_is_xx else "male",
-                                    "female" if a_is_xx else "male")
-                    sexes[sid] = a_is_xx
-    else:
-        sexes = collections.defaultdict(lambda: female_samples)
-
     # TODO - refactor/inline this func here, once it works
     ref_probes = combine_probes(target_fnames, antitarget_fnames, fa_fname,
-                                male_reference, sexes, do_gc, do_edge, do_rmask,
-                                do_cluster, min_cluster_size)
+                                male_reference, female_samples, do_gc, do_edge,
+                                do_rmask, do_cluster, min_cluster_size,
+                                processes)
+    warn_bad_bins(ref_probes)
+    return ref_probes
+
+
+def do_reference_pool(pool_dir, target_fnames=None, antitarget_fnames=None,
+                      remove_samples=None, fa_fname=None, male_reference=False,
+                      female_samples=None, do_gc=True, do_edge=True,
+                      do_rmask=True, do_cluster=False, min_cluster_size=4,
+                      processes=1):
+    """Update a stored pool of normal samples, then compile its reference.
+
+    If the directory `pool_dir` exists, the given samples are added to that
+    pool and `remove_samples` (sample IDs) are dropped from it; otherwise a new
+    pool is created from the given samples. The updated pool is saved back to
+    `pool_dir`. Only the added samples are loaded and bias-corrected.
+    """
+    if os.path.exists(pool_dir):
+        logging.info("Loading normal pool %s", pool_dir)
+        pool = NormalPool.read(pool_dir)
+        if target_fnames:
+            pool.add(NormalPool.from_files(target_fnames, antitarget_fnames,
+                                           fa_fname, male_reference,
+                                           female_samples, do_gc, do_edge,
+                                           do_rmask, pool.fasta_stats(),
+                                           processes))
+    elif target_fnames:
+        if not fa_fname:
+            logging.info("No FASTA reference genome provided; "
+                         "skipping GC, RM calculations")
+        pool = NormalPool.from_files(target_fnames, antitarget_fnames,
+                                     fa_fname, male_reference, female_samples,
+                                     do_gc, do_edge, do_rmask,
+                                     processes=processes)
+    else:
+        raise ValueError("Normal pool %s does not exist yet; give the normal "
+                         "samples' .cnn files to create it" % pool_dir)
+    if remove_samples:
+        pool.remove(remove_samples)
+    pool.write(pool_dir)
+    ref_probes = pool.to_reference(do_cluster, min_cluster_size, processes)
     warn_bad_bins(ref_probes)
     return ref_probes
 
 
+def guess_sample_xx(target_cnarr, antitarget_cnarr=None):
+    """Infer a normal sample's chromosomal sex from its coverages.
+
+    Returns True if female, False if male, or None if it can't be inferred.
+    """
+    # NB: Antitargets are usually preferred for inferring sex, but might be
+    # empty files, in which case no inference can be done. Since targets are
+    # guaranteed to exist, infer from those first, then replace those
+    # values where antitargets are suitable.
+    t_is_xx = target_cnarr.guess_xx(False) if target_cnarr else None
+    if not antitarget_cnarr:
+        return t_is_xx
+    a_is_xx = antitarget_cnarr.guess_xx(False)
+    if a_is_xx is None:
+        return t_is_xx
+    if t_is_xx is not None and t_is_xx != a_is_xx:
+        logging.warning("Sample %s chromosomal X/Y ploidy looks "
+                        "like %s in targets but %s in antitargets; "
+                        "preferring antitargets",
+                        target_cnarr.sample_id,
+                        "female" if t_is_xx else "male",
+                        "female" if a_is_xx else "male")
+    return a_is_xx
+
+
 def infer_sexes(cnn_fnames, is_haploid_x):
     """Map sample IDs to inferred chromosomal sex, where possible.
 
@@ -108,8 +160,8 @@ def infer_sexes(cnn_fnames, is_haploid_x):
 
 
 def combine_probes(filenames, antitarget_fnames, fa_fname,
-                   is_haploid_x, sexes, fix_gc, fix_edge, fix_rmask,
-                   do_cluster, min_cluster_size):
+                   is_haploid_x, female_samples, fix_gc, fix_edge, fix_rmask,
+                   do_cluster, min_cluster_size, processes=1):
     """Calculate the median coverage of each bin across multiple samples.
 
     Parameters
@@ -122,10 +174,14 @@ def combine_probes(filenames, antitarget_fnames, fa_fname,
         Reference genome sequence in FASTA format, used to extract GC and
         RepeatMasker content of each genomic bin.
     is_haploid_x : bool
+    female_samples : bool or None
+        Chromosomal sex of all samples, or None to infer each sample's sex.
     do_cluster : bool
     fix_gc : bool
     fix_edge : bool
     fix_rmask : bool
+    processes : int
+        Number of processes to load and bias-correct samples in parallel.
 
     Returns
     -------
@@ -133,43 +189,55 @@ def combine_probes(filenames, antitarget_fnames, fa_fname,
         One object summarizing the coverages of the input samples, including
         each bin's "average" coverage, "spread" of coverages, and GC content.
     """
-    # Special parameters:
-    # skip_low (when centering) = True for target; False for antitarget
-    # do_edge  = as given for target; False for antitarget
-    # do_rmask  = False for target; as given for antitarget
-    ref_df, all_logr, all_depths = load_sample_block(
-        filenames, fa_fname, is_haploid_x, sexes,
-        True, fix_gc, fix_edge, False)
-    if antitarget_fnames:
-        # XXX TODO ensure ordering matches targets!
-        #   argsort on both -> same?
-        anti_ref_df, anti_logr, anti_depths = load_sample_block(
-            antitarget_fnames, fa_fname, is_haploid_x, sexes,
-            False, fix_gc, False, fix_rmask)
-        ref_df = ref_df.append(anti_ref_df, ignore_index=True, sort=False)
-        all_logr = np.hstack([all_logr, anti_logr])
-        all_depths = np.hstack([all_depths, anti_depths])
-
-    stats_all = summarize_info(all_logr, all_depths)
+    blocks, sample_ids = load_samples(filenames, antitarget_fnames, fa_fname,
+                                      is_haploid_x, female_samples, fix_gc,
+                                      fix_edge, fix_rmask, processes=processes)
+    return summarize_pool(blocks, sample_ids, do_cluster, min_cluster_size,
+                          processes)
+
+
+def summarize_pool(blocks, sample_ids, do_cluster, min_cluster_size,
+                   processes=1):
+    """Summarize the pooled samples' coverages into a reference.
+
+    Parameters
+    ----------
+    blocks : list
+        Target and (optional) antitarget bins, as the tuples returned by
+        `load_samples`.
+    sample_ids : list
+        Sample IDs of the rows of each block's log2 matrix, after the first
+        "flat" pseudocount row.
+    do_cluster : bool
+    min_cluster_size : int
+    processes : int
+
+    Returns
+    -------
+    CopyNumArray
+        The reference, with the summary stats of each bin.
+    """
+    ref_df = pd.concat([block[0] for block in blocks], ignore_index=True,
+                       sort=False)
+    block_stats = [summarize_info(logr, depths, processes)
+                   for _df, logr, depths in blocks]
+    stats_all = {key: np.concatenate([bstats[key] for bstats in block_stats])
+                 for key in block_stats[0]}
     ref_df = ref_df.assign(**stats_all)
 
     if do_cluster:
-        # Get extra cols, concat axis=1 here (DATAFRAME v-concat)
-        sample_ids = [core.fbase(f) for f in filenames]
-        if len(sample_ids) != len(all_logr) - 1:
+        logr_blocks = [logr for _df, logr, _d in blocks]
+        n_samples = len(logr_blocks[0]) - 1
+        if len(sample_ids) != n_samples:
             raise ValueError("Expected %d target coverage files (.cnn), got %d"
-                             % (len(all_logr) - 1, len(sample_ids)))
-        clustered_cols = create_clusters(all_logr, min_cluster_size, sample_ids)
+                             % (n_samples, len(sample_ids)))
+        clustered_cols = create_clusters(logr_blocks, min_cluster_size,
+                                         sample_ids, processes)
         if clustered_cols:
-            try:
-                ref_df = ref_df.assign(**clustered_cols)
-            except ValueError as exc:
-                print("Reference:", len(ref_df.index))
-                for cl_key, cl_col in clustered_cols.items():
-                    print(cl_key, ":", len(cl_col))
-                raise exc
+            ref_df = ref_df.assign(**clustered_cols)
         else:
-            print("** Why weren't there any clustered cols?")
+            logging.warning("No sample clusters of at least %d samples",
+                            min_cluster_size)
 
     ref_cna = CNA(ref_df, meta_dict={'sample_id': 'reference'})
     # NB: Up to this point, target vs. antitarget bins haven't been row-sorted.
@@ -184,32 +252,90 @@ def combine_probes(filenames, antitarget_fnames, fa_fname,
     return ref_cna
 
 
-def load_sample_block(filenames, fa_fname,
-                      is_haploid_x, sexes, skip_low,
-                      fix_gc, fix_edge, fix_rmask):
-    r"""Load and summarize a pool of \*coverage.cnn files.
+def load_samples(target_fnames, antitarget_fnames, fa_fname, is_haploid_x,
+                 female_samples, fix_gc, fix_edge, fix_rmask, fasta_stats=None,
+                 processes=1):
+    r"""Load and bias-correct a pool of \*coverage.cnn files.
 
-    Run separately for the on-target and (optional) antitarget bins.
+    Each sample's target and (optional) antitarget files are read once, to
+    infer the sample's chromosomal sex and correct its biases, with samples
+    processed in parallel. Their log2 ratios and depths are collected as
+    float32 in matrices that are kept on disk (memory-mapped) rather than in
+    memory when larger than `MAX_IN_MEMORY_CELLS`, so that a large pool only
+    needs to hold one block of bins across all samples at a time in
+    `summarize_info`.
+
+    If `fasta_stats` is given, as a dict of block name ('target' or
+    'antitarget') to a (GC, RepeatMasker) tuple of arrays for the bins, those
+    values are used instead of being recalculated from `fa_fname`.
 
     Returns
     -------
-    ref_df : pandas.DataFrame
-        All columns needed for the reference CNA object, including
-        aggregate log2 and spread.
-    all_logr : numpy.ndarray
-        All sample log2 ratios, as a 2D matrix (rows=bins, columns=samples),
-        to be used with do_cluster.
+    blocks : list
+        For the target bins, then antitarget bins if given, a tuple of:
+
+        - ref_df (pandas.DataFrame): All columns needed for the reference CNA
+          object, except the aggregate log2, depth and spread.
+        - all_logr (numpy.ndarray): All sample log2 ratios, as a 2D matrix
+          (rows=samples, columns=bins), to be used with do_cluster. The first
+          row is the "flat" pseudocount sample.
+        - all_depths (numpy.ndarray): All sample read depths, as a 2D matrix
+          (rows=samples, columns=bins).
+    sample_ids : list
+        Sample IDs of the matrix rows, after the pseudocount.
     """
     # Ensures samples' target and antitarget matrix columns are in the same
-    # order, so they can be concatenated.
-    # (We don't explicitly pair off each sample's target and antitarget .cnn
-    # files; as long as the filename prefixes match, the resulting columns will
-    # be consistent. Same is true for sample sex inference.)
-    filenames = sorted(filenames, key=core.fbase)
-
-    # Load coverage from target/antitarget files
-    logging.info("Loading %s", filenames[0])
-    cnarr1 = read_cna(filenames[0])
+    # order, so they can be concatenated, and pairs off each sample's target
+    # and antitarget .cnn files by filename prefix.
+    target_fnames = sorted(target_fnames, key=core.fbase)
+    antitarget_fnames = (sorted(antitarget_fnames, key=core.fbase)
+                         if antitarget_fnames else None)
+    fasta_stats = fasta_stats or {}
+    # Special parameters:
+    # skip_low (when centering) = True for target; False for antitarget
+    # do_edge  = as given for target; False for antitarget
+    # do_rmask  = False for target; as given for antitarget
+    setups = [_block_setup(target_fnames[0], fa_fname, is_haploid_x, True,
+                           fix_gc, fix_edge, False,
+                           fasta_stats.get('target'))]
+    if antitarget_fnames:
+        setups.append(_block_setup(antitarget_fnames[0], fa_fname,
+                                   is_haploid_x, False, fix_gc, False,
+                                   fix_rmask, fasta_stats.get('antitarget')))
+    blocks = []
+    for setup in setups:
+        n_bins = len(setup['ref_df'])
+        all_logr = _sample_matrix(len(target_fnames) + 1, n_bins)
+        all_depths = _sample_matrix(len(target_fnames), n_bins)
+        if setup['flat_logr'] is not None:
+            # Pseudocount of 1 "flat" sample
+            all_logr[0] = setup['flat_logr']
+        blocks.append((setup['ref_df'], all_logr, all_depths))
+
+    jobs = ((tgt_fname, anti_fname, setups, female_samples)
+            for tgt_fname, anti_fname
+            in zip(target_fnames,
+                   antitarget_fnames or [None] * len(target_fnames)))
+    with parallel.pick_pool(processes) as pool:
+        for i, results in enumerate(pool.map(_load_sample, jobs)):
+            for (_df, all_logr, all_depths), result in zip(blocks, results):
+                if result is not None:
+                    all_depths[i], all_logr[i + 1] = result
+    sample_ids = [core.fbase(f) for f in target_fnames]
+    return blocks, sample_ids
+
+
+def _block_setup(fname, fa_fname, is_haploid_x, skip_low, fix_gc, fix_edge,
+                 fix_rmask, fasta_stats):
+    """Bin information shared by all samples' target or antitarget files.
+
+    Read from the first sample's file; run separately for the on-target and
+    antitarget bins.
+    """
+    logging.info("Loading bins from %s", fname)
+    cnarr1 = read_cna(fname)
+    setup = {'fname': fname, 'skip_low': skip_low, 'fix_gc': fix_gc,
+             'fix_edge': fix_edge, 'fix_rmask': fix_rmask}
     if not len(cnarr1):
         # Just create an empty array with the right columns
         col_names = ['chromosome', 'start', 'end', 'gene', 'log2', 'depth']
@@ -218,10 +344,9 @@ def load_sample_block(filenames, fa_fname,
         if fa_fname:
             col_names.append('rmask')
         col_names.append('spread')
-        empty_df = pd.DataFrame.from_records([], columns=col_names)
-        empty_logr = np.array([[]] * (len(filenames) + 1))
-        empty_dp = np.array([[]] * len(filenames))
-        return empty_df, empty_logr, empty_dp
+        setup['ref_df'] = pd.DataFrame.from_records([], columns=col_names)
+        setup['flat_logr'] = None
+        return setup
 
     # Calculate GC and RepeatMasker content for each probe's genomic region
     ref_columns = {
@@ -230,51 +355,280 @@ def load_sample_block(filenames, fa_fname,
         'end': cnarr1.end,
         'gene': cnarr1['gene'],
     }
-    if fa_fname and (fix_rmask or fix_gc):
-        gc, rmask = get_fasta_stats(cnarr1, fa_fname)
-        if fix_gc:
+    if (fa_fname or fasta_stats) and (fix_rmask or fix_gc):
+        gc, rmask = fasta_stats or get_fasta_stats(cnarr1, fa_fname)
+        if fix_gc and gc is not None:
             ref_columns['gc'] = gc
-        if fix_rmask:
+        if fix_rmask and rmask is not None:
             ref_columns['rmask'] = rmask
     elif 'gc' in cnarr1 and fix_gc:
         # Reuse .cnn GC values if they're already stored (via import-picard)
         gc = cnarr1['gc']
         ref_columns['gc'] = gc
-
+    setup['ref_columns'] = ref_columns
+    setup['ref_df'] = pd.DataFrame.from_dict(ref_columns)
+    setup['bin_coords'] = cnarr1.data.loc[:, ('chromosome', 'start', 'end',
+                                              'gene')].values
     # Make the sex-chromosome coverages of male and female samples compatible
-    is_chr_x = (cnarr1.chromosome == cnarr1._chr_x_label)
-    is_chr_y = (cnarr1.chromosome == cnarr1._chr_y_label)
-    ref_flat_logr = cnarr1.expect_flat_log2(is_haploid_x)
-    ref_edge_bias = fix.get_edge_bias(cnarr1, params.INSERT_SIZE)
-    # Pseudocount of 1 "flat" sample
-    all_depths = [cnarr1['depth'] if 'depth' in cnarr1
-                  else np.exp2(cnarr1['log2'])]
-    all_logr = [
-        ref_flat_logr,
-        bias_correct_logr(cnarr1, ref_columns, ref_edge_bias,
-                          ref_flat_logr, sexes, is_chr_x, is_chr_y,
-                          fix_gc, fix_edge, fix_rmask, skip_low)]
-
-    # Load only coverage depths from the remaining samples
-    for fname in filenames[1:]:
+    setup['is_chr_x'] = (cnarr1.chromosome == cnarr1._chr_x_label)
+    setup['is_chr_y'] = (cnarr1.chromosome == cnarr1._chr_y_label)
+    setup['flat_logr'] = cnarr1.expect_flat_log2(is_haploid_x)
+    setup['edge_bias'] = fix.get_edge_bias(cnarr1, params.INSERT_SIZE)
+    return setup
+
+
+def _load_sample(args):
+    """Load and bias-correct one sample's target and antitarget coverages.
+
+    Returns
+    -------
+    list
+        For each block of bins, a tuple of the sample's (depths, log2 ratios)
+        as float32 arrays, or None if the block has no bins.
+    """
+    tgt_fname, anti_fname, setups, female_samples = args
+    fnames = [tgt_fname, anti_fname][:len(setups)]
+    cnarrs = []
+    for fname in fnames:
         logging.info("Loading %s", fname)
-        cnarrx = read_cna(fname)
+        cnarrs.append(read_cna(fname))
+    if female_samples is None:
+        is_xx = guess_sample_xx(*cnarrs)
+    else:
+        is_xx = female_samples
+
+    results = []
+    for fname, cnarr, setup in zip(fnames, cnarrs, setups):
+        if setup['flat_logr'] is None:
+            results.append(None)
+            continue
         # Bin information should match across all files
         if not np.array_equal(
-                cnarr1.data.loc[:, ('chromosome', 'start', 'end', 'gene')].values,
-                cnarrx.data.loc[:, ('chromosome', 'start', 'end', 'gene')].values):
+                setup['bin_coords'],
+                cnarr.data.loc[:, ('chromosome', 'start', 'end', 'gene')
+                              ].values):
             raise RuntimeError("%s bins do not match those in %s"
-                               % (fname, filenames[0]))
-        all_depths.append(cnarrx['depth'] if 'depth' in cnarrx
-                          else np.exp2(cnarrx['log2']))
-        all_logr.append(
-            bias_correct_logr(cnarrx, ref_columns, ref_edge_bias, ref_flat_logr,
-                              sexes, is_chr_x, is_chr_y,
-                              fix_gc, fix_edge, fix_rmask, skip_low))
-    all_logr = np.vstack(all_logr)
-    all_depths = np.vstack(all_depths)
-    ref_df = pd.DataFrame.from_dict(ref_columns)
-    return ref_df, all_logr, all_depths
+                               % (fname, setup['fname']))
+        depths = (cnarr['depth'] if 'depth' in cnarr
+                  else np.exp2(cnarr['log2']))
+        logr = bias_correct_logr(cnarr, setup['ref_columns'],
+                                 setup['edge_bias'], setup['flat_logr'],
+                                 {cnarr.sample_id: is_xx},
+                                 setup['is_chr_x'], setup['is_chr_y'],
+                                 setup['fix_gc'], setup['fix_edge'],
+                                 setup['fix_rmask'], setup['skip_low'])
+        results.append((np.asarray(depths, dtype=np.float32),
+                        np.asarray(logr, dtype=np.float32)))
+    return results
+
+
+def _sample_matrix(n_samples, n_bins):
+    """Allocate a samples-by-bins matrix, on disk if it's too big for memory.
+
+    The backing temporary file is deleted once the array is released.
+    """
+    if n_samples * n_bins <= MAX_IN_MEMORY_CELLS:
+        return np.zeros((n_samples, n_bins), dtype=np.float32)
+    return np.memmap(tempfile.TemporaryFile(prefix="cnvkit-reference."),
+                     dtype=np.float32, mode='w+', shape=(n_samples, n_bins))
+
+
+class NormalPool(object):
+    """Bias-corrected coverages of a pool of normal samples.
+
+    This keeps each sample's log2 ratios and depths as computed by
+    `load_samples`, before summarizing them across samples, so that
+    samples can be added to or removed from a pooled reference without
+    reloading and correcting all the others. It's saved as a directory of
+    NumPy .npy files, with the coverages stored as float32 matrices that are
+    memory-mapped when read, so only a block of bins at a time needs to be in
+    memory.
+
+    Attributes
+    ----------
+    options : dict
+        The reference options the samples' bias corrections depend on.
+    sample_ids : list
+    blocks : list
+        Target and (optional) antitarget bins, as tuples of (bin table, log2
+        matrix, depth matrix) in the form returned by `load_samples`.
+    """
+    _bin_columns = ('chromosome', 'start', 'end', 'gene', 'gc', 'rmask')
+    _block_names = ('target', 'antitarget')
+
+    def __init__(self, options, sample_ids, blocks):
+        self.options = options
+        self.sample_ids = list(sample_ids)
+        self.blocks = blocks
+
+    def __len__(self):
+        return len(self.sample_ids)
+
+    @classmethod
+    def from_files(cls, target_fnames, antitarget_fnames=None, fa_fname=None,
+                   male_reference=False, female_samples=None, do_gc=True,
+                   do_edge=True, do_rmask=True, fasta_stats=None, processes=1):
+        """Load and bias-correct normal samples' .cnn files into a pool.
+
+        Bin GC and RepeatMasker content can be given as `fasta_stats`, a dict
+        of block name to (GC, RepeatMasker) arrays, instead of being
+        calculated from `fa_fname`.
+        """
+        if antitarget_fnames:
+            core.assert_equal("Unequal number of target and antitarget files "
+                              "given",
+                              targets=len(target_fnames),
+                              antitargets=len(antitarget_fnames))
+        blocks, sample_ids = load_samples(target_fnames, antitarget_fnames,
+                                          fa_fname, male_reference,
+                                          female_samples, do_gc, do_edge,
+                                          do_rmask, fasta_stats, processes)
+        options = {'male_reference': bool(male_reference),
+                   'do_gc': bool(do_gc),
+                   'do_edge': bool(do_edge),
+                   'do_rmask': bool(do_rmask)}
+        return cls(options, sample_ids,
+                   [(ref_df.loc[:, [c for c in cls._bin_columns
+                                    if c in ref_df]],
+                     logr, depths)
+                    for ref_df, logr, depths in blocks])
+
+    @classmethod
+    def read(cls, dirname):
+        """Load a pool from a directory written by `write`.
+
+        The log2 and depth matrices are memory-mapped, not read into memory.
+        """
+        with open(os.path.join(dirname, 'pool.json')) as handle:
+            info = json.load(handle)
+        blocks = []
+        for name in info['blocks']:
+            bins = pd.DataFrame.from_dict(collections.OrderedDict(
+                (col, np.load(os.path.join(dirname, name + '_' + col + '.npy')))
+                for col in info['bin_columns']))
+            blocks.append((bins,
+                           np.load(os.path.join(dirname, name + '_log2.npy'),
+                                   mmap_mode='r'),
+                           np.load(os.path.join(dirname, name + '_depth.npy'),
+                                   mmap_mode='r')))
+        return cls(info['options'], info['sample_ids'], blocks)
+
+    def write(self, dirname):
+        """Save the pool to a directory of .npy files.
+
+        Each file is written under a temporary name and then moved into
+        place, so a pool can be saved over the directory it was read from.
+        """
+        if not os.path.isdir(dirname):
+            os.mkdir(dirname)
+            logging.info("Created directory %s", dirname)
+        block_names = self._block_names[:len(self.blocks)]
+        for name, (bins, logr, depths) in zip(block_names, self.blocks):
+            for col in bins.columns:
+                values = bins[col].values
+                if values.dtype == np.object_:
+                    values = values.astype(np.str_)
+                _save_npy(os.path.join(dirname, name + '_' + col + '.npy'),
+                          values)
+            _save_npy(os.path.join(dirname, name + '_log2.npy'), logr)
+            _save_npy(os.path.join(dirname, name + '_depth.npy'), depths)
+        info = {'options': self.options,
+                'sample_ids': self.sample_ids,
+                'blocks': block_names,
+                'bin_columns': list(self.blocks[0][0].columns)}
+        json_fname = os.path.join(dirname, 'pool.json')
+        with open(json_fname + '.tmp', 'w') as handle:
+            json.dump(info, handle, indent=1)
+        os.replace(json_fname + '.tmp', json_fname)
+        logging.info("Wrote %s with %d samples", dirname, len(self))
+
+    def fasta_stats(self):
+        """Each block's stored (GC, RepeatMasker) content, where available."""
+        return {name: tuple(bins[col].values if col in bins else None
+                            for col in ('gc', 'rmask'))
+                for name, (bins, _l, _d) in zip(self._block_names, self.blocks)
+                if 'gc' in bins or 'rmask' in bins}
+
+    def add(self, other):
+        """Add the samples of another pool to this one, in place.
+
+        Samples already in this pool are replaced by the new ones.
+        """
+        if other.options != self.options:
+            raise ValueError("Reference options %s do not match the existing "
+                             "pool's options %s" % (other.options, self.options))
+        if len(other.blocks) != len(self.blocks):
+            raise ValueError("Antitargets must be given for both or neither "
+                             "of the new samples and the existing pool")
+        for (bins, _l, _d), (obins, _ol, _od) in zip(self.blocks, other.blocks):
+            if not np.array_equal(
+                    bins.loc[:, ('chromosome', 'start', 'end', 'gene')].values,
+                    obins.loc[:, ('chromosome', 'start', 'end', 'gene')].values):
+                raise ValueError("New samples' bins do not match the existing "
+                                 "pool's bins")
+        is_replaced = np.isin(self.sample_ids, other.sample_ids)
+        if is_replaced.any():
+            logging.info("Replacing samples: %s",
+                         ", ".join(np.array(self.sample_ids)[is_replaced]))
+        # Keep the existing "flat" pseudocount row
+        kept = np.flatnonzero(~is_replaced)
+        self.blocks = [
+            (bins,
+             _stack_rows([(logr, np.r_[0, kept + 1]),
+                          (ologr, np.arange(1, len(ologr)))]),
+             _stack_rows([(depths, kept),
+                          (odepths, np.arange(len(odepths)))]))
+            for (bins, logr, depths), (_ob, ologr, odepths)
+            in zip(self.blocks, other.blocks)]
+        self.sample_ids = ([sid for sid, rep
+                            in zip(self.sample_ids, is_replaced) if not rep]
+                           + other.sample_ids)
+        logging.info("Added %d samples to the pool", len(other))
+
+    def remove(self, sample_ids):
+        """Remove the given samples from the pool, in place."""
+        missing = set(sample_ids).difference(self.sample_ids)
+        if missing:
+            raise ValueError("Samples not in the pool: %s"
+                             % ", ".join(sorted(missing)))
+        is_kept = ~np.isin(self.sample_ids, list(sample_ids))
+        if not is_kept.any():
+            raise ValueError("Can't remove every sample from the pool")
+        kept = np.flatnonzero(is_kept)
+        self.blocks = [(bins, _stack_rows([(logr, np.r_[0, kept + 1])]),
+                        _stack_rows([(depths, kept)]))
+                       for bins, logr, depths in self.blocks]
+        self.sample_ids = [sid for sid, keep in zip(self.sample_ids, is_kept)
+                           if keep]
+        logging.info("Removed %d samples from the pool", len(sample_ids))
+
+    def to_reference(self, do_cluster=False, min_cluster_size=4, processes=1):
+        """Summarize the pooled samples into a reference."""
+        return summarize_pool(self.blocks, self.sample_ids, do_cluster,
+                              min_cluster_size, processes)
+
+
+def _stack_rows(parts):
+    """Stack the selected rows of sample matrices, a block of bins at a time.
+
+    `parts` is a list of (matrix, row indices) pairs with the same bins. The
+    result is memory-mapped from a temporary file if large, as in
+    `load_samples`.
+    """
+    n_bins = parts[0][0].shape[1]
+    result = _sample_matrix(sum(len(rows) for _m, rows in parts), n_bins)
+    for start in range(0, n_bins, SUMMARY_BLOCK_SIZE):
+        end = start + SUMMARY_BLOCK_SIZE
+        result[:, start:end] = np.concatenate(
+            [matrix[rows, start:end] for matrix, rows in parts])
+    return result
+
+
+def _save_npy(fname, array):
+    """Write an array to an .npy file, replacing the file only when done."""
+    with open(fname + '.tmp', 'wb') as outfile:
+        np.save(outfile, array)
+    os.replace(fname + '.tmp', fname)
 
 
 def bias_correct_logr(cnarr, ref_columns, ref_edge_bias,
@@ -289,15 +643,18 @@ def bias_correct_logr(cnarr, ref_columns, ref_edge_bias,
         logging.warning("WARNING: most bins have no or very low coverage; "
                         "check that the right BED file was used")
     else:
+        bias_keys = []
         if 'gc' in ref_columns and fix_gc:
             logging.info("Correcting for GC bias...")
-            cnarr = fix.center_by_window(cnarr, .1, ref_columns['gc'])
+            bias_keys.append(ref_columns['gc'])
         if 'rmask' in ref_columns and fix_rmask:
             logging.info("Correcting for RepeatMasker bias...")
-            cnarr = fix.center_by_window(cnarr, .1, ref_columns['rmask'])
+            bias_keys.append(ref_columns['rmask'])
         if fix_edge:
             logging.info("Correcting for density bias...")
-            cnarr = fix.center_by_window(cnarr, .1, ref_edge_bias)
+            bias_keys.append(ref_edge_bias)
+        if bias_keys:
+            cnarr = fix.center_by_windows(cnarr, .1, bias_keys)
     return cnarr['log2']
 
 
@@ -333,20 +690,31 @@ def shift_sex_chroms(cnarr, sexes, ref_flat_logr, is_chr_x, is_chr_y):
         cnarr[is_chr_x | is_chr_y, 'log2'] += 1.0
 
 
-def summarize_info(all_logr, all_depths):
+def summarize_info(all_logr, all_depths, processes=1, rows=None):
     """Average & spread of log2ratios and depths for a group of samples.
 
-    Can apply to all samples, or a given cluster of samples.
-    """
-    logging.info("Calculating average bin coverages")
-    cvg_centers = np.apply_along_axis(descriptives.biweight_location, 0,
-                                      all_logr)
-    depth_centers = np.apply_along_axis(descriptives.biweight_location, 0,
-                                        all_depths)
-    logging.info("Calculating bin spreads")
-    spreads = np.array([descriptives.biweight_midvariance(a, initial=i)
-                        for a, i in zip(all_logr.T, cvg_centers)])
+    Can apply to all samples, or a given cluster of samples (`rows`).
 
+    Bins are summarized in blocks of `SUMMARY_BLOCK_SIZE` at a time, with all
+    samples in each block handled together, optionally in parallel.
+    """
+    logging.info("Calculating average bin coverages and spreads")
+    n_bins = all_logr.shape[1]
+    block_starts = range(0, n_bins, SUMMARY_BLOCK_SIZE)
+    jobs = ((all_logr[:, start:start+SUMMARY_BLOCK_SIZE],
+             all_depths[:, start:start+SUMMARY_BLOCK_SIZE]
+             if len(all_depths) else None,
+             rows)
+            for start in block_starts)
+    with parallel.pick_pool(processes) as pool:
+        # Only read a few blocks ahead of the workers, so memory-mapped
+        # matrices are streamed rather than copied to the workers all at once
+        blocks = list(parallel.map_ahead(pool, _summarize_block, jobs,
+                                         processes))
+    if blocks:
+        cvg_centers, depth_centers, spreads = map(np.concatenate, zip(*blocks))
+    else:
+        cvg_centers = depth_centers = spreads = np.array([])
     result = {
         'log2': cvg_centers,
         'depth': depth_centers,
@@ -358,11 +726,28 @@ def summarize_info(all_logr, all_depths):
     return result
 
 
-def create_clusters(logr_matrix, min_cluster_size, sample_ids):
-    """Extract and summarize clusters of samples in logr_matrix.
+def _summarize_block(args):
+    """Summarize one block of bins (columns) across all samples (rows)."""
+    logr, depths, rows = args
+    if rows is not None:
+        logr = logr[rows]
+        if depths is not None:
+            depths = depths[rows]
+    cvg_centers = descriptives.biweight_location_cols(logr)
+    if depths is None:
+        depth_centers = np.repeat(np.nan, logr.shape[1])
+    else:
+        depth_centers = descriptives.biweight_location_cols(depths)
+    spreads = descriptives.biweight_midvariance_cols(logr, initial=cvg_centers)
+    return cvg_centers, depth_centers, spreads
+
+
+def create_clusters(logr_blocks, min_cluster_size, sample_ids, processes=1):
+    """Extract and summarize clusters of samples in logr_blocks.
 
-    1. Calculate correlation coefficients between all samples (columns).
-    2. Cluster the correlation matrix.
+    1. Project the samples onto their principal components, using a subsample
+       of bins (see `cluster.sketch_bins`).
+    2. Cluster the samples in that space.
     3. For each resulting sample cluster (down to a minimum size threshold),
        calculate the central log2 value for each bin, similar to the full pool.
        Also print the sample IDs in each cluster, if feasible.
@@ -370,20 +755,26 @@ def create_clusters(logr_matrix, min_cluster_size, sample_ids):
     Also recalculate and store the 'spread' of each cluster, though this might
     not be necessary/good.
 
-    Return a DataFrame of just the log2 values. Column names are ``log2_i``
-    where i=1,2,... .
+    Parameters
+    ----------
+    logr_blocks : list of 2D arrays
+        Log2 ratios of each block of bins (e.g. targets and antitargets),
+        with samples as rows, after a first "flat" pseudocount row.
+
+    Return a dict of the log2 and spread columns. Column names are ``log2_i``
+    and ``spread_i`` where i=1,2,... .
     """
-    from .cluster import markov, kmeans
+    from .cluster import kmeans, sketch_bins
     # Drop the pseudocount sample
-    logr_matrix = logr_matrix[1:, :]
-    print("Clustering", len(logr_matrix), "samples...")
-    #clusters = markov(logr_matrix)
-    clusters = kmeans(logr_matrix)
+    sketch = sketch_bins(logr_blocks, skip_rows=1)
+    logging.info("Clustering %d samples on %d bins...",
+                 len(sketch), sketch.shape[1])
+    #clusters = markov(sketch)
+    clusters = kmeans(sketch)
     cluster_cols = {}
     sample_ids = np.array(sample_ids)  # For easy indexing
     for i, clust_idx in enumerate(clusters):
         i += 1
-        #print(len(clust_idx), clust_idx)
         if len(clust_idx) < min_cluster_size:
             logging.info("Skipping cluster #%d, size %d < min. %d",
                          i, len(clust_idx), min_cluster_size)
@@ -393,13 +784,15 @@ def create_clusters(logr_matrix, min_cluster_size, sample_ids):
         # List which samples are in each cluster
         samples = sample_ids[clust_idx]
         logging.info("\n".join(["\t" + s for s in samples]))
-        # Calculate each cluster's summary stats
-        clust_matrix = logr_matrix[clust_idx, :]
+        # Calculate each cluster's summary stats, one block of bins at a time
         # XXX re-add the pseudocount sample to each cluster? need benchmark
-        clust_info = summarize_info(clust_matrix, [])
+        clust_info = [summarize_info(logr, [], processes, rows=clust_idx + 1)
+                      for logr in logr_blocks]
         cluster_cols.update({
-            'log2_%d' % i: clust_info['log2'],
-            'spread_%d' % i: clust_info['spread'],
+            'log2_%d' % i: np.concatenate([info['log2']
+                                           for info in clust_info]),
+            'spread_%d' % i: np.concatenate([info['spread']
+                                             for info in clust_info]),
         })
     return cluster_cols
 
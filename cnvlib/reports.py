@@ -8,9 +8,9 @@ import sys
 
 import numpy as np
 import pandas as pd
+from skgenome.intersect import idx_ranges
 
 from . import params
-from .segmetrics import segment_mean
 
 
 # _____________________________________________________________________________
@@ -88,13 +88,11 @@ def do_genemetrics(cnarr, segments=None, threshold=0.2, min_probes=3,
     cnarr = cnarr.shift_xx(male_reference, is_sample_female)
     if segments:
         segments = segments.shift_xx(male_reference, is_sample_female)
-        rows = gene_metrics_by_segment(cnarr, segments, threshold, skip_low)
+        table = gene_metrics_by_segment(cnarr, segments, threshold, skip_low)
     else:
-        rows = gene_metrics_by_gene(cnarr, threshold, skip_low)
-    rows = list(rows)
-    columns = (rows[0].index if len(rows) else cnarr._required_columns)
-    columns = ["gene"] + [col for col in columns if col != "gene"]
-    table = pd.DataFrame.from_records(rows).reindex(columns=columns)
+        table = gene_metrics_by_gene(cnarr, threshold, skip_low)
+    columns = ["gene"] + [col for col in table.columns if col != "gene"]
+    table = table.reindex(columns=columns)
     if min_probes and len(table):
         n_probes = (table.segment_probes
                     if 'segment_probes' in table.columns
@@ -106,12 +104,13 @@ def do_genemetrics(cnarr, segments=None, threshold=0.2, min_probes=3,
 def gene_metrics_by_gene(cnarr, threshold, skip_low=False):
     """Identify genes where average bin copy ratio value exceeds `threshold`.
 
+    Returns a table of genes, as from `summarize_genes`.
+
     NB: Adjust the sample's sex-chromosome log2 values beforehand with shift_xx,
     otherwise all chrX/chrY genes may be reported gained/lost.
     """
-    for row in group_by_genes(cnarr, skip_low):
-        if abs(row.log2) >= threshold and row.gene:
-            yield row
+    table = summarize_genes(cnarr, skip_low)
+    return table[table['log2'].abs() >= threshold].reset_index(drop=True)
 
 
 def gene_metrics_by_segment(cnarr, segments, threshold, skip_low=False):
@@ -126,47 +125,115 @@ def gene_metrics_by_segment(cnarr, segments, threshold, skip_low=False):
     extra_cols = [col for col in segments.data.columns
                   if col not in cnarr.data.columns
                   and col not in ('depth', 'probes', 'weight')]
+    segdata = segments.data[segments.data['log2'].abs() >= threshold]
+    segdata = segdata.reset_index(drop=True)
+    # Gather each segment's bins, in order, and summarize genes within each
+    bin_rows, seg_ids = _segment_bin_rows(cnarr, segdata)
+    subdata = cnarr.data.iloc[bin_rows].assign(_segment_=seg_ids)
     for colname in extra_cols:
-        cnarr[colname] = np.nan
-    for segment, subprobes in cnarr.by_ranges(segments):
-        if abs(segment.log2) >= threshold:
-            for row in group_by_genes(subprobes, skip_low):
-                row["log2"] = segment.log2
-                if hasattr(segment, 'weight'):
-                    row['segment_weight'] = segment.weight
-                if hasattr(segment, 'probes'):
-                    row['segment_probes'] = segment.probes
-                for colname in extra_cols:
-                    row[colname] = getattr(segment, colname)
-                yield row
-
-
-# ENH consolidate with CNA.squash_genes
-def group_by_genes(cnarr, skip_low):
-    """Group probe and coverage data by gene.
+        subdata[colname] = np.nan
+    table = summarize_genes(cnarr.as_dataframe(subdata), skip_low,
+                            blocks=seg_ids)
+    seg_rows = segdata.iloc[table.pop('_segment_').values]
+    table["log2"] = seg_rows['log2'].values
+    if 'weight' in segdata:
+        table['segment_weight'] = seg_rows['weight'].values
+    if 'probes' in segdata:
+        table['segment_probes'] = seg_rows['probes'].values
+    for colname in extra_cols:
+        table[colname] = seg_rows[colname].values
+    return table
 
-    Return an iterable of genes, in chromosomal order, associated with their
-    location and coverages:
 
-        [(gene, chrom, start, end, [coverages]), ...]
+def _segment_bin_rows(cnarr, segdata):
+    """Row positions of the bins in each segment, as in `by_ranges`.
+
+    Returns the concatenated row positions, and the segment number of each.
     """
-    ignore = ('', np.nan) + params.ANTITARGET_ALIASES
-    for gene, rows in cnarr.by_gene():
-        if not rows or gene in ignore:
-            continue
-        segmean = segment_mean(rows, skip_low)
-        if segmean is None:
+    chrom_rows = cnarr.data.groupby('chromosome', sort=False).indices
+    bin_rows = []
+    seg_ids = []
+    for chrom, segrows in segdata.groupby('chromosome', sort=False):
+        if chrom not in chrom_rows:
             continue
-        outrow = rows[0].copy()
-        outrow["end"] = rows.end.iat[-1]
-        outrow["gene"] = gene
-        outrow["log2"] = segmean
-        outrow["probes"] = len(rows)
-        if "weight" in rows:
-            outrow["weight"] = rows["weight"].sum()
-            if "depth" in rows:
-                outrow["depth"] = np.average(rows["depth"],
-                                             weights=rows["weight"])
-        elif "depth" in rows:
-            outrow["depth"] = rows["depth"].mean()
-        yield outrow
+        rows = chrom_rows[chrom]
+        subranges = idx_ranges(cnarr.data.iloc[rows], segrows['start'],
+                               segrows['end'], 'outer')
+        for seg_id, (region_idx, _s, _e) in zip(segrows.index, subranges):
+            bin_rows.append(rows[region_idx])
+            seg_ids.append(np.repeat(seg_id, len(bin_rows[-1])))
+    if not bin_rows:
+        return np.zeros(0, dtype=np.int_), np.zeros(0, dtype=np.int_)
+    return np.concatenate(bin_rows), np.concatenate(seg_ids)
+
+
+def summarize_genes(cnarr, skip_low=False, blocks=None):
+    """Group probe and coverage data by gene.
+
+    Genes' bins are located as in `CopyNumArray.by_gene`, and the rows of each
+    are reduced at once. `blocks` is passed to `CopyNumArray.gene_runs`.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per gene, in chromosomal order: the gene's first bin, with the
+        gene's name, end position, number of bins ("probes"), average log2
+        value (as in `segment_mean`), and total weight and average depth.
+    """
+    names, starts, ends = cnarr.gene_runs(blocks=blocks)
+    is_gene = ~np.isin(names, ('',) + params.ANTITARGET_ALIASES)
+    names = names[is_gene]
+    starts = starts[is_gene]
+    ends = ends[is_gene]
+    data = cnarr.data
+    table = data.iloc[starts].reset_index(drop=True)
+    table["end"] = data["end"].values[ends - 1]
+    table["gene"] = names
+
+    log2 = data['log2'].values
+    if skip_low:
+        # As in drop_low_coverage
+        is_used = (log2 >= params.NULL_LOG2_COVERAGE - params.MIN_REF_COVERAGE)
+        if 'depth' in data:
+            is_used &= (data['depth'].values != 0)
+    else:
+        is_used = np.ones(len(data), dtype=np.bool_)
+    is_valid = is_used & ~np.isnan(log2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        log2_mean = (_run_sums(np.where(is_valid, log2, 0.), starts, ends)
+                     / _run_sums(is_valid, starts, ends))
+        if 'weight' in data:
+            weight = np.where(is_used, data['weight'].values, 0.)
+            is_weighted = (_run_sums(weight != 0, starts, ends) > 0)
+            log2_mean = np.where(
+                is_weighted,
+                _run_sums(np.where(is_used, weight * log2, 0.), starts, ends)
+                / _run_sums(weight, starts, ends),
+                log2_mean)
+    table["log2"] = log2_mean
+    table["probes"] = ends - starts
+    if "weight" in data:
+        weight = data["weight"].values
+        table["weight"] = _run_sums(weight, starts, ends)
+        if "depth" in data:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                table["depth"] = (
+                    _run_sums(data["depth"].values * weight, starts, ends)
+                    / table["weight"].values)
+    elif "depth" in data:
+        depth = data["depth"].values
+        is_valid = ~np.isnan(depth)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            table["depth"] = (
+                _run_sums(np.where(is_valid, depth, 0.), starts, ends)
+                / _run_sums(is_valid, starts, ends))
+    return table
+
+
+def _run_sums(values, starts, ends):
+    """Sum of each run ``values[start:end]``; runs may overlap."""
+    if not len(starts):
+        return np.zeros(0)
+    values = np.append(np.asarray(values, dtype=np.float_), 0.)
+    bounds = np.ravel(np.column_stack((starts, ends)))
+    return np.add.reduceat(values, bounds)[::2]
@@ -9,7 +9,7 @@ import pandas as pd
 from scipy.stats import gmean
 
 from .cnary import CopyNumArray as CNA
-from .fix import center_by_window
+from .fix import center_by_windows
 
 
 NULL_LOG2_COVERAGE = -5
@@ -400,10 +400,13 @@ def correct_cnr(cnr, do_gc, do_txlen, max_log2):
     cnr.center_all()
     # Biases, similar to stock CNVkit
     if any((do_gc, do_txlen)):
+        bias_keys = []
         if do_gc and 'gc' in cnr:
-            cnr = center_by_window(cnr, .1, cnr['gc'])
+            bias_keys.append(cnr['gc'].values)
         if do_txlen and 'tx_length' in cnr:
-            cnr = center_by_window(cnr, .1, cnr['tx_length'])
+            bias_keys.append(cnr['tx_length'].values)
+        if bias_keys:
+            cnr = center_by_windows(cnr, .1, bias_keys)
         cnr.center_all()
     if max_log2:
         cnr[cnr['log2'] > max_log2, 'log2'] = max_log2
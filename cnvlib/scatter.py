@@ -1,12 +1,14 @@
 """The 'scatter' command for rendering copy number as scatter plots."""
 import collections
 import logging
+import os
 
 import numpy as np
 from matplotlib import pyplot
-from skgenome.rangelabel import unpack_range
+from matplotlib.collections import LineCollection
+from skgenome.rangelabel import Region, to_label, unpack_range
 
-from . import core, params, plots
+from . import core, parallel, params, plots
 from .plots import MB
 from .cnary import CopyNumArray as CNA
 
@@ -20,25 +22,148 @@ def do_scatter(cnarr, segments=None, variants=None,
                show_range=None, show_gene=None, do_trend=False, by_bin=False,
                window_width=1e6, y_min=None, y_max=None, fig_size=None,
                antitarget_marker=None, segment_color=SEG_COLOR, title=None,
-              ):
-    """Plot probe log2 coverages and segmentation calls together."""
+               density=False):
+    """Plot probe log2 coverages and segmentation calls together.
+
+    With `density`, genome-wide plots draw bins and SNVs as a raster of point
+    density instead of individual points, which is much faster for large
+    (e.g. WGS) inputs.
+    """
     if by_bin:
-        bp_per_bin = (sum(c.end.iat[-1] for _, c in cnarr.by_chromosome())
-                     / len(cnarr))
-        window_width /= bp_per_bin
-        show_range_bins = plots.translate_region_to_bins(show_range, cnarr)
+        window_width /= _bp_per_bin(cnarr)
+        if show_range:
+            show_range = plots.translate_region_to_bins(show_range, cnarr)
         cnarr, segments, variants = plots.update_binwise_positions(
             cnarr, segments, variants)
+    return _draw_scatter(cnarr, segments, variants, show_range, show_gene,
+                         do_trend, by_bin, window_width, y_min, y_max,
+                         fig_size, antitarget_marker, segment_color, title,
+                         density)
+
+
+def do_scatter_pages(cnarr, segments=None, variants=None, regions=(),
+                     output=None, output_dir=None, title=None, processes=1,
+                     by_bin=False, window_width=1e6, **kwargs):
+    """Plot each of several chromosomal regions on a separate page.
+
+    The inputs are split by chromosome (and with `by_bin`, converted to
+    bin-wise positions) once, rather than again for each region. Pages are
+    written to `output` as a multi-page PDF, in this process; or to
+    `output_dir` as one PNG file per region, rendered in `processes` parallel
+    processes.
+
+    Parameters
+    ----------
+    regions : GenomicArray
+        The regions to plot. Each region's file in `output_dir` is named for
+        its 'gene', if the regions have names, or else its coordinates.
+    output : str
+        Multi-page PDF file name.
+    output_dir : str
+        Directory to write PNG files in, if `output` is not given.
+    title : str
+        Page title, followed by each region's chromosome name.
+        [Default: sample ID]
+    kwargs
+        Other plotting options, as for `do_scatter`.
+
+    Returns
+    -------
+    list
+        Names of the files written.
+    """
+    sample_id = (cnarr or segments or variants).sample_id
+    if title is None:
+        title = sample_id
+    regions = list(regions.coords(['gene'] if 'gene' in regions else ()))
+    if by_bin:
+        window_width /= _bp_per_bin(cnarr)
+        orig_cnarr = _split_chromosomes(cnarr)
+        show_ranges = [
+            plots.translate_region_to_bins(region,
+                                           orig_cnarr[region.chromosome])
+            for region in regions]
+        cnarr, segments, variants = plots.update_binwise_positions(
+            cnarr, segments, variants)
+    else:
+        show_ranges = [Region(*region[:3]) for region in regions]
+    chrom_arrays = [_split_chromosomes(arr)
+                    for arr in (cnarr, segments, variants)]
+    kwargs.update(by_bin=by_bin, window_width=window_width)
+
+    # Group the pages by chromosome, so each chromosome's data is only sent to
+    # the processes plotting it
+    chrom_pages = collections.OrderedDict()
+    used_names = set()
+    for region, show_range in zip(regions, show_ranges):
+        page_title = "%s %s" % (title, region.chromosome)
+        if output:
+            fname = None
+        else:
+            name = getattr(region, 'gene', None)
+            if not name or name in params.IGNORE_GENE_NAMES:
+                name = "%s_%d-%d" % (region.chromosome, region.start + 1,
+                                     region.end)
+            while name in used_names:
+                name += "_"
+            used_names.add(name)
+            fname = os.path.join(output_dir, "%s-%s.png" % (sample_id, name))
+        chrom_pages.setdefault(region.chromosome, []).append(
+            (show_range, page_title, fname))
+
+    if output:
+        from matplotlib.backends.backend_pdf import PdfPages
+        with PdfPages(output) as pdf_out:
+            for chrom, pages in chrom_pages.items():
+                arrays = [arrs[chrom] for arrs in chrom_arrays]
+                for show_range, page_title, _fname in pages:
+                    try:
+                        fig = _draw_scatter_page(arrays, show_range,
+                                                 page_title, kwargs)
+                    except ValueError as exc:
+                        # Probably no bins in the selected region
+                        logging.warning("Not plotting region %r: %s",
+                                        to_label(show_range), exc)
+                        # Keep the page, so pages still match the regions
+                        fig = pyplot.gcf()
+                    pdf_out.savefig(fig)
+                    pyplot.close(fig)
+        logging.info("Wrote %s", output)
+        return [output]
+
+    results = []
+    with parallel.pick_pool(processes) as pool:
+        for chrom, pages in chrom_pages.items():
+            arrays = [arrs[chrom] for arrs in chrom_arrays]
+            for chunk in _chunk_pages(pages, len(regions), processes):
+                results.append(pool.submit(_write_scatter_pages, arrays,
+                                           chunk, kwargs))
+    fnames = [fname for result in results for fname in result.result()]
+    logging.info("Wrote %d plots to %s", len(fnames), output_dir)
+    return fnames
+
+
+def _bp_per_bin(cnarr):
+    """Average genomic size of the bins in `cnarr`, including gaps."""
+    return (sum(c.end.iat[-1] for _, c in cnarr.by_chromosome())
+            / len(cnarr))
+
+
+def _draw_scatter(cnarr, segments=None, variants=None, show_range=None,
+                  show_gene=None, do_trend=False, by_bin=False,
+                  window_width=1e6, y_min=None, y_max=None, fig_size=None,
+                  antitarget_marker=None, segment_color=SEG_COLOR, title=None,
+                  density=False):
+    """Plot as `do_scatter`, with inputs already in bin-wise coordinates."""
+    if by_bin:
         global MB
         orig_mb = MB
         MB = 1
 
     if not show_gene and not show_range:
         fig = genome_scatter(cnarr, segments, variants, do_trend, y_min, y_max, title,
-                       segment_color)
+                       segment_color, density, fig_size)
     else:
-        if by_bin:
-            show_range = show_range_bins
         fig = chromosome_scatter(cnarr, segments, variants, show_range, show_gene,
                            antitarget_marker, do_trend, by_bin, window_width,
                            y_min, y_max, title, segment_color)
@@ -51,42 +176,98 @@ def do_scatter(cnarr, segments=None, variants=None,
         fig.set_size_inches(w=width, h=height)
     return fig
 
+
+def _split_chromosomes(garr):
+    """Split an array by chromosome, with empty arrays for other chromosomes.
+
+    Returns None for a missing (None or empty) input, as `do_scatter` treats
+    those alike.
+    """
+    if not garr:
+        return collections.defaultdict(lambda: None)
+    empty = garr.as_dataframe(garr.data.iloc[:0])
+    chrom_arrays = collections.defaultdict(lambda: empty)
+    chrom_arrays.update(garr.by_chromosome())
+    return chrom_arrays
+
+
+def _chunk_pages(pages, n_total, processes):
+    """Split a chromosome's pages into tasks of a few pages each."""
+    chunk_size = max(1, n_total // (4 * (processes or os.cpu_count() or 1)))
+    for i in range(0, len(pages), chunk_size):
+        yield pages[i:i+chunk_size]
+
+
+def _draw_scatter_page(arrays, show_range, title, kwargs):
+    """Plot a region of one chromosome's `_split_chromosomes` arrays."""
+    cnarr, segments, variants = arrays
+    if not (cnarr or segments or variants):
+        raise ValueError("No data on chromosome %s" % show_range.chromosome)
+    return _draw_scatter(cnarr, segments, variants, show_range=show_range,
+                         title=title, **kwargs)
+
+
+def _write_scatter_pages(arrays, pages, kwargs):
+    """Plot and save each of several regions of one chromosome's data."""
+    fnames = []
+    for show_range, title, fname in pages:
+        try:
+            fig = _draw_scatter_page(arrays, show_range, title, kwargs)
+        except ValueError as exc:
+            logging.warning("Not plotting region %r: %s",
+                            to_label(show_range), exc)
+            pyplot.close()
+            continue
+        fig.savefig(fname, format='png', bbox_inches="tight")
+        pyplot.close(fig)
+        fnames.append(fname)
+    return fnames
+
+
 # === Genome-level scatter plots ===
 
 def genome_scatter(cnarr, segments=None, variants=None, do_trend=False,
-                   y_min=None, y_max=None, title=None, segment_color=SEG_COLOR):
+                   y_min=None, y_max=None, title=None, segment_color=SEG_COLOR,
+                   density=False, fig_size=None):
     """Plot all chromosomes, concatenated on one plot."""
+    # Density images are sized to the axes, so the figure's size must be final
+    fig = pyplot.figure(figsize=fig_size)
     if (cnarr or segments) and variants:
         # Lay out top 3/5 for the CN scatter, bottom 2/5 for SNP plot
         axgrid = pyplot.GridSpec(5, 1, hspace=.85)
-        axis = pyplot.subplot(axgrid[:3])
-        axis2 = pyplot.subplot(axgrid[3:], sharex=axis)
+        axis = fig.add_subplot(axgrid[:3])
+        axis2 = fig.add_subplot(axgrid[3:], sharex=axis)
         # Place chromosome labels between the CNR and SNP plots
         axis2.tick_params(labelbottom=False)
         chrom_sizes = plots.chromosome_sizes(cnarr or segments)
         axis2 = snv_on_genome(axis2, variants, chrom_sizes, segments, do_trend,
-                      segment_color)
+                      segment_color, density)
     else:
-        _fig, axis = pyplot.subplots()
+        axis = fig.add_subplot(111)
     if title is None:
         title = (cnarr or segments or variants).sample_id
     if cnarr or segments:
         axis.set_title(title)
         axis = cnv_on_genome(axis, cnarr, segments, do_trend, y_min, y_max,
-                      segment_color)
+                      segment_color, density)
     else:
         axis.set_title("Variant allele frequencies: %s" % title)
         chrom_sizes = collections.OrderedDict(
             (chrom, subarr["end"].max())
             for chrom, subarr in variants.by_chromosome())
         axis = snv_on_genome(axis, variants, chrom_sizes, segments, do_trend,
-                      segment_color)
+                      segment_color, density)
     return axis.get_figure()
 
 
 def cnv_on_genome(axis, probes, segments, do_trend=False, y_min=None,
-                  y_max=None, segment_color=SEG_COLOR):
-    """Plot bin ratios and/or segments for all chromosomes on one plot."""
+                  y_max=None, segment_color=SEG_COLOR, density=False):
+    """Plot bin ratios and/or segments for all chromosomes on one plot.
+
+    Bins are drawn in a single scatter layer, rasterized in vector formats, or
+    with `density` as a density image; segments and trendlines are each drawn
+    as a single collection of lines.
+    """
     # Configure axes etc.
     axis.axhline(color='k')
     axis.set_ylabel("Copy ratio (log2)")
@@ -109,44 +290,55 @@ def cnv_on_genome(axis, probes, segments, do_trend=False, y_min=None,
                 y_max = 2.5
     axis.set_ylim(y_min, y_max)
 
-    # Group probes by chromosome (to calculate plotting coordinates)
+    # Plotting coordinates: each chromosome is shifted along the x-axis
     if probes:
         chrom_sizes = plots.chromosome_sizes(probes)
-        chrom_probes = dict(probes.by_chromosome())
-        # Precalculate smoothing window size so all chromosomes have similar
-        # degree of smoothness
-        # NB: Target panel has ~1k bins/chrom. -> 250-bin window
-        #     Exome: ~10k bins/chrom. -> 2500-bin window
-        window_size = int(round(.15 * len(probes) /
-                                probes.chromosome.nunique()))
     else:
         chrom_sizes = plots.chromosome_sizes(segments)
-    # Same for segment calls
-    chrom_segs = dict(segments.by_chromosome()) if segments else {}
+    x_starts = plots.plot_chromosome_dividers(axis, chrom_sizes)
 
     # Plot points & segments
-    x_starts = plots.plot_chromosome_dividers(axis, chrom_sizes)
-    for chrom, x_offset in x_starts.items():
-        if probes and chrom in chrom_probes:
-            subprobes = chrom_probes[chrom]
-            x = 0.5 * (subprobes['start'] + subprobes['end']) + x_offset
-            axis.scatter(x, subprobes['log2'], marker='.',
-                         color=POINT_COLOR, edgecolor='none', alpha=0.2)
-            if do_trend:
-                # ENH break trendline by chromosome arm boundaries?
-                # Here and in subsequent occurrences, it's important to use snap=False to avoid short lines/segment
-                # disappearing when saving as PNG. See also https://github.com/etal/cnvkit/issues/604.
-                axis.plot(x, subprobes.smooth_log2(), color=POINT_COLOR, linewidth=2, zorder=-1, snap=False)
-
-        if chrom in chrom_segs:
-            for seg in chrom_segs[chrom]:
-                color = choose_segment_color(seg, segment_color)
-                axis.plot((seg.start + x_offset, seg.end + x_offset),
-                          (seg.log2, seg.log2),
-                          color=color, linewidth=3, solid_capstyle='round', snap=False)
+    if probes:
+        x = (0.5 * (probes['start'].values + probes['end'].values)
+             + probes.chromosome.map(x_starts).values)
+        if density:
+            plots.plot_point_density(axis, x, probes['log2'].values,
+                                     POINT_COLOR, alpha=0.2)
+        else:
+            # Keep vector output (PDF, SVG) small and fast to render
+            axis.scatter(x, probes['log2'].values, marker='.',
+                         color=POINT_COLOR, edgecolor='none', alpha=0.2,
+                         rasterized=True)
+        if do_trend:
+            # ENH break trendline by chromosome arm boundaries?
+            # Here and in subsequent occurrences, it's important to use snap=False to avoid short lines/segment
+            # disappearing when saving as PNG. See also https://github.com/etal/cnvkit/issues/604.
+            trends = []
+            for chrom, subprobes in probes.by_chromosome():
+                sub_x = (0.5 * (subprobes['start'].values
+                                + subprobes['end'].values) + x_starts[chrom])
+                trends.append(np.column_stack((sub_x,
+                                               subprobes.smooth_log2())))
+            axis.add_collection(LineCollection(trends, colors=POINT_COLOR,
+                                               linewidths=2, zorder=-1,
+                                               snap=False))
+
+    if segments:
+        segments = segments[segments.chromosome.isin(list(x_starts))]
+        offsets = segments.chromosome.map(x_starts).values
+        log2s = segments['log2'].values
+        lines = np.stack([
+            np.column_stack((segments['start'].values + offsets, log2s)),
+            np.column_stack((segments['end'].values + offsets, log2s))],
+            axis=1)
+        colors = [choose_segment_color(seg, segment_color)
+                  for seg in segments]
+        axis.add_collection(LineCollection(lines, colors=colors, linewidths=3,
+                                           capstyle='round', snap=False))
     return axis
 
-def snv_on_genome(axis, variants, chrom_sizes, segments, do_trend, segment_color):
+def snv_on_genome(axis, variants, chrom_sizes, segments, do_trend, segment_color,
+                  density=False):
     """Plot a scatter-plot of SNP chromosomal positions and shifts."""
     axis.set_ylim(0.0, 1.0)
     axis.set_ylabel("VAF")
@@ -162,32 +354,39 @@ def snv_on_genome(axis, variants, chrom_sizes, segments, do_trend, segment_color
     else:
         chrom_segs = {}
 
+    # Plot the points
+    is_shown = variants.chromosome.isin(list(x_starts)).values
+    x = (variants['start'].values[is_shown]
+         + variants.chromosome[is_shown].map(x_starts).values)
+    y = variants['alt_freq'].values[is_shown]
+    if density:
+        plots.plot_point_density(axis, x, y, POINT_COLOR, alpha=0.2)
+    else:
+        axis.scatter(x, y, color=POINT_COLOR, edgecolor='none', alpha=0.2,
+                     marker='.', rasterized=True)
+
+    # Trend bars: always calculated, only shown on request
+    lines = []
+    colors = []
     for chrom, x_offset in x_starts.items():
-        if chrom not in chrom_snvs:
+        if chrom not in chrom_snvs or chrom not in chrom_segs:
             continue
-
+        # Draw average VAF within each segment
         snvs = chrom_snvs[chrom]
-        # Plot the points
-        axis.scatter(snvs['start'].values + x_offset,
-                     snvs['alt_freq'].values,
-                     color=POINT_COLOR, edgecolor='none',
-                     alpha=0.2, marker='.')
-        # Trend bars: always calculated, only shown on request
-        if chrom in chrom_segs:
-            # Draw average VAF within each segment
-            segs = chrom_segs[chrom]
-            for seg, v_freq in get_segment_vafs(snvs, segs):
-                if seg:
-                    posn = [seg.start + x_offset, seg.end + x_offset]
-                    color = choose_segment_color(seg, segment_color,
-                                                 default_bright=False)
-                else:
-                    posn = [snvs.start.iat[0] + x_offset,
-                            snvs.start.iat[-1] + x_offset]
-                    color = TREND_COLOR
-                axis.plot(posn, [v_freq, v_freq],
-                          color=color, linewidth=2, zorder=-1,
-                          solid_capstyle='round', snap=False)
+        for seg, v_freq in get_segment_vafs(snvs, chrom_segs[chrom]):
+            if seg:
+                lines.append([(seg.start + x_offset, v_freq),
+                              (seg.end + x_offset, v_freq)])
+                colors.append(choose_segment_color(seg, segment_color,
+                                                   default_bright=False))
+            else:
+                lines.append([(snvs.start.iat[0] + x_offset, v_freq),
+                              (snvs.start.iat[-1] + x_offset, v_freq)])
+                colors.append(TREND_COLOR)
+    if lines:
+        axis.add_collection(LineCollection(lines, colors=colors, linewidths=2,
+                                           zorder=-1, capstyle='round',
+                                           snap=False))
     return axis
 
 # === Chromosome-level scatter plots ===
@@ -41,29 +41,28 @@ def squash_by_groups(cnarr, levels, by_arm=False):
     assert cnarr.data.index.is_unique
     assert levels.index.is_unique
     assert change_levels.index.is_unique
+    group_keys = [change_levels.values]
     if by_arm:
         # Enumerate chromosome arms
         arm_levels = []
         for i, (_chrom, cnarm) in enumerate(cnarr.by_arm()):
             arm_levels.append(np.repeat(i, len(cnarm)))
-        change_levels += np.concatenate(arm_levels)
+        group_keys.append(np.concatenate(arm_levels))
     else:
         # Enumerate chromosomes
-        chrom_names = cnarr['chromosome'].unique()
-        chrom_col = (cnarr['chromosome']
-                     .replace(chrom_names, np.arange(len(chrom_names))))
-        change_levels += chrom_col
-    data = cnarr.data.assign(_group=change_levels)
-    groupkey = ['_group']
+        group_keys.append(pd.factorize(cnarr['chromosome'])[0])
     if 'cn1' in cnarr:
         # Keep allele-specific CNAs separate
-        data['_g1'] = enumerate_changes(cnarr['cn1'])
-        data['_g2'] = enumerate_changes(cnarr['cn2'])
-        groupkey.extend(['_g1', '_g2'])
-    data = (data.groupby(groupkey, as_index=False, group_keys=False, sort=False)
-            .apply(squash_region)
-            .reset_index(drop=True))
-    return cnarr.as_dataframe(data)
+        group_keys.append(enumerate_changes(cnarr['cn1']).values)
+        group_keys.append(enumerate_changes(cnarr['cn2']).values)
+    # Each run ends where any of the keys changes
+    is_change = np.zeros(len(cnarr), dtype=np.bool_)
+    for key in group_keys:
+        is_change[1:] |= (key[1:] != key[:-1])
+    run_starts = np.flatnonzero(is_change)
+    if len(cnarr):
+        run_starts = np.concatenate(([0], run_starts))
+    return cnarr.as_dataframe(squash_runs(cnarr.data, run_starts))
 
 
 def enumerate_changes(levels):
@@ -80,45 +79,134 @@ def squash_region(cnarr):
     Most fields added by the `segmetrics` command will be dropped.
     """
     assert 'weight' in cnarr
-    out = {'chromosome': [cnarr['chromosome'].iat[0]],
-           'start': cnarr['start'].iat[0],
-           'end': cnarr['end'].iat[-1],
+    return squash_runs(cnarr, np.array([0]))
+
+
+def squash_runs(data, run_starts):
+    """Reduce each run of consecutive rows of a table to a single row.
+
+    Like applying `squash_region` to each run, but all runs are reduced at once
+    with offset-based array operations.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Bin or segment table with at least the columns chromosome, start, end,
+        log2, gene and weight.
+    run_starts : array of int
+        Row offset where each run begins, in increasing order; the first must
+        be 0 unless `data` is empty.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per run.
+    """
+    assert 'weight' in data
+    run_starts = np.asarray(run_starts, dtype=np.int_)
+    run_ends = np.append(run_starts[1:], len(data))
+    sizes = run_ends - run_starts
+    if not len(run_starts):
+        sizes = run_ends = run_starts
+    run_ids = np.repeat(np.arange(len(run_starts)), sizes)
+
+    def reduce_sum(values):
+        if not len(values):
+            return np.zeros(0, dtype=values.dtype)
+        return np.add.reduceat(values, run_starts)
+
+    weights = data['weight'].values.astype(np.float_)
+    region_weight = reduce_sum(np.nan_to_num(weights))
+    is_weighted = region_weight > 0
+
+    def average(col):
+        values = data[col].values.astype(np.float_)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(is_weighted,
+                            reduce_sum(values * weights) / reduce_sum(weights),
+                            reduce_sum(values) / sizes)
+
+    out = {'chromosome': data['chromosome'].values[run_starts],
+           'start': data['start'].values[run_starts],
+           'end': data['end'].values[run_ends - 1],
+           'log2': average('log2'),
+           'gene': _join_run_genes(data['gene'].values, run_ids, run_starts),
+           'probes': (reduce_sum(data['probes'].values) if 'probes' in data
+                      else sizes),
+           'weight': region_weight,
           }
-    region_weight = cnarr['weight'].sum()
-    if region_weight > 0:
-        out['log2'] = np.average(cnarr['log2'], weights=cnarr['weight'])
-    else:
-        out['log2'] = np.mean(cnarr['log2'])
-    out['gene'] = ','.join(cnarr['gene'].drop_duplicates())
-    out['probes'] = cnarr['probes'].sum() if 'probes' in cnarr else len(cnarr)
-    out['weight'] = region_weight
-    if 'depth' in cnarr:
-        if region_weight > 0:
-            out['depth'] = np.average(cnarr['depth'], weights=cnarr['weight'])
-        else:
-            out['depth'] = np.mean(cnarr['depth'])
-    if 'baf' in cnarr:
-        if region_weight > 0:
-            out['baf'] = np.average(cnarr['baf'], weights=cnarr['weight'])
-        else:
-            out['baf'] = np.mean(cnarr['baf'])
-    if 'cn' in cnarr:
-        if region_weight > 0:
-            out['cn'] = weighted_median(cnarr['cn'], cnarr['weight'])
-        else:
-            out['cn'] = np.median(cnarr['cn'])
-        if 'cn1' in cnarr:
-            if region_weight > 0:
-                out['cn1'] = weighted_median(cnarr['cn1'], cnarr['weight'])
-            else:
-                out['cn1'] = np.median(cnarr['cn1'])
+    if 'depth' in data:
+        out['depth'] = average('depth')
+    if 'baf' in data:
+        out['baf'] = average('baf')
+    if 'cn' in data:
+        out['cn'] = _run_medians(data['cn'].values, weights, run_ids,
+                                 run_starts, is_weighted)
+        if 'cn1' in data:
+            out['cn1'] = _run_medians(data['cn1'].values, weights, run_ids,
+                                      run_starts, is_weighted)
             out['cn2'] = out['cn'] - out['cn1']
-    if 'p_bintest' in cnarr:
+    if 'p_bintest' in data:
         # Only relevant for single-bin segments, but this seems safe/conservative
-        out['p_bintest'] = cnarr['p_bintest'].max()
+        p_values = data['p_bintest'].values.astype(np.float_)
+        out['p_bintest'] = (np.fmax.reduceat(p_values, run_starts)
+                            if len(p_values) else p_values)
     return pd.DataFrame(out)
 
 
+def _join_run_genes(genes, run_ids, run_starts):
+    """Comma-separated unique gene names of each run, in order of appearance."""
+    if not len(run_starts):
+        return []
+    is_first = ~pd.DataFrame({'run': run_ids, 'gene': genes}).duplicated().values
+    first_run_ids = run_ids[is_first]
+    run_genes = np.split(genes[is_first],
+                         np.searchsorted(first_run_ids,
+                                         np.arange(1, len(run_starts))))
+    return [','.join(names) for names in run_genes]
+
+
+def _run_medians(values, weights, run_ids, run_starts, is_weighted):
+    """Median of each run's values: weighted if the run has any weight.
+
+    Matches `descriptives.weighted_median` (or `np.median`, for unweighted
+    runs) applied to each run separately.
+    """
+    values = values.astype(np.float_)
+    if not len(values):
+        return values
+    sizes = np.diff(np.append(run_starts, len(values)))
+    # Sort values within each run
+    order = np.lexsort((values, run_ids))
+    vals = values[order]
+    wts = weights[order]
+    # Unweighted: middle value(s) of each run
+    result = .5 * (vals[run_starts + (sizes - 1) // 2] +
+                   vals[run_starts + sizes // 2])
+    # Weighted: any value with the majority of the run's weight is the median;
+    # otherwise, average the values around the cumulative weight's midpoint
+    midpoints = .5 * np.add.reduceat(wts, run_starts)
+    cum_weights = pd.Series(wts).groupby(run_ids).cumsum().values
+    past_mid = np.flatnonzero(cum_weights >= midpoints[run_ids])
+    past_mid_runs, first = np.unique(run_ids[past_mid], return_index=True)
+    mid_idx = run_starts.copy()
+    mid_idx[past_mid_runs] = past_mid[first]
+    weighted = np.where(mid_idx > run_starts,
+                        .5 * (vals[mid_idx - 1] + vals[mid_idx]),
+                        vals[mid_idx])
+    is_major = np.flatnonzero(wts > midpoints[run_ids])
+    weighted[run_ids[is_major]] = vals[is_major]
+    result = np.where(is_weighted, weighted, result)
+    # Missing values: reduce those runs one at a time
+    is_nan = np.isnan(values) | np.isnan(weights)
+    for i in np.unique(run_ids[is_nan]):
+        run_vals = values[run_starts[i]:run_starts[i] + sizes[i]]
+        run_wts = weights[run_starts[i]:run_starts[i] + sizes[i]]
+        result[i] = (weighted_median(run_vals, run_wts) if is_weighted[i]
+                     else np.median(run_vals))
+    return result
+
+
 @require_column('cn')
 def ampdel(segarr):
     """Merge segments by amplified/deleted/neutral copy number status.
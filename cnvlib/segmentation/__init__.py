@@ -14,10 +14,8 @@ from skgenome.intersect import iter_slices
 from .. import core, parallel, params, smoothing, vary
 from ..cnary import CopyNumArray as CNA
 from ..segfilters import squash_by_groups
-from . import cbs, flasso, haar, hmm, none
-
-SEGMENT_METHODS = ('cbs', 'flasso', 'haar', 'none',
-                   'hmm', 'hmm-tumor', 'hmm-germline')
+from ..params import SEGMENT_METHODS
+from . import cbs, flasso, haar, none
 
 
 def do_segmentation(cnarr, method, threshold=None, variants=None,
@@ -58,7 +56,7 @@ def do_segmentation(cnarr, method, threshold=None, variants=None,
 
     else:
         with parallel.pick_pool(processes) as pool:
-            rets = list(pool.map(_ds, ((ca, method, threshold, variants,
+            rets = list(pool.map(_ds, ((ca, method, threshold, None,
                                         skip_low, skip_outliers, min_weight,
                                         save_dataframe, rscript_path, smooth_cbs)
                                        for _, ca in cnarr.by_arm())))
@@ -72,6 +70,9 @@ def do_segmentation(cnarr, method, threshold=None, variants=None,
             rstr = "".join(rstr)
         cna = cnarr.concat(rets)
 
+    if variants and not method.startswith('hmm'):
+        cna = resegment_variants(cna, cnarr, variants, processes)
+
     cna.sort_columns()
     if save_dataframe:
         return cna, rstr
@@ -136,6 +137,8 @@ def _do_segmentation(cnarr, method, threshold, variants=None,
         segarr = none.segment_none(filtered_cn)
 
     elif method.startswith('hmm'):
+        # Only load pomegranate if needed
+        from . import hmm
         segarr = hmm.segment_hmm(filtered_cn, method, threshold, variants)
 
     elif method in ('cbs', 'flasso'):
@@ -177,15 +180,6 @@ def _do_segmentation(cnarr, method, threshold, variants=None,
         raise ValueError("Unknown method %r" % method)
 
     segarr.meta = cnarr.meta.copy()
-    if variants and not method.startswith('hmm'):
-        # Re-segment the variant allele freqs within each segment
-        # TODO train on all segments together
-        logging.info("Re-segmenting on variant allele frequency")
-        newsegs = [hmm.variants_in_segment(subvarr, segment)
-                   for segment, subvarr in variants.by_ranges(segarr)]
-        segarr = segarr.as_dataframe(pd.concat(newsegs))
-        segarr['baf'] = variants.baf_by_ranges(segarr)
-
     segarr = transfer_fields(segarr, cnarr)
     if save_dataframe:
         return segarr, seg_out
@@ -193,6 +187,29 @@ def _do_segmentation(cnarr, method, threshold, variants=None,
         return segarr
 
 
+def resegment_variants(segments, cnarr, variants, processes=1):
+    """Split a sample's segments where the SNVs' allele frequencies change.
+
+    One allele frequency model is trained on all of the segments together,
+    rather than one per chromosome arm or segment (see
+    `hmm.variants_in_segments`). The bin-level fields are then transferred
+    from `cnarr` to the split segments of each chromosome arm.
+    """
+    # Only load pomegranate if needed
+    from . import hmm
+    logging.info("Re-segmenting on variant allele frequency")
+    segarr = segments.as_dataframe(
+        hmm.variants_in_segments(variants, segments, processes=processes))
+    segarr['baf'] = variants.baf_by_ranges(segarr)
+    arm_segments = []
+    for chrom, arm_bins in cnarr.by_arm():
+        arm_segarr = segarr.in_range(chrom, arm_bins.start.iat[0],
+                                     arm_bins.end.iat[-1], mode='inner')
+        if len(arm_segarr):
+            arm_segments.append(transfer_fields(arm_segarr, arm_bins))
+    return segments.concat(arm_segments)
+
+
 def drop_outliers(cnarr, width, factor):
     """Drop outlier bins with log2 ratios too far from the trend line.
 
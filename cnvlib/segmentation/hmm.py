@@ -9,6 +9,7 @@ import numpy as np
 import pandas as pd
 import scipy.special
 import pomegranate as pom
+from skgenome.intersect import iter_slices
 
 from ..cnary import CopyNumArray as CNA
 from ..descriptives import biweight_midvariance
@@ -161,21 +162,7 @@ def as_observation_matrix(cnarr, variants=None):
 def variants_in_segment(varr, segment, min_variants=50):
     if len(varr) > min_variants:
         observations = varr.mirrored_baf(above_half=True)
-        state_names = ["neutral", "alt"]
-        distributions = [
-            pom.NormalDistribution(0.5, .1, frozen=True),
-            pom.NormalDistribution(0.67, .1, frozen=True),
-        ]
-        n_states = len(distributions)
-        # Starts -- prefer neutral
-        start_probabilities = [.95, .05]
-        # Prefer to keep the current state in each transition
-        # All other transitions are equally likely, to start
-        transition_matrix = (np.identity(n_states) * 100
-                             + np.ones((n_states, n_states)) / n_states)
-        model = pom.HiddenMarkovModel.from_matrix(transition_matrix, distributions,
-            start_probabilities, state_names=state_names, name="loh")
-
+        model = _baf_model()
         model.fit(sequences=[observations],
                   edge_inertia=0.1,
                   lr_decay=.75,
@@ -242,3 +229,113 @@ def variants_in_segment(varr, segment, min_variants=50):
         }, index=[0])
 
     return dframe
+
+
+def variants_in_segments(varr, segarr, min_variants=50, processes=1):
+    """Re-segment variant allele frequencies within all segments at once.
+
+    Unlike `variants_in_segment`, a single HMM is trained on the BAFs of every
+    segment with more than `min_variants` SNVs, each segment being a separate
+    observation sequence. The fitted model then decodes each of those
+    segments, and the new breakpoints are placed midway between consecutive
+    SNVs with different predicted states.
+
+    Parameters
+    ----------
+    varr : VariantArray
+        Heterozygous SNVs with allele frequencies.
+    segarr : CopyNumArray
+        Segments to subdivide by allele frequency.
+    min_variants : int
+        Minimum number of SNVs (exclusive) for a segment to be re-segmented.
+    processes : int
+        Number of parallel jobs to run while training the model.
+
+    Returns
+    -------
+    pd.DataFrame
+        The segments of `segarr`, subdivided where the BAF state changes;
+        columns are chromosome, start, end, gene, log2, probes.
+    """
+    seg_data = segarr.data.reset_index(drop=True)
+    var_data = varr.data.reset_index(drop=True)
+    bafs = np.asarray(varr.mirrored_baf(above_half=True), dtype=np.float_)
+    var_starts = var_data['start'].values
+    var_ends = var_data['end'].values
+
+    # Positions of each segment's SNVs in the variant array
+    var_idx = list(iter_slices(var_data, seg_data, 'outer', True))
+    to_split = [i for i, idx in enumerate(var_idx) if len(idx) > min_variants]
+    n_out = np.ones(len(seg_data), dtype=np.int_)
+    out_probes = [[p] for p in seg_data['probes'].values]
+    out_breaks = [[] for _i in range(len(seg_data))]
+    if to_split:
+        logging.info("Training allele frequency model on %d segments",
+                     len(to_split))
+        sequences = [bafs[var_idx[i]] for i in to_split]
+        model = _baf_model()
+        model.fit(sequences=sequences,
+                  weights=[len(seq) for seq in sequences],
+                  edge_inertia=0.1,
+                  lr_decay=.75,
+                  pseudocount=5,
+                  use_pseudocount=True,
+                  max_iterations=100000,
+                  n_jobs=processes,
+                  verbose=False)
+        logging.debug("Edges: %s", model.edges)
+        # pomegranate decodes one sequence per call; decoding the segments
+        # concatenated would carry states across the segment boundaries
+        for seg_i, obs in zip(to_split, sequences):
+            states = np.array(model.predict(obs, algorithm='map'))
+            # SNV offsets where the predicted state changes
+            changes = np.flatnonzero(np.diff(states)) + 1
+            if not len(changes):
+                continue
+            idx = var_idx[seg_i]
+            out_breaks[seg_i] = (var_starts[idx[changes]]
+                                 + var_ends[idx[changes - 1]]) // 2
+            out_probes[seg_i] = np.diff(np.r_[0, changes, len(states)])
+            n_out[seg_i] = len(changes) + 1
+            logging.info("Segment %s:%d-%d on allele freqs for %d additional "
+                         "breakpoints", seg_data['chromosome'].iat[seg_i],
+                         seg_data['start'].iat[seg_i],
+                         seg_data['end'].iat[seg_i], len(changes))
+
+    # Cut each segment at its breakpoints, keeping the original endpoints
+    starts = np.concatenate([np.r_[s, b] for s, b in
+                             zip(seg_data['start'].values, out_breaks)])
+    ends = np.concatenate([np.r_[b, e] for e, b in
+                           zip(seg_data['end'].values, out_breaks)])
+    dframe = pd.DataFrame({
+        'chromosome': np.repeat(seg_data['chromosome'].values, n_out),
+        'start': starts.astype(np.int_),
+        'end': ends.astype(np.int_),
+        'gene': np.repeat(seg_data['gene'].values, n_out),
+        'log2': np.repeat(seg_data['log2'].values, n_out),
+        'probes': np.concatenate(out_probes),
+    })
+    bad_segs_idx = (dframe.start >= dframe.end)
+    if bad_segs_idx.any():
+        raise RuntimeError("Improper post-processing of segments -- "
+                           "{} bins start >= end:\n{}\n"
+                           .format(bad_segs_idx.sum(), dframe[bad_segs_idx]))
+    return dframe
+
+
+def _baf_model():
+    """Two-state HMM of mirrored b-allele frequencies: neutral vs. allelic imbalance."""
+    state_names = ["neutral", "alt"]
+    distributions = [
+        pom.NormalDistribution(0.5, .1, frozen=True),
+        pom.NormalDistribution(0.67, .1, frozen=True),
+    ]
+    n_states = len(distributions)
+    # Starts -- prefer neutral
+    start_probabilities = [.95, .05]
+    # Prefer to keep the current state in each transition
+    # All other transitions are equally likely, to start
+    transition_matrix = (np.identity(n_states) * 100
+                         + np.ones((n_states, n_states)) / n_states)
+    return pom.HiddenMarkovModel.from_matrix(transition_matrix, distributions,
+        start_probabilities, state_names=state_names, name="loh")
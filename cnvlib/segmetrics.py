@@ -4,98 +4,227 @@ import logging
 
 import numpy as np
 # import pandas as pd
-from scipy import stats
+from skgenome.intersect import iter_slices
 
-from . import descriptives
+from . import descriptives, parallel
+
+# Max. number of bins to resample at once in the bootstrap; each job resamples
+# at most (bootstraps * BOOTSTRAP_BLOCK_SIZE) values, taking roughly 40 bytes
+# of memory apiece
+BOOTSTRAP_BLOCK_SIZE = 50000
 
 
 def do_segmetrics(cnarr, segarr, location_stats=(), spread_stats=(),
-                  interval_stats=(), alpha=.05, bootstraps=100, smoothed=False, skip_low=False):
+                  interval_stats=(), alpha=.05, bootstraps=100, smoothed=False, skip_low=False,
+                  processes=1):
     """Compute segment-level metrics from bin-level log2 ratios."""
-    # Silence sem's "Degrees of freedom <= 0 for slice"; NaN is OK
-    import warnings
-    warnings.simplefilter('ignore', RuntimeWarning)
+    if skip_low:
+        cnarr = cnarr.drop_low_coverage()
+    bin_idx, offsets = segment_bin_offsets(cnarr, segarr)
+    log2s = cnarr['log2'].values[bin_idx]
+    # Missing values are skipped by every statistic
+    is_nan = np.isnan(log2s)
+    if is_nan.any():
+        seg_ids = np.repeat(np.arange(len(segarr)), np.diff(offsets))
+        bin_idx = bin_idx[~is_nan]
+        log2s = log2s[~is_nan]
+        np.cumsum(np.bincount(seg_ids[~is_nan], minlength=len(segarr)),
+                  out=offsets[1:])
+    bins = SegmentBins(log2s, offsets)
 
     stat_funcs = {
-        'mean': np.mean,
-        'median': np.median,
-        'mode': descriptives.modal_location,
-        'p_ttest': lambda a: stats.ttest_1samp(a, 0.0, nan_policy='omit')[1],
-
-        'stdev': np.std,
-        'mad':  descriptives.median_absolute_deviation,
-        'mse':  descriptives.mean_squared_error,
-        'iqr':  descriptives.interquartile_range,
-        'bivar': descriptives.biweight_midvariance,
-        'sem': stats.sem,
-
-        'ci': make_ci_func(alpha, bootstraps, smoothed),
-        'pi': make_pi_func(alpha),
+        'mean': bins.mean,
+        'median': bins.median,
+        'mode': lambda: bins.apply(descriptives.modal_location),
+        'p_ttest': bins.p_ttest,
+
+        'stdev': lambda: np.sqrt(bins.variance()),
+        'mad': bins.mad,
+        'mse': bins.variance,
+        'iqr': lambda: bins.quantile(.75) - bins.quantile(.25),
+        'bivar': lambda: bins.apply(descriptives.biweight_midvariance,
+                                    segarr['log2'].values),
+        'sem': bins.sem,
     }
 
-    if skip_low:
-        cnarr = cnarr.drop_low_coverage()
-    bins_log2s = list(cnarr.iter_ranges_of(segarr, 'log2', 'outer', True))
-
     segarr = segarr.copy()
-    if location_stats:
-        # Measures of location
-        for statname in location_stats:
-            func = stat_funcs[statname]
-            segarr[statname] = np.fromiter(map(func, bins_log2s),
-                                           np.float_, len(segarr))
-    # Measures of spread
-    if spread_stats:
-        deviations = (bl - sl for bl, sl in zip(bins_log2s, segarr['log2']))
-        if len(spread_stats) > 1:
-            deviations = list(deviations)
-        for statname in spread_stats:
-            func = stat_funcs[statname]
-            segarr[statname] = np.fromiter(map(func, deviations),
-                                           np.float_, len(segarr))
+    # Measures of location, then spread
+    for statname in list(location_stats) + list(spread_stats):
+        segarr[statname] = stat_funcs[statname]()
     # Interval calculations
-    weights = cnarr['weight']
     if 'ci' in interval_stats:
-        segarr['ci_lo'], segarr['ci_hi'] = calc_intervals(bins_log2s, weights,
-                                                          stat_funcs['ci'])
+        segarr['ci_lo'], segarr['ci_hi'] = confidence_intervals_bootstrap(
+            log2s, cnarr['weight'].values[bin_idx], offsets,
+            alpha, bootstraps, smoothed, processes)
     if 'pi' in interval_stats:
-        segarr['pi_lo'], segarr['pi_hi'] = calc_intervals(bins_log2s, weights,
-                                                          stat_funcs['pi'])
+        # Prediction interval, estimated by percentiles
+        # ENH: weighted percentile
+        segarr['pi_lo'] = bins.quantile(alpha / 2)
+        segarr['pi_hi'] = bins.quantile(1 - alpha / 2)
 
     return segarr
 
 
-def make_ci_func(alpha, bootstraps, smoothed):
-    def ci_func(ser, wt):
-        return confidence_interval_bootstrap(ser, wt, alpha, bootstraps,
-                                             smoothed)
-    return ci_func
+class SegmentBins(object):
+    """Bin log2 values grouped by segment, for computing segment statistics.
 
+    All segments are handled together as one flat array of values and the
+    offsets where each segment starts. Values are sorted within each segment
+    only once, on first use, and shared by all of the order statistics.
 
-def make_pi_func(alpha):
-    """Prediction interval, estimated by percentiles."""
-    # ENH: weighted percentile
-    pct_lo = 100 * alpha / 2
-    pct_hi = 100 * (1 - alpha / 2)
-    def pi_func(ser, _w):
-        return np.percentile(ser, [pct_lo, pct_hi])
-    return pi_func
+    Statistics follow the conventions of `cnvlib.descriptives`: segments with
+    no bins get NaN, and single-bin segments get zero spread.
+    """
 
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+        self.starts = offsets[:-1]
+        self.sizes = np.diff(offsets)
+        self.seg_ids = np.repeat(np.arange(len(self.sizes)), self.sizes)
+        self._sorted = None
+        self._mean = None
+
+    def sorted_values(self):
+        """Values sorted within each segment."""
+        if self._sorted is None:
+            self._sorted = self.values[np.lexsort((self.values,
+                                                   self.seg_ids))]
+        return self._sorted
+
+    def _sum(self, values):
+        return np.bincount(self.seg_ids, weights=values,
+                           minlength=len(self.sizes))
+
+    def mean(self):
+        """Mean of each segment's values."""
+        if self._mean is None:
+            with np.errstate(invalid='ignore'):
+                self._mean = self._sum(self.values) / self.sizes
+        return self._mean
+
+    def variance(self, ddof=0):
+        """Variance of each segment's values."""
+        residuals = self.values - self.mean()[self.seg_ids]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._sum(residuals ** 2) / (self.sizes - ddof)
+
+    def sem(self):
+        """Standard error of the mean of each segment's values."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.variance(ddof=1) / self.sizes)
+
+    def quantile(self, q, sorted_values=None):
+        """Quantile of each segment, interpolated linearly like np.percentile."""
+        if sorted_values is None:
+            sorted_values = self.sorted_values()
+        result = np.repeat(np.nan, len(self.sizes))
+        ok = (self.sizes > 0)
+        position = self.starts[ok] + q * (self.sizes[ok] - 1)
+        lower = np.floor(position).astype(np.int_)
+        upper = np.ceil(position).astype(np.int_)
+        lower_vals = sorted_values[lower]
+        result[ok] = (lower_vals + (position - lower)
+                      * (sorted_values[upper] - lower_vals))
+        return result
+
+    def median(self):
+        """Median of each segment's values."""
+        return self.quantile(.5)
+
+    def mad(self, scale_to_sd=True):
+        """Median absolute deviation of each segment's values."""
+        abs_dev = np.abs(self.values - self.median()[self.seg_ids])
+        mad = self.quantile(.5, abs_dev[np.lexsort((abs_dev, self.seg_ids))])
+        if scale_to_sd:
+            mad *= 1.4826
+        return mad
+
+    def p_ttest(self):
+        """P-value of the one-sample t-test of each segment versus 0.0."""
+        from scipy import stats
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = self.mean() / np.sqrt(self.variance(ddof=1) / self.sizes)
+            return 2 * stats.t.sf(np.abs(t), self.sizes - 1)
+
+    def apply(self, func, shifts=None):
+        """Apply `func` to each segment's (sorted) values, one at a time.
+
+        If `shifts` is given, subtract each segment's shift from its values
+        first, e.g. to get deviations from the segment's log2 value.
+        """
+        sorted_values = self.sorted_values()
+        result = np.repeat(np.nan, len(self.sizes))
+        for i in np.flatnonzero(self.sizes):
+            seg_values = sorted_values[self.offsets[i]:self.offsets[i+1]]
+            if shifts is not None:
+                seg_values = seg_values - shifts[i]
+            result[i] = func(seg_values)
+        return result
+
+
+def segment_bin_offsets(cnarr, segarr):
+    """Locate the bins in each segment, as a flat array of bin positions.
 
-def calc_intervals(bins_log2s, weights, func):
-    """Compute a stat that yields intervals (low & high values)"""
-    out_vals_lo =  np.repeat(np.nan, len(bins_log2s))
-    out_vals_hi = np.repeat(np.nan, len(bins_log2s))
-    for i, ser in enumerate(bins_log2s):
-        if len(ser):
-            wt = weights[ser.index]
-            assert (wt.index == ser.index).all()
-            out_vals_lo[i], out_vals_hi[i] = func(ser.values, wt.values)
-    return out_vals_lo, out_vals_hi
+    Returns
+    -------
+    tuple
+        (bin_idx, offsets): `bin_idx` holds the row positions in `cnarr` of
+        each segment's bins, in segment order; the bins of segment ``i`` are
+        ``bin_idx[offsets[i]:offsets[i+1]]``.
+    """
+    slices = list(iter_slices(cnarr.data.reset_index(drop=True),
+                              segarr.data, 'outer', True))
+    offsets = np.zeros(len(slices) + 1, dtype=np.int_)
+    np.cumsum([len(idx) for idx in slices], out=offsets[1:])
+    if slices:
+        bin_idx = np.concatenate(slices).astype(np.int_)
+    else:
+        bin_idx = np.array([], dtype=np.int_)
+    return bin_idx, offsets
 
 
 def confidence_interval_bootstrap(values, weights, alpha, bootstraps=100, smoothed=False):
     """Confidence interval for segment mean log2 value, estimated by bootstrap."""
+    ci_lo, ci_hi = confidence_intervals_bootstrap(
+        np.asarray(values), np.asarray(weights), [0, len(values)], alpha,
+        bootstraps, smoothed)
+    return np.array([ci_lo[0], ci_hi[0]])
+
+
+def confidence_intervals_bootstrap(values, weights, offsets, alpha,
+                                   bootstraps=100, smoothed=False,
+                                   processes=1):
+    """Confidence intervals for many segments' mean log2 values, by bootstrap.
+
+    The replicates for a block of segments are all drawn at once and their
+    weighted means taken with array operations; blocks of segments are
+    processed independently, optionally in parallel.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Bin log2 values, grouped by segment.
+    weights : np.ndarray
+        Bin weights, matching `values`.
+    offsets : array of int
+        Start of each segment's bins in `values`, plus the final end, as from
+        `segment_bin_offsets`.
+    alpha : float
+        Significance level; the interval covers 1 - alpha.
+    bootstraps : int
+        Number of bootstrap replicates.
+    smoothed : bool
+        Add Gaussian noise to each replicate; see `_bootstrap_block`.
+    processes : int
+        Number of processes to bootstrap blocks of segments in parallel.
+
+    Returns
+    -------
+    tuple
+        (ci_lo, ci_hi) arrays, with one value per segment. Segments with no
+        bins get NaN, and single-bin segments get their bin's value.
+    """
     if not 0 < alpha < 1:
         raise ValueError("alpha must be between 0 and 1; got %s" % alpha)
     if bootstraps <= 2 / alpha:
@@ -103,66 +232,94 @@ def confidence_interval_bootstrap(values, weights, alpha, bootstraps=100, smooth
         logging.warning("%d bootstraps not enough to estimate CI alpha level "
                         "%f; increasing to %d", bootstraps, alpha, new_boots)
         bootstraps = new_boots
-    # Bootstrap for CI
-    k = len(values)
-    if k < 2:
-        return np.repeat(values[0], 2)
-
-    np.random.seed(0xA5EED)
-    rand_indices = np.random.randint(0, k, size=(bootstraps, k))
-    samples = ((np.take(values, idx), np.take(weights, idx))
-               for idx in rand_indices)
-    if smoothed:
-        samples = _smooth_samples_by_weight(values, samples)
-    # Recalculate segment means
-    seg_means = (np.average(val, weights=wt)
-                 for val, wt in samples)
-    bootstrap_dist = np.fromiter(seg_means, np.float_, bootstraps)
-    alphas = np.array([alpha / 2, 1 - alpha / 2])
-    if not smoothed:
-        # alphas = _bca_correct_alpha(values, weights, bootstrap_dist, alphas)
-        pass
-    ci = np.percentile(bootstrap_dist, list(100 * alphas))
-    return ci
-
-
-def _smooth_samples_by_weight(values, samples):
-    """Add Gaussian noise to each bootstrap replicate.
-
-    The result is used to compute a "smoothed bootstrap," where the added noise
-    ensures that for small samples (e.g. number of bins in the segment) the
-    bootstrapped CI is close to the standard error of the mean, as it should be.
-    Conceptually, sample from a KDE instead of the values themselves.
-
-    This addresses the issue that small segments (#bins < #replicates) don't
-    fully represent the underlying distribution, in particular the extreme
-    values, so the CI is too narrow. For single-bin segments in particular,
-    the confidence interval will always have zero width unless the samples are
-    smoothed.
-
-    Standard deviation of the noise added to each bin comes from each bin's
-    weight, which is an estimate of (1-variance).
-
-    Parameters
-    ----------
-    values : np.ndarray
-        Original log2 values within the segment.
-    samples : list of np.ndarray
-        Bootstrap replicates as (value_sample, weight_sample).
+    offsets = np.asarray(offsets)
+    sizes = np.diff(offsets)
+    ci_lo = np.repeat(np.nan, len(sizes))
+    ci_hi = ci_lo.copy()
+    # Too few bins to resample; the interval is just the one value, if any
+    singles = np.flatnonzero(sizes == 1)
+    ci_lo[singles] = ci_hi[singles] = values[offsets[singles]]
+
+    to_boot = np.flatnonzero(sizes >= 2)
+    if not len(to_boot):
+        return ci_lo, ci_hi
+    # Group segments into blocks of up to BOOTSTRAP_BLOCK_SIZE bins; a larger
+    # segment is a block by itself
+    boot_sizes = sizes[to_boot]
+    is_big = boot_sizes > BOOTSTRAP_BLOCK_SIZE
+    block_ids = (np.cumsum(boot_sizes) - 1) // BOOTSTRAP_BLOCK_SIZE
+    block_bounds = np.union1d(
+        np.r_[0, np.flatnonzero(np.diff(block_ids)) + 1, len(to_boot)],
+        np.r_[np.flatnonzero(is_big), np.flatnonzero(is_big) + 1])
+    # Large segments are resampled a chunk of replicates at a time, so that
+    # no job resamples more than (bootstraps * BOOTSTRAP_BLOCK_SIZE) values.
+    # Each (block, chunk) has its own fixed random seed so results don't
+    # depend on `processes`.
+    blocks = []
+    jobs = []
+    for block_num, (i_start, i_end) in enumerate(zip(block_bounds[:-1],
+                                                    block_bounds[1:])):
+        seg_idx = to_boot[i_start:i_end]
+        bin_start, bin_end = offsets[seg_idx[0]], offsets[seg_idx[-1] + 1]
+        chunk_size = max(1, bootstraps * BOOTSTRAP_BLOCK_SIZE
+                         // (bin_end - bin_start))
+        chunk_sizes = [min(chunk_size, bootstraps - row)
+                       for row in range(0, bootstraps, chunk_size)]
+        blocks.append((seg_idx, len(chunk_sizes)))
+        for chunk_num, n_rows in enumerate(chunk_sizes):
+            jobs.append((values[bin_start:bin_end],
+                         weights[bin_start:bin_end],
+                         offsets[seg_idx] - bin_start, sizes[seg_idx],
+                         n_rows, smoothed, (block_num, chunk_num)))
+    with parallel.pick_pool(processes) as pool:
+        results = iter(pool.map(_bootstrap_block, jobs))
+        for seg_idx, n_chunks in blocks:
+            seg_means = np.concatenate([next(results)
+                                        for _i in range(n_chunks)])
+            ci_lo[seg_idx], ci_hi[seg_idx] = np.percentile(
+                seg_means, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    return ci_lo, ci_hi
+
+
+def _bootstrap_block(args):
+    """Bootstrap the weighted means of a block of adjacent segments.
+
+    For a "smoothed bootstrap," Gaussian noise is added to each resampled
+    value. Conceptually, this samples from a KDE instead of the values
+    themselves, so that for small segments (#bins < #replicates) the CI is
+    close to the standard error of the mean, as it should be; otherwise the
+    extreme values are underrepresented and the CI is too narrow. The standard
+    deviation of the noise added to each bin comes from each bin's weight,
+    which is an estimate of (1-variance), and the KDE bandwidth narrows for
+    larger segments following Silverman's Rule and Polansky 1995, but with
+    k=1 -> bw=1 for consistency.
 
     Returns
     -------
-    `samples` with random N(0, pop_sd) added to each value, and
-    weights unchanged.
+    np.ndarray
+        The segments' mean values in each replicate, one row per replicate.
     """
-    k = len(values)
-    # KDE bandwidth narrows for larger sample sizes
-    # Following Silverman's Rule and Polansky 1995,
-    # but requiring k=1 -> bw=1 for consistency
-    bw = k ** (-1/4)
-    samples = [(v + (bw * np.sqrt(1-w) * np.random.randn(k)), w)
-                for v, w in samples]
-    return samples
+    values, weights, starts, sizes, n_rows, smoothed, seed = args
+    rng = np.random.RandomState([0xA5EED] + list(seed))
+    seg_starts = np.repeat(starts, sizes)
+    seg_sizes = np.repeat(sizes, sizes)
+    # Each replicate (row) resamples every segment's bins, side by side
+    rand_indices = (seg_starts
+                    + (rng.random_sample((n_rows, len(seg_sizes)))
+                       * seg_sizes).astype(np.int_))
+    sample_vals = values[rand_indices]
+    sample_wts = weights[rand_indices]
+    if smoothed:
+        bw = seg_sizes ** (-1/4)
+        sample_vals += (bw * np.sqrt(1 - sample_wts)
+                        * rng.standard_normal(sample_vals.shape))
+    # Recalculate segment means
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sample_starts = np.cumsum(sizes) - sizes
+        seg_means = (np.add.reduceat(sample_vals * sample_wts, sample_starts,
+                                     axis=1)
+                     / np.add.reduceat(sample_wts, sample_starts, axis=1))
+    return seg_means
 
 
 def _bca_correct_alpha(values, weights, bootstrap_dist, alphas):
@@ -173,6 +330,7 @@ def _bca_correct_alpha(values, weights, bootstrap_dist, alphas):
 
     Ported from R package "bootstrap" function "bcanon".
     """
+    from scipy import stats
     n_boots = len(bootstrap_dist)
     orig_mean = np.average(values, weights=weights)
     logging.warning("boot samples less: %s / %s",
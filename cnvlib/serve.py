@@ -0,0 +1,121 @@
+"""Run CNVkit commands in a long-lived server process.
+
+Starting ``cnvkit.py`` for each small step of a pipeline means importing the
+whole stack and re-parsing the same reference and BED files every time. A
+server started with ``cnvkit.py serve SOCKET`` keeps those loaded, and runs
+commands sent to it over a local Unix socket -- by ``cnvkit.py`` itself, if
+the environment variable ``CNVKIT_SERVER`` is set to the socket's path.
+
+Protocol: the client sends one line of JSON, ``{"argv": [...], "cwd": ...}``,
+i.e. the command-line arguments and the client's working directory. The
+server runs the command and replies with one line of JSON,
+``{"status": int, "stdout": str, "stderr": str}``.
+"""
+import contextlib
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import traceback
+
+from skgenome import tabio
+
+
+def do_serve(socket_path, cache_size=32):
+    """Serve CNVkit commands on a Unix socket until interrupted.
+
+    Commands are run one at a time, in this process. Up to `cache_size` parsed
+    input files are kept for reuse (see `skgenome.tabio.read_cache`).
+    """
+    if os.path.exists(socket_path):
+        if _is_listening(socket_path):
+            raise ValueError("A server is already listening on " + socket_path)
+        # Left over from a server that didn't shut down cleanly
+        os.unlink(socket_path)
+    with tabio.read_cache(cache_size):
+        with socketserver.UnixStreamServer(socket_path,
+                                           _CommandHandler) as server:
+            logging.info("Serving CNVkit commands on %s", socket_path)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                logging.info("Shutting down")
+            finally:
+                os.unlink(socket_path)
+
+
+def _is_listening(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+    """Run the command-line request sent by a client."""
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        logging.info("Running: cnvkit.py %s", " ".join(request["argv"]))
+        status, stdout, stderr = run_command(request["argv"],
+                                             request.get("cwd"))
+        response = {"status": status, "stdout": stdout, "stderr": stderr}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def run_command(argv, cwd=None):
+    """Run a CNVkit command as if from the command line, capturing its output.
+
+    Parameters
+    ----------
+    argv : list of str
+        Command-line arguments, without the program name.
+    cwd : str
+        Directory to run the command in, i.e. which relative paths in `argv`
+        are relative to.
+
+    Returns
+    -------
+    tuple
+        The command's exit status, and its standard output and error
+        (including log messages) as strings.
+    """
+    from . import commands
+    stdout, stderr = io.StringIO(), io.StringIO()
+    log_handler = logging.StreamHandler(stderr)
+    log_handler.setFormatter(logging.Formatter("%(message)s"))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(log_handler)
+    orig_cwd = os.getcwd()
+    status = 0
+    try:
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(stderr):
+            if cwd:
+                os.chdir(cwd)
+            if argv[:1] == ["serve"]:
+                sys.exit("Can't start a server from within a server")
+            args = commands.parse_args(argv)
+            args.func(args)
+    except SystemExit as exc:
+        # From argparse or sys.exit(), as the CLI would exit
+        if exc.code is None or isinstance(exc.code, int):
+            status = exc.code or 0
+        else:
+            stderr.write("%s\n" % exc.code)
+            status = 1
+    except Exception:
+        traceback.print_exc(file=stderr)
+        status = 1
+    finally:
+        os.chdir(orig_cwd)
+        root_logger.removeHandler(log_handler)
+        if "matplotlib.pyplot" in sys.modules:
+            # Don't carry over figures from one command to the next
+            sys.modules["matplotlib.pyplot"].close("all")
+    return status, stdout.getvalue(), stderr.getvalue()
@@ -0,0 +1,171 @@
+"""Infer samples' chromosomal sex from the coverage of chromosomes X and Y."""
+import numpy as np
+import pandas as pd
+from scipy.special import xlogy
+
+from . import parallel
+from .metrics import batch_by_bins
+
+
+def do_sex(cnarrs, is_male_reference, processes=1):
+    """Guess samples' sex from the relative coverage of chromosomes X and Y.
+
+    Consecutive samples with identical bins are compared together (see
+    `compare_sex_chromosomes_cols`); any others are compared one at a time, in
+    parallel if `processes` is not 1.
+    """
+    results = []
+    with parallel.pick_pool(processes) as pool:
+        for batch in batch_by_bins(cnarrs):
+            if len(batch) > 1:
+                comparisons = compare_sex_chromosomes_cols(batch,
+                                                           is_male_reference)
+                results.extend(parallel.SerialFuture(_format_row(cna, *cmp))
+                               for cna, cmp in zip(batch, comparisons))
+            else:
+                results.append(pool.submit(_sample_row, batch[0],
+                                           is_male_reference))
+        rows = [res.result() for res in results]
+    columns = ["sample", "sex", "X_logratio", "Y_logratio"]
+    return pd.DataFrame.from_records(rows, columns=columns)
+
+
+def _sample_row(cna, is_male_reference):
+    is_xy, stats = cna.compare_sex_chromosomes(is_male_reference)
+    return _format_row(cna, is_xy, stats)
+
+
+def _format_row(cna, is_xy, stats):
+    return (cna.meta["filename"] or cna.sample_id,
+            "Male" if is_xy else "Female",
+            _strsign(stats['chrx_ratio']) if stats else "NA",
+            _strsign(stats['chry_ratio']) if stats else "NA")
+
+
+def _strsign(num):
+    if num > 0:
+        return "+%.3g" % num
+    return "%.3g" % num
+
+
+def compare_sex_chromosomes_cols(cnarrs, male_reference=False):
+    """Compare sex chromosomes to autosomes in samples with identical bins.
+
+    Equivalent to calling `CopyNumArray.compare_sex_chromosomes` on each
+    sample, but the Mood's median tests and average log2 ratios are calculated
+    for all samples at once, as columns of a bins-by-samples matrix. Samples
+    the matrix version can't handle exactly (e.g. with NaN log2 values, or
+    where a weighted median difference is needed) are compared on their own.
+
+    Returns
+    -------
+    list
+        A tuple ``(is_xy, stats)`` for each sample, as returned by
+        `CopyNumArray.compare_sex_chromosomes`.
+    """
+    cnarr = cnarrs[0]
+    if not len(cnarr):
+        return [cna.compare_sex_chromosomes(male_reference) for cna in cnarrs]
+    is_x = (cnarr.chromosome == cnarr._chr_x_label).values
+    if not is_x.any():
+        return [cna.compare_sex_chromosomes(male_reference) for cna in cnarrs]
+    is_y = (cnarr.chromosome == cnarr._chr_y_label).values
+    is_auto = cnarr.chromosome.str.match(r"(chr)?\d+$", na=False).values
+    if not is_auto.any():
+        is_auto = np.ones(len(cnarr), dtype=np.bool_)
+
+    log2s = np.column_stack([cna['log2'].values for cna in cnarrs])
+    weights = np.column_stack([cna['weight'].values if 'weight' in cna
+                               else np.zeros(len(cna)) for cna in cnarrs])
+    use_weight = np.array(['weight' in cna for cna in cnarrs])
+    auto_l = log2s[is_auto]
+    female_x_shift, male_x_shift = (-1, 0) if male_reference else (0, +1)
+    chrx_male_lr = _compare_chrom_cols(auto_l, log2s[is_x], use_weight,
+                                       female_x_shift, male_x_shift)
+    combined_score = chrx_male_lr.copy()
+    if is_y.any():
+        chry_male_lr = _compare_chrom_cols(auto_l, log2s[is_y], use_weight,
+                                           +3, 0)
+        is_finite = np.isfinite(chry_male_lr)
+        combined_score[is_finite] *= chry_male_lr[is_finite]
+    else:
+        chry_male_lr = np.repeat(np.nan, len(cnarrs))
+    # Relative log2 values, for convenient reporting
+    auto_mean = _mean_cols(auto_l, weights[is_auto])
+    chrx_ratio = _mean_cols(log2s[is_x], weights[is_x]) - auto_mean
+    chry_ratio = _mean_cols(log2s[is_y], weights[is_y]) - auto_mean
+
+    # Fall back to the one-sample method where the shortcuts don't apply
+    redo = (np.isnan(log2s).any(axis=0) | np.isnan(chrx_male_lr) |
+            (np.isnan(chry_male_lr) & is_y.any()))
+    results = []
+    for i, cna in enumerate(cnarrs):
+        if redo[i]:
+            results.append(cna.compare_sex_chromosomes(male_reference))
+        else:
+            results.append((combined_score[i] > 1.0,
+                            dict(chrx_ratio=chrx_ratio[i],
+                                 chry_ratio=chry_ratio[i],
+                                 combined_score=combined_score[i],
+                                 chrx_male_lr=chrx_male_lr[i],
+                                 chry_male_lr=chry_male_lr[i])))
+    return results
+
+
+def _compare_chrom_cols(auto_l, vals, use_weight, female_shift, male_shift):
+    """Calculate the "maleness" ratio of test statistics for each column.
+
+    As in `CopyNumArray.compare_sex_chromosomes`: the ratio of the female vs.
+    male Mood's median test statistics, or if either test fails, the ratio of
+    the absolute differences in medians. NaN where the latter would need a
+    weighted median.
+    """
+    female_stat = _median_test_cols(auto_l, vals + female_shift)
+    male_stat = _median_test_cols(auto_l, vals + male_shift)
+    auto_med = np.median(auto_l, axis=0)
+    vals_med = np.median(vals, axis=0)
+    f_diff = np.abs(auto_med - (vals_med + female_shift))
+    m_diff = np.abs(auto_med - (vals_med + male_shift))
+    tests_ok = np.isfinite(female_stat) & np.isfinite(male_stat)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = np.where(tests_ok,
+                         female_stat / np.maximum(male_stat, 0.01),
+                         f_diff / np.maximum(m_diff, 0.01))
+    ratio[~tests_ok & use_weight] = np.nan
+    return ratio
+
+
+def _median_test_cols(a, b):
+    """Mood's median test statistic comparing each column of `a` and `b`.
+
+    Matches `scipy.stats.median_test` with ``ties='ignore'`` and
+    ``lambda_='log-likelihood'`` (a G-test with Yates' continuity correction).
+    The statistic is NaN where `compare_sex_chromosomes` would treat the test
+    as failed.
+    """
+    grand_median = np.median(np.concatenate((a, b)), axis=0)
+    table = np.array([[(a > grand_median).sum(axis=0),
+                       (b > grand_median).sum(axis=0)],
+                      [(a < grand_median).sum(axis=0),
+                       (b < grand_median).sum(axis=0)]], dtype=np.float_)
+    row_sums = table.sum(axis=1)
+    col_sums = table.sum(axis=0)
+    is_valid = (row_sums > 0).all(axis=0) & (col_sums > 0).all(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = (row_sums[:, None, :] * col_sums[None, :, :]
+                    / row_sums.sum(axis=0))
+        diff = expected - table
+        observed = table + np.sign(diff) * np.minimum(.5, np.abs(diff))
+        stat = 2 * xlogy(observed, observed / expected).sum(axis=(0, 1))
+    stat[~is_valid] = np.nan
+    # A zero statistic from a table with an empty cell is also a failure
+    stat[(stat == 0) & (table == 0).any(axis=(0, 1))] = np.nan
+    return stat
+
+
+def _mean_cols(log2s, weights):
+    """Weighted average of each column of log2 values, as `segment_mean`."""
+    if not len(log2s):
+        return np.repeat(np.nan, log2s.shape[1])
+    weights = np.where(weights.any(axis=0), weights, 1.)
+    return (log2s * weights).sum(axis=0) / weights.sum(axis=0)
@@ -4,7 +4,7 @@ import math
 
 import numpy as np
 import pandas as pd
-from scipy.signal import savgol_coeffs, savgol_filter
+import scipy
 
 from . import descriptives
 
@@ -58,22 +58,55 @@ def _pad_array(x, wing):
                            x[:-wing-1:-1]))
 
 
+# SciPy 1.14+ ranks 1-D windows with a two-heap O(n log w) kernel; earlier
+# versions re-select within every window, which is slower than pandas.
+_FAST_RANK_FILTER = tuple(int(v) for v in scipy.__version__.split('.')[:2]
+                          ) >= (1, 14)
+
+
 def rolling_median(x, width):
     """Rolling median with mirrored edges."""
-    x, wing, signal = check_inputs(x, width)
-    rolled = signal.rolling(2 * wing + 1, 1, center=True).median()
-    # if rolled.hasnans:
-    #     rolled = rolled.interpolate()
-    return np.asfarray(rolled[wing:-wing])
+    return rolling_quantile(x, width, .5)
 
 
 def rolling_quantile(x, width, quantile):
     """Rolling quantile (0--1) with mirrored edges."""
-    x, wing, signal = check_inputs(x, width)
+    x = np.asfarray(x)
+    wing = _width2wing(width, x)
+    if _FAST_RANK_FILTER and not np.isnan(x).any():
+        return _rolling_order_stat(x, wing, quantile)
+    # Fallback: pandas skips NaNs within each window
+    signal = pd.Series(_pad_array(x, wing))
     rolled = signal.rolling(2 * wing + 1, 2, center=True).quantile(quantile)
     return np.asfarray(rolled[wing:-wing])
 
 
+def rolling_iqr(x, width):
+    """Rolling interquartile range with mirrored edges."""
+    return rolling_quantile(x, width, .75) - rolling_quantile(x, width, .25)
+
+
+def _rolling_order_stat(x, wing, quantile):
+    """Rolling quantile of a NaN-free float array, via order statistics.
+
+    Each window of ``2 * wing + 1`` elements is centered on an element of `x`,
+    with the array edges mirrored as in `_pad_array`. Quantiles falling
+    between two order statistics are linearly interpolated, matching
+    `pandas.Series.rolling(...).quantile`.
+    """
+    size = 2 * wing + 1
+    position = quantile * (size - 1)
+    rank_lo = int(math.floor(position))
+    rank_hi = int(math.ceil(position))
+    from scipy import ndimage
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    lows = ndimage.rank_filter(x, rank_lo, size=size, mode='reflect')
+    if rank_hi == rank_lo:
+        return lows
+    highs = ndimage.rank_filter(x, rank_hi, size=size, mode='reflect')
+    return lows + (position - rank_lo) * (highs - lows)
+
+
 def rolling_std(x, width):
     """Rolling quantile (0--1) with mirrored edges."""
     x, wing, signal = check_inputs(x, width)
@@ -81,6 +114,32 @@ def rolling_std(x, width):
     return np.asfarray(rolled[wing:-wing])
 
 
+# Use FFT (overlap-add) convolution above these sizes; below, direct
+# convolution is faster
+FFT_MIN_WINDOW = 256
+FFT_MIN_WORK = 10**6
+
+
+def convolve_same(signal, window):
+    """Convolve `window` over `signal`, keeping the size of `signal`.
+
+    Equivalent to ``np.convolve(signal, window, mode='same')``, but switches
+    to overlap-add FFT convolution when the window is wide and the product of
+    the window and signal lengths is large, as for WGS bins with a
+    genome-scale smoothing bandwidth.
+    """
+    if (len(window) >= FFT_MIN_WINDOW and
+        len(window) * len(signal) >= FFT_MIN_WORK and
+        len(signal) >= len(window)):
+        try:
+            from scipy.signal import oaconvolve
+        except ImportError:
+            # SciPy < 1.4
+            from scipy.signal import fftconvolve as oaconvolve
+        return oaconvolve(signal, window, mode='same')
+    return np.convolve(signal, window, mode='same')
+
+
 def convolve_weighted(window, signal, weights, n_iter=1):
     """Convolve a weighted window over a weighted signal array.
 
@@ -94,11 +153,11 @@ def convolve_weighted(window, signal, weights, n_iter=1):
     for _i in range(n_iter):
         logging.debug("Iteration %d: len(y)=%d, len(w)=%d",
         _i, len(y), len(w))
-        D = np.convolve(w * y, window, mode='same')
-        N = np.convolve(w, window, mode='same')
+        D = convolve_same(w * y, window)
+        N = convolve_same(w, window)
         y = D / N
         # Update weights to account for the smoothing
-        w = np.convolve(window, w, mode='same')
+        w = convolve_same(w, window)
     return y, w
 
 
@@ -110,7 +169,7 @@ def convolve_unweighted(window, signal, wing, n_iter=1):
     window /= window.sum()
     y = signal
     for _i in range(n_iter):
-        y = np.convolve(window, y, mode='same')
+        y = convolve_same(y, window)
     # Chop off the ends of the result so it has the original size
     y = y[wing:-wing]
     return y
@@ -171,6 +230,7 @@ def savgol(x, total_width=None, weights=None,
 
     `total_width` overrides `n_iter`.
     """
+    from scipy.signal import savgol_coeffs, savgol_filter
     if len(x) < 2:
         return x
 
@@ -199,13 +259,26 @@ def savgol(x, total_width=None, weights=None,
     logging.debug('Smoothing in {} iterations with window width {} and order {} for effective bandwidth {}'.format(
         n_iter, window_width, order, total_width))
     if weights is None:
-        y = signal
-        for _i in range(n_iter):
-            y = savgol_filter(y, window_width, order, mode='interp')
+        if n_iter * (window_width // 2) <= total_wing:
+            # The edge effects of iterating savgol_filter stay within the
+            # padding, so the kept values equal a single convolution with the
+            # iterated filter kernel
+            window = _iterate_kernel(savgol_coeffs(window_width, order), n_iter)
+            y = convolve_same(signal, window)
+        else:
+            y = signal
+            for _i in range(n_iter):
+                y = savgol_filter(y, window_width, order, mode='interp')
         # y = convolve_unweighted(window, signal, wing)
     else:
         # TODO fit edges here, too
         window = savgol_coeffs(window_width, order)
+        if n_iter * (window_width // 2) <= total_wing:
+            # Likewise: each iteration smooths the weighted signal and the
+            # weights alike, so their ratio after n_iter iterations is that
+            # of one convolution of each with the iterated kernel
+            window = _iterate_kernel(window, n_iter)
+            n_iter = 1
         y, w = convolve_weighted(window, signal, weights, n_iter)
     # Safety
     bad_idx = (y > x.max()) | (y < x.min())
@@ -218,6 +291,18 @@ def savgol(x, total_width=None, weights=None,
     return y[total_wing:-total_wing]
 
 
+def _iterate_kernel(window, n_iter):
+    """Convolve a filter kernel with itself, `n_iter` times in total.
+
+    Smoothing a signal `n_iter` times with `window` is equivalent, away from
+    the signal's edges, to smoothing it once with the resulting kernel.
+    """
+    kernel = window
+    for _i in range(n_iter - 1):
+        kernel = np.convolve(kernel, window)
+    return kernel
+
+
 def _fit_edges(x, y, wing, polyorder=3):
     """Apply polynomial interpolation to the edges of y, in-place.
 
@@ -313,9 +398,7 @@ def rolling_outlier_iqr(x, width, c=3.0):
     if len(x) <= width:
         return np.zeros(len(x), dtype=np.bool_)
     dists = x - savgol(x, width)
-    q_hi = rolling_quantile(dists, width, .75)
-    q_lo = rolling_quantile(dists, width, .25)
-    iqr = q_hi - q_lo
+    iqr = rolling_iqr(dists, width)
     outliers = (np.abs(dists) > iqr * c)
     return outliers
 
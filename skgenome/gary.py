@@ -6,9 +6,9 @@ import numpy as np
 import pandas as pd
 
 from .chromsort import sorter_chrom
-from .intersect import by_ranges, into_ranges, iter_ranges, iter_slices
+from .intersect import (by_ranges, into_ranges, iter_ranges, iter_slices,
+                        range_idx)
 from .merge import flatten, merge
-from .rangelabel import to_label
 from .subtract import subtract
 from .subdivide import subdivide
 
@@ -317,7 +317,20 @@ class GenomicArray(object):
         return coordframe.itertuples(index=False)
 
     def labels(self):
-        return self.data.apply(to_label, axis=1)
+        """Region label of each bin, as `to_label`: "chrom:start-end"."""
+        return (self.data['chromosome'].astype(str)
+                + ':' + (self.data['start'] + 1).astype(str)
+                + '-' + self.data['end'].astype(str))
+
+    def same_coords(self, other):
+        """Test whether `other` has the same bins as `self`, in the same order.
+
+        Only chromosome, start and end are compared, as whole arrays.
+        """
+        if len(self) != len(other):
+            return False
+        return all(np.array_equal(self.data[col].values, other.data[col].values)
+                   for col in GenomicArray._required_columns)
 
     def in_range(self, chrom=None, start=None, end=None, mode='outer'):
         """Get the GenomicArray portion within the given genomic range.
@@ -470,6 +483,26 @@ class GenomicArray(object):
         for slc in iter_slices(self.data, other.data, mode, keep_empty):
             yield ser[slc]
 
+    def range_idx(self, other, mode='outer'):
+        """Position of the bin in `other` that each bin in `self` falls within.
+
+        Parameters
+        ----------
+        other : GenomicArray
+            Another GA instance, e.g. segments.
+        mode : string
+            Which bins `other`'s ranges select, as in `iter_ranges_of`:
+            ``inner`` or ``outer``.
+
+        Returns
+        -------
+        np.ndarray
+            Integer row position in `other` for each bin in `self`, or -1 where
+            no range in `other` selects the bin. Where ranges in `other`
+            overlap, a bin is assigned to the first of them.
+        """
+        return range_idx(self.data, other.data, mode)
+
     # Modification
 
     def add(self, other):
@@ -120,6 +120,51 @@ def iter_slices(table, other, mode, keep_empty):
                     yield indices
 
 
+def range_idx(table, other, mode):
+    """Position of the range in `other` that selects each row of `table`.
+
+    Like `iter_slices`, but returns one integer array aligned to `table`, with
+    -1 for rows that no range selects. Where ranges overlap, a row is assigned
+    to the first range that selects it.
+    """
+    assert mode in ('inner', 'outer')
+    result = np.repeat(-1, len(table))
+    if not len(table) or not len(other):
+        return result
+    table_rows = table.groupby('chromosome', sort=False).indices
+    for chrom, other_rows in other.groupby('chromosome',
+                                           sort=False).indices.items():
+        if chrom not in table_rows:
+            continue
+        rows = table_rows[chrom]
+        ctable = table.iloc[rows]
+        ranges = other.iloc[other_rows]
+        starts = ranges['start'].values
+        if (ctable['end'].is_monotonic_increasing
+                and (np.diff(starts) >= 0).all()):
+            if mode == 'inner':
+                lo = ctable['start'].searchsorted(starts)
+                hi = ctable['end'].searchsorted(ranges['end'].values, 'right')
+            else:
+                lo = ctable['end'].searchsorted(starts, 'right')
+                hi = ctable['start'].searchsorted(ranges['end'].values)
+            # Trim each range's rows to those no earlier range includes
+            prev_hi = np.maximum.accumulate(np.append(0, hi[:-1]))
+            lo = np.maximum(lo, prev_hi)
+            sizes = np.maximum(hi - lo, 0)
+            offsets = np.repeat(lo - (sizes.cumsum() - sizes), sizes)
+            result[rows[offsets + np.arange(sizes.sum())]] = np.repeat(
+                other_rows, sizes)
+        else:
+            # Nested bins or unsorted ranges; earlier ranges take precedence
+            regions = list(idx_ranges(ctable, ranges['start'],
+                                      ranges['end'], mode))
+            for orow, (region_idx, _s, _e) in zip(other_rows[::-1],
+                                                  regions[::-1]):
+                result[rows[region_idx]] = orow
+    return result
+
+
 def idx_ranges(table, starts, ends, mode):
     """Iterate through sub-ranges."""
     assert mode in ('inner', 'outer')
@@ -46,6 +46,13 @@ def read(infile, fmt="tab", into=None, sample_id=None, meta=None, **kwargs):
         The data from the given file instantiated as `into`, if specified, or
         the default base class for the given file format (usually GenomicArray).
     """
+    if _READ_CACHE is not None and isinstance(infile, str) and fmt != 'auto':
+        return _read_cached(infile, fmt, into, sample_id, meta, kwargs)
+    return _read(infile, fmt, into, sample_id, meta, **kwargs)
+
+
+def _read(infile, fmt, into, sample_id, meta, **kwargs):
+    """Read a file (see `read`), without caching."""
     from cnvlib.core import fbase
     if fmt == 'auto':
         return read_auto(infile)
@@ -92,6 +99,56 @@ def read(infile, fmt="tab", into=None, sample_id=None, meta=None, **kwargs):
     # dframe.set_index(['chromosome', 'start'], inplace=True)
 
 
+# Parsed files to reuse, if enabled with `read_cache`
+_READ_CACHE = None
+_READ_CACHE_SIZE = 0
+
+
+@contextlib.contextmanager
+def read_cache(maxsize=32):
+    """Reuse the parsed contents of recently read files within this context.
+
+    Up to `maxsize` files are kept, least recently used first out, keyed by
+    the file's path, modification time and size, and the `read` arguments.
+    Each `read` of a cached file returns an independent copy.
+
+    For long-running processes that read the same files repeatedly, e.g. a
+    CNVkit reference or target BED in ``cnvkit.py serve``.
+    """
+    global _READ_CACHE, _READ_CACHE_SIZE
+    prev_cache, prev_size = _READ_CACHE, _READ_CACHE_SIZE
+    _READ_CACHE, _READ_CACHE_SIZE = collections.OrderedDict(), maxsize
+    try:
+        yield _READ_CACHE
+    finally:
+        _READ_CACHE, _READ_CACHE_SIZE = prev_cache, prev_size
+
+
+def _read_cached(infile, fmt, into, sample_id, meta, kwargs):
+    """Read a file via the cache enabled by `read_cache`."""
+    try:
+        stat = os.stat(infile)
+    except OSError:
+        stat = None
+    if stat is None:
+        # Let the reader report the error
+        return _read(infile, fmt, into, sample_id, meta, **kwargs)
+    key = (os.path.abspath(infile), infile, stat.st_mtime_ns, stat.st_size,
+           fmt, into, sample_id,
+           repr(sorted(meta.items())) if meta else None,
+           repr(sorted(kwargs.items())))
+    result = _READ_CACHE.get(key)
+    if result is None:
+        result = _read(infile, fmt, into, sample_id, meta, **kwargs)
+    else:
+        logging.debug("Reusing cached %s", infile)
+    _READ_CACHE[key] = result
+    _READ_CACHE.move_to_end(key)
+    while len(_READ_CACHE) > _READ_CACHE_SIZE:
+        _READ_CACHE.popitem(last=False)
+    return result.copy()
+
+
 def read_auto(infile):
     """Auto-detect a file's format and use an appropriate parser to read it."""
     if not isinstance(infile, str) and not hasattr(infile, "seek"):
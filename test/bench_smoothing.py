@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Benchmark CNVkit's rolling-window smoothing on WGS-sized arrays.
+
+Compares the order-statistic kernel used by `cnvlib.smoothing` against the
+equivalent pandas rolling-window calculation, at several window widths.
+
+Usage::
+
+    python bench_smoothing.py [-n BINS] [-w WIDTH [WIDTH ...]]
+"""
+import argparse
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from cnvlib import smoothing
+
+
+def pandas_rolling_quantile(x, width, quantile):
+    """Reference implementation: pandas rolling quantile on a padded copy."""
+    wing = smoothing._width2wing(width, x)
+    signal = pd.Series(smoothing._pad_array(x, wing))
+    rolled = signal.rolling(2 * wing + 1, 2, center=True).quantile(quantile)
+    return rolled.values[wing:-wing]
+
+
+def main(args):
+    np.random.seed(0xA5EED)
+    x = np.random.standard_t(5, args.bins)
+    print("Array size:", args.bins)
+    print("width\tquantile\tpandas(s)\tcnvkit(s)\tspeedup\tmax_diff")
+    for width in args.widths:
+        for quantile in (.5, .95):
+            expect = pandas_rolling_quantile(x, width, quantile)
+            result = smoothing.rolling_quantile(x, width, quantile)
+            t_pd = min(timeit.repeat(
+                lambda: pandas_rolling_quantile(x, width, quantile),
+                number=1, repeat=args.repeat))
+            t_cnv = min(timeit.repeat(
+                lambda: smoothing.rolling_quantile(x, width, quantile),
+                number=1, repeat=args.repeat))
+            print("%d\t%.2f\t%.3f\t%.3f\t%.1fx\t%.3g"
+                  % (width, quantile, t_pd, t_cnv, t_pd / t_cnv,
+                     np.abs(result - expect).max()))
+
+
+if __name__ == '__main__':
+    AP = argparse.ArgumentParser(description=__doc__)
+    AP.add_argument('-n', '--bins', type=int, default=1000000,
+                    help="Number of bins in the test array. [Default: %(default)d]")
+    AP.add_argument('-w', '--widths', type=int, nargs='+',
+                    default=[50, 100, 200, 500],
+                    help="Rolling window widths. [Default: %(default)s]")
+    AP.add_argument('-r', '--repeat', type=int, default=3,
+                    help="Timing repetitions. [Default: %(default)d]")
+    main(AP.parse_args())
@@ -14,7 +14,8 @@ import numpy as np
 from skgenome import GenomicArray, tabio
 
 import cnvlib
-from cnvlib import (cnary, core, fix, smoothing, vary)
+from cnvlib import (cluster, cnary, core, descriptives, fix, segfilters,
+                    smoothing, vary)
 
 
 class CNATests(unittest.TestCase):
@@ -42,6 +43,39 @@ class CNATests(unittest.TestCase):
         self.assertEqual(tuple(cna[0]), tuple(same[0]))
         self.assertEqual(cna[3:6], same[3:6])
 
+    def test_by_gene(self):
+        """Group bins by gene name, including intergenic bins."""
+        cna = cnary.CopyNumArray.from_rows(
+            [("chr1", 0, 10, "A", 0.1),
+             ("chr1", 10, 20, "A,B", 0.2),
+             ("chr1", 20, 30, "Antitarget", 0.3),
+             ("chr1", 30, 40, "B", 0.4),
+             ("chr1", 40, 50, "-", 0.5),
+             ("chr2", 0, 10, "Antitarget", 0.6),
+             ("chr2", 10, 20, "C", 0.7),
+             ("chr2", 20, 30, "Antitarget", 0.8)])
+        self.assertEqual([(name, list(rows['log2']))
+                          for name, rows in cna.by_gene()],
+                         [("A", [0.1, 0.2]),
+                          ("B", [0.2, 0.3, 0.4]),
+                          ("Antitarget", [0.5]),
+                          ("Antitarget", [0.6]),
+                          ("C", [0.7]),
+                          ("Antitarget", [0.8])])
+        squashed = cna.squash_genes(np.mean)
+        self.assertEqual(list(squashed['gene']),
+                         ["A", "B", "-", "Antitarget", "C", "Antitarget"])
+        self.assertEqual(list(squashed['end']), [20, 40, 50, 10, 20, 30])
+        self.assertTrue(np.allclose(squashed['log2'],
+                                    [0.15, 0.3, 0.5, 0.6, 0.7, 0.8]))
+        # Every bin of a real sample is in exactly one group
+        cna = cnvlib.read('formats/reference-tr.cnn')
+        _names, starts, ends = cna.gene_runs()
+        self.assertTrue((starts[1:] == ends[:-1]).all())
+        self.assertEqual((starts[0], ends[-1]), (0, len(cna)))
+        squashed = cna.squash_genes(squash_antitarget=True)
+        self.assertEqual(len(squashed), len(starts))
+
     def test_center_all(self):
         """Test recentering."""
         cna = cnvlib.read('formats/reference-tr.cnn')
@@ -93,6 +127,7 @@ class CNATests(unittest.TestCase):
         regions = GenomicArray(segments.data).drop_extra_columns()
         for grouping_arg in (None, segments, regions):
             resid = cnarr.residuals(grouping_arg)
+            self.assertEqual(len(resid), len(cnarr))
             self.assertAlmostEqual(0, resid.mean(), delta=.3)
             self.assertAlmostEqual(1, np.percentile(resid, 80), delta=.2)
             self.assertAlmostEqual(2, resid.std(), delta=.5)
@@ -113,6 +148,21 @@ class CNATests(unittest.TestCase):
 class OtherTests(unittest.TestCase):
     """Tests for other functionality."""
 
+    def test_cluster(self):
+        """Cluster samples with dense and sparse MCL, and k-means."""
+        rs = np.random.RandomState(0xA5EED)
+        centers = rs.normal(0, 3, (3, 60))
+        samples = np.vstack([c + rs.normal(0, .3, (20, 60)) for c in centers])
+        dense = cluster.markov(samples, inflation=2)
+        self.assertEqual(sorted(map(len, dense)), [20, 20, 20])
+        sparse = cluster.markov(samples, inflation=2, n_neighbors=30)
+        self.assertEqual(sorted(map(tuple, sparse)), sorted(map(tuple, dense)))
+        self.assertEqual(sum(map(len, cluster.kmeans(samples))), 60)
+        # Subsampled bins across blocks, without the first row
+        sketch = cluster.sketch_bins([samples[:, :25], samples[:, 25:]],
+                                     max_bins=40, skip_rows=1)
+        self.assertEqual(sketch.shape, (59, 40))
+
     def test_fix_edge(self):
         """Test the 'edge' bias correction calculations."""
         # NB: With no gap, gain and loss should balance out
@@ -134,6 +184,166 @@ class OtherTests(unittest.TestCase):
         self.assertAlmostEqual(fix.edge_losses(target_size, insert_size),
                         2 * fix.edge_gains(target_size, gap_size, insert_size))
 
+    def test_center_by_window(self):
+        """Combined bias corrections match sequential per-key corrections."""
+        cnarr = cnvlib.read("formats/reference-tr.cnn")
+        rs = np.random.RandomState(0xA5EED)
+        keys = [rs.random_sample(len(cnarr)) for _ in range(3)]
+        # Reference algorithm: shuffle, sort by key, subtract rolling median
+        log2 = cnarr['log2'].values.copy()
+        for key in keys:
+            shuffle = np.random.RandomState(0xA5EED).permutation(len(log2))
+            order = shuffle[np.argsort(key[shuffle], kind='mergesort')]
+            log2[order] -= smoothing.rolling_median(log2[order], .1)
+        fixarr = fix.center_by_windows(cnarr, .1, keys)
+        self.assertTrue(np.allclose(fixarr['log2'].values, log2))
+        self.assertTrue((fixarr['start'].values == cnarr['start'].values).all())
+        self.assertEqual(len(fixarr), len(cnarr))
+        # Unsorted input comes back in genomic order
+        rev = cnarr.as_dataframe(cnarr.data.iloc[::-1])
+        fixarr = fix.center_by_window(rev, .1, keys[0][::-1])
+        self.assertTrue((fixarr['start'].values == cnarr['start'].values).all())
+        self.assertTrue((fixarr.data.index == np.arange(len(cnarr))).all())
+
+    def test_match_ref_to_sample(self):
+        """Match reference bins to a sample by genomic coordinates."""
+        ref = cnvlib.read("formats/reference-tr.cnn")
+        self.assertTrue(fix.match_ref_to_sample(ref, ref).data.equals(ref.data))
+        # Subset, reversed order
+        samp = ref[np.arange(len(ref)) % 3 == 0]
+        samp = samp.as_dataframe(samp.data.iloc[::-1])
+        matched = fix.match_ref_to_sample(ref, samp)
+        self.assertTrue(matched.data.equals(samp.data))
+        # Missing and duplicated bins
+        with self.assertRaises(ValueError):
+            fix.match_ref_to_sample(samp, ref)
+        with self.assertRaises(ValueError):
+            fix.match_ref_to_sample(ref, samp.concat([samp, samp[:2]]))
+
+    def test_squash_by_groups(self):
+        """Squashing runs at once matches squashing each run separately."""
+        import pandas as pd
+        cnarr = cnvlib.read("formats/p2-20_1.cnr")
+        rs = np.random.RandomState(0xA5EED)
+        # Copy numbers in blocks of 40 bins, levels changing every ~60 bins
+        blocks = np.arange(len(cnarr)) // 40
+        cn = rs.choice([0, 1, 2, 2, 3, 5], blocks[-1] + 1)[blocks]
+        cnarr['cn'] = cn
+        cnarr['cn1'] = np.minimum(cn, rs.choice([0, 1], blocks[-1] + 1)[blocks])
+        cnarr['cn2'] = cnarr['cn'] - cnarr['cn1']
+        cnarr['probes'] = rs.randint(1, 5, len(cnarr))
+        levels = pd.Series((rs.random_sample(len(cnarr)) < 1/60).cumsum())
+        result = segfilters.squash_by_groups(cnarr, levels)
+        # Runs of each level, chromosome and allelic copy number
+        keys = pd.DataFrame({'level': levels.values,
+                             'chrom': cnarr['chromosome'].values,
+                             'cn1': cnarr['cn1'].values,
+                             'cn2': cnarr['cn2'].values})
+        run_ids = (keys != keys.shift()).any(axis=1).cumsum()
+        # Reduce each run on its own, as squash_region did row by row
+        rows = []
+        for _i, group in cnarr.data.groupby(run_ids.values):
+            weight = group['weight'].values
+            cn = descriptives.weighted_median(group['cn'].values, weight)
+            cn1 = descriptives.weighted_median(group['cn1'].values, weight)
+            rows.append({
+                'chromosome': group['chromosome'].iat[0],
+                'start': group['start'].iat[0],
+                'end': group['end'].iat[-1],
+                'gene': ','.join(group['gene'].drop_duplicates()),
+                'log2': np.average(group['log2'], weights=weight),
+                'depth': np.average(group['depth'], weights=weight),
+                'probes': group['probes'].sum(),
+                'weight': weight.sum(),
+                'cn': cn, 'cn1': cn1, 'cn2': cn - cn1})
+        expect = pd.DataFrame(rows)
+        self.assertEqual(sorted(result.data.columns), sorted(expect.columns))
+        self.assertEqual(len(result), len(expect))
+        for col in ('chromosome', 'start', 'end', 'gene', 'probes'):
+            self.assertTrue((result[col].values == expect[col].values).all())
+        for col in ('log2', 'weight', 'depth', 'cn', 'cn1', 'cn2'):
+            self.assertTrue(np.allclose(result[col], expect[col]))
+
+    def test_rolling_quantile(self):
+        """Rolling order statistics match pandas' windowed quantiles."""
+        import pandas as pd
+        np.random.seed(0xA5EED)
+        x = np.random.standard_t(3, 1000)
+        for width in (7, 50, .1):
+            wing = smoothing._width2wing(width, x)
+            padded = pd.Series(smoothing._pad_array(x, wing)).rolling(
+                2 * wing + 1, center=True)
+            for q in (.25, .5, .95):
+                expect = padded.quantile(q).values[wing:-wing]
+                result = smoothing.rolling_quantile(x, width, q)
+                self.assertTrue(np.allclose(result, expect))
+            self.assertTrue(np.allclose(smoothing.rolling_median(x, width),
+                                        padded.median().values[wing:-wing]))
+
+    def test_smoothing_convolution(self):
+        """FFT and single-kernel smoothing match direct iterated filtering."""
+        from scipy.signal import savgol_coeffs, savgol_filter
+        np.random.seed(0xA5EED)
+        x = np.random.randn(20000) * .3 + np.repeat([0, 1, -1, .5], 5000)
+        weights = np.random.uniform(.1, 1, len(x))
+        # Savitzky-Golay: compare to iterating the filter over the padded array
+        for width in (7, 50, 3001):
+            _x, wing, signal = smoothing.check_inputs(x, width, False)
+            expect = signal
+            for _i in range((2 * wing + 1) // 7):
+                expect = savgol_filter(expect, 7, 3, mode='interp')
+            result = smoothing.savgol(x, width)
+            self.assertTrue(np.allclose(result, expect[wing:-wing]))
+            # Weighted: compare to iterating the weighted convolution
+            _x, wing, signal, wts = smoothing.check_inputs(x, width, False,
+                                                           weights)
+            window = savgol_coeffs(7, 3)
+            expect = smoothing.convolve_weighted(window, signal, wts,
+                                                 (2 * wing + 1) // 7)[0]
+            result = smoothing.savgol(x, width, weights=weights)
+            self.assertTrue(np.allclose(result, expect[wing:-wing]))
+        # Kaiser: compare FFT convolution to direct convolution
+        for width in (51, 1001):
+            result = smoothing.kaiser(x, width, weights)
+            orig_min_window = smoothing.FFT_MIN_WINDOW
+            smoothing.FFT_MIN_WINDOW = len(x) + 1
+            try:
+                expect = smoothing.kaiser(x, width, weights)
+            finally:
+                smoothing.FFT_MIN_WINDOW = orig_min_window
+            self.assertTrue(np.allclose(result, expect))
+
+    def test_q_n(self):
+        """Qn selection matches the quartile of all pairwise differences."""
+        np.random.seed(0xA5EED)
+        for x in (np.random.randn(50),
+                  np.random.randn(777),
+                  np.random.randint(0, 6, 400).astype(float),
+                  np.round(np.random.randn(1500), 1)):
+            n = len(x)
+            i_upper, j_upper = np.triu_indices(n, 1)
+            expect = np.percentile(np.abs(x[i_upper] - x[j_upper]), 25)
+            scale = (1.392 if n <= 10 else 1 + 4 / n if n < 400 else 1.0)
+            self.assertAlmostEqual(descriptives.q_n(x), expect / scale)
+
+    def test_biweight_cols(self):
+        """Column-wise biweight estimators match the 1-D versions."""
+        np.random.seed(0xA5EED)
+        x = np.random.standard_t(3, (20, 300))
+        x[:, :10] = 1.0
+        x[:5, 10:20] = np.nan
+        x[1:, 20] = np.nan
+        x[:, 21] = np.nan
+        expect_loc = np.array([descriptives.biweight_location(col)
+                               for col in x.T])
+        expect_var = np.array([descriptives.biweight_midvariance(col, initial=i)
+                               for col, i in zip(x.T, expect_loc)])
+        result_loc = descriptives.biweight_location_cols(x)
+        result_var = descriptives.biweight_midvariance_cols(x,
+                                                            initial=result_loc)
+        self.assertTrue(np.allclose(result_loc, expect_loc, equal_nan=True))
+        self.assertTrue(np.allclose(result_var, expect_var, equal_nan=True))
+
     # call
     # Test: convert_clonal(x, 1, 2) == convert_diploid(x)
 
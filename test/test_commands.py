@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 """Unit tests for the CNVkit library, cnvlib."""
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 
 import logging
@@ -17,9 +21,10 @@ from skgenome import tabio
 import cnvlib
 # Import all modules as a smoke test
 from cnvlib import (access, antitarget, autobin, batch, bintest, cnary,
-                    commands, core, coverage, diagram, export, fix, import_rna,
-                    importers, metrics, params, plots, reference, reports,
-                    segmentation, segmetrics, smoothing, vary)
+                    commands, core, coverage, descriptives, diagram, export,
+                    fix, import_rna, importers, metrics, params, plots,
+                    reference, reports, segmentation, segmetrics, sex,
+                    smoothing, vary)
 
 
 class CommandTests(unittest.TestCase):
@@ -47,6 +52,61 @@ class CommandTests(unittest.TestCase):
                                  skip_noncanonical=True)
         self.assertEqual(len(acc), 5)
 
+    def test_access_scan(self):
+        """Scan FASTA sequences for N's, with or without an index (.fai)."""
+        fasta = "formats/chrM-Y-trunc.hg19.fa"
+        expect = list(access.get_regions(fasta))
+        # Same regions from a naive per-base scan
+        seqs = {}
+        with open(fasta) as handle:
+            for line in handle:
+                if line.startswith('>'):
+                    chrom = line[1:].split()[0]
+                    seqs[chrom] = []
+                else:
+                    seqs[chrom].append(line.rstrip())
+        naive = []
+        for chrom, lines in seqs.items():
+            seq = "".join(lines)
+            start = None
+            for i, base in enumerate(seq + 'N'):
+                if base != 'N' and start is None:
+                    start = i
+                elif base == 'N' and start is not None:
+                    naive.append((chrom, start, i))
+                    start = None
+        self.assertEqual([tuple(map(int, r[1:])) for r in expect],
+                         [r[1:] for r in naive])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Indexed copy, with Windows line endings
+            indexed_fasta = os.path.join(tmpdir, "crlf.fa")
+            with open(indexed_fasta, 'w', newline='') as outfile:
+                with open(os.path.join(tmpdir, "crlf.fa.fai"), 'w') as faifile:
+                    offset = 0
+                    for chrom, lines in seqs.items():
+                        header = ">%s\r\n" % chrom
+                        offset += len(header)
+                        faifile.write("%s\t%d\t%d\t%d\t%d\n"
+                                      % (chrom, sum(map(len, lines)), offset,
+                                         len(lines[0]), len(lines[0]) + 2))
+                        outfile.write(header)
+                        for line in lines:
+                            outfile.write(line + "\r\n")
+                            offset += len(line) + 2
+            os.utime(indexed_fasta, (0, 0))
+            self.assertEqual(
+                list(access.get_regions(indexed_fasta, processes=2)), expect)
+            # Cached results
+            cache_dir = os.path.join(tmpdir, "cache")
+            acc = commands.do_access(fasta, [], 500, skip_noncanonical=False,
+                                     cache_dir=cache_dir)
+            self.assertEqual(len(acc), 3)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cached = commands.do_access(fasta, [], 500,
+                                        skip_noncanonical=False,
+                                        cache_dir=cache_dir)
+            self.assertEqual(list(cached.coords()), list(acc.coords()))
+
     def test_antitarget(self):
         """The 'antitarget' command."""
         baits = tabio.read_auto('formats/nv2_baits.interval_list')
@@ -241,6 +301,37 @@ class CommandTests(unittest.TestCase):
             # VCF
             _vheader, vcf_body = export.export_vcf(cns, ploidy, True, is_f)
             self.assertTrue(0 < len(vcf_body.splitlines()) < len(cns))
+            for line in vcf_body.splitlines()[1:]:
+                fields = line.split('\t')
+                svtype = fields[7].split(';')[1]
+                self.assertEqual(fields[4], "<%s>" % svtype[len("SVTYPE="):])
+                self.assertEqual(fields[8].count(':'),
+                                 fields[9].count(':'))
+        # Fuzzy breakpoints from bins, and multiple samples in parallel
+        cnr = cnvlib.read("formats/amplicon.cnr")
+        cnr["probes"] = 1
+        _vheader, vcf_body = export.export_vcf(cnr, 2, False, True, cnarr=cnr)
+        self.assertIn(";CIPOS=(", vcf_body)
+        fnames = ["formats/tr95t.cns", "formats/cl_seq.cns"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out_fnames = [os.path.join(tmpdir, core.fbase(fname) + ".vcf")
+                          for fname in fnames]
+            export.export_vcfs(fnames, None, out_fnames, 2, True, 'f',
+                               processes=2)
+            for fname, out_fname in zip(fnames, out_fnames):
+                _vheader, vcf_body = export.export_vcf(cnvlib.read(fname), 2,
+                                                       True, True)
+                with open(out_fname) as handle:
+                    self.assertTrue(handle.read().endswith(vcf_body))
+        # The --cnr option takes one file, so it can precede the segments
+        args = commands.parse_args(["export", "vcf", "-y", "--cnr", "x.cnr",
+                                    "x.cns", "-o", "x.vcf"])
+        self.assertEqual(args.segments, ["x.cns"])
+        self.assertEqual(args.cnr, ["x.cnr"])
+        args = commands.parse_args(["export", "vcf"] + fnames
+                                   + ["--cnr", "a.cnr", "--cnr", "b.cnr"])
+        self.assertEqual(args.segments, fnames)
+        self.assertEqual(args.cnr, ["a.cnr", "b.cnr"])
 
     def test_export_cdt_jtv(self):
         """The 'export' command for CDT and Java TreeView formats."""
@@ -252,6 +343,31 @@ class CommandTests(unittest.TestCase):
             formatter = export.EXPORT_FORMATS[fmt_key]
             _oh, outrows = formatter(sample_ids, table)
             self.assertEqual(len(list(outrows)), nrows + header2)
+            # Streamed in blocks of bins, the output is the same
+            blocks = export.iter_merged_samples(fnames, block_size=1000)
+            _oh, blockrows = formatter(sample_ids, blocks)
+            _oh, outrows = formatter(sample_ids, table)
+            self.assertEqual(list(blockrows), list(outrows))
+        with self.assertRaises(ValueError):
+            export.merge_samples(fnames + ["formats/amplicon.cnr"])
+        # Mismatched inputs fail before the output file is created
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out_fname = os.path.join(tmpdir, "out.cdt")
+            args = commands.parse_args(["export", "cdt", fnames[0],
+                                        "formats/amplicon.cnr",
+                                        "-o", out_fname])
+            with self.assertRaises(ValueError):
+                args.func(args)
+            self.assertFalse(os.path.exists(out_fname))
+
+    def test_export_gistic(self):
+        """The 'export gistic' command."""
+        fnames = ["formats/amplicon.cnr", "formats/p2-20_1.cnr",
+                  "formats/p2-20_2.cnr"]
+        markers = export.export_gistic_markers(fnames)
+        nbins = linecount(fnames[0]) - 1 + linecount(fnames[1]) - 1
+        self.assertEqual(len(markers), 2 * nbins)
+        self.assertFalse(markers.duplicated().any())
 
     def test_export_nexus(self):
         """The 'export nexus-basic' and 'nexus-ogt' commands."""
@@ -270,6 +386,14 @@ class CommandTests(unittest.TestCase):
         seg2_rows = export.export_seg(["formats/tr95t.cns",
                                        "formats/cl_seq.cns"])
         self.assertGreater(len(seg2_rows), len(seg_rows))
+        # Unreadable inputs fail before the output file is created
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out_fname = os.path.join(tmpdir, "out.seg")
+            args = commands.parse_args(["export", "seg", "formats/tr95t.cns",
+                                        "nonexist.cns", "-o", out_fname])
+            with self.assertRaises(IOError):
+                args.func(args)
+            self.assertFalse(os.path.exists(out_fname))
 
     def test_export_theta(self):
         """The 'export theta' command."""
@@ -314,6 +438,56 @@ class CommandTests(unittest.TestCase):
         rows = commands.do_genemetrics(probes, segs, 0.3, 4, male_reference=True)
         self.assertGreater(len(rows), 0)
 
+    def test_heatmap(self):
+        """The 'heatmap' command's tabulation of a cohort."""
+        from cnvlib import heatmap
+        cnarrs = [cnvlib.read(fname) for fname in ("formats/tr95t.cns",
+                                                   "formats/cl_seq.cns",
+                                                   "formats/amplicon.cns")]
+        matrix = heatmap.CohortMatrix.from_cnarrs(cnarrs)
+        self.assertEqual(matrix.log2.shape, (3, len(matrix.regions)))
+        # Each column holds each sample's segment value at that position
+        mids = (matrix.regions.start + matrix.regions.end) // 2
+        for cnarr, row in zip(cnarrs, matrix.log2):
+            for chrom, mid, value in zip(matrix.regions.chromosome, mids,
+                                         row):
+                hits = cnarr.in_range(chrom, mid, mid + 1)
+                if len(hits):
+                    # (Where segments overlap, the later one is shown)
+                    self.assertAlmostEqual(value, hits.log2.iat[-1], places=5)
+                else:
+                    self.assertTrue(np.isnan(value))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "cohort.npz")
+            matrix.write(fname)
+            loaded = heatmap.CohortMatrix.read(fname)
+        self.assertEqual(loaded.sample_ids, matrix.sample_ids)
+        self.assertTrue(loaded.regions.equals(matrix.regions))
+        self.assertTrue(np.array_equal(loaded.log2, matrix.log2,
+                                       equal_nan=True))
+        for arg in (cnarrs, loaded):
+            for show_range in (None, "chr7", "chr7:50000000-60000000"):
+                axis = heatmap.do_heatmap(arg, show_range)
+                self.assertEqual(len(axis.get_images()), 1)
+        # Each pixel shows the most extreme value under it, skipping NaN
+        result = heatmap.paint_over(np.array([0, 10, 30]),
+                                    np.array([10, 20, 40]),
+                                    np.array([[1., -2., 4.],
+                                              [np.nan, 2., -4.]]),
+                                    np.array([0., 5., 15., 22., 28., 35.]))
+        self.assertTrue(np.array_equal(result, [[1, -2, -2, np.nan, 4],
+                                                [np.nan, 2, 2, np.nan, -4]],
+                                       equal_nan=True))
+        # So focal gains and losses in many-bins-per-pixel plots stay visible
+        cnarr = cnvlib.read("formats/p2-20_1.cnr").in_range("chr1")
+        image = heatmap.do_heatmap([cnarr], "chr1").get_images()[0]
+        row = image.get_array()[0]
+        x_min, x_max = image.get_extent()[:2]
+        mids = .5 * (cnarr.start + cnarr.end).values * plots.MB
+        idx = ((mids - x_min) / (x_max - x_min) * len(row)).astype(int)
+        self.assertTrue((np.abs(row[idx])
+                         >= np.abs(cnarr.log2.values) - 1e-5).all())
+
     def test_import_theta(self):
         """The 'import-theta' command."""
         cns = cnvlib.read("formats/nv3.cns")
@@ -321,6 +495,99 @@ class CommandTests(unittest.TestCase):
         for new_cns in commands.do_import_theta(cns, theta_fname):
             self.assertTrue(0 < len(new_cns) <= len(cns))
 
+    def test_import_time(self):
+        """Starting the CLI doesn't import any command's heavy dependencies."""
+        import_times = importtime("import cnvlib.commands")
+        self.assertIn("cnvlib.commands", import_times)
+        for modname in ("matplotlib", "pomegranate", "reportlab",
+                        "Bio.Graphics", "scipy.stats", "scipy.signal",
+                        "cnvlib.scatter", "cnvlib.segmentation.hmm"):
+            self.assertNotIn(modname, import_times)
+        # API functions are bound at import time, without module __getattr__
+        # (Python 3.7+), but their modules are only loaded when first called
+        for name in commands.__all__:
+            self.assertIn(name, vars(commands))
+            self.assertIn(name, vars(cnvlib))
+        self.assertIn("do_diagram", vars(cnvlib))
+        import_times = importtime("import cnvlib; cnvlib.do_scatter; "
+                                  "cnvlib.do_diagram")
+        self.assertNotIn("matplotlib", import_times)
+        self.assertNotIn("reportlab", import_times)
+        # Plotting is loaded when a plotting command is first used
+        import_times = importtime("import cnvlib; cnvlib.do_scatter("
+                                  "cnvlib.read('formats/amplicon.cnr'))")
+        self.assertIn("matplotlib.pyplot", import_times)
+        self.assertNotIn("pomegranate", import_times)
+
+    def test_scatter_pages(self):
+        """The 'scatter' command with a list of regions."""
+        from cnvlib import scatter
+        cnarr = cnvlib.read("formats/amplicon.cnr")
+        segments = cnvlib.read("formats/amplicon.cns")
+        regions = tabio.read("formats/amplicon.bed", "bed")
+        regions = regions.as_dataframe(regions.data.iloc[[0, 1, 5]])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pdf_fname = os.path.join(tmpdir, "pages.pdf")
+            self.assertEqual(
+                scatter.do_scatter_pages(cnarr, segments, regions=regions,
+                                         output=pdf_fname),
+                [pdf_fname])
+            self.assertGreater(os.path.getsize(pdf_fname), 0)
+            for by_bin in (False, True):
+                fnames = scatter.do_scatter_pages(cnarr, segments,
+                                                  regions=regions,
+                                                  output_dir=tmpdir,
+                                                  processes=2, by_bin=by_bin)
+                # Regions are named by gene, and duplicate names are kept
+                self.assertEqual(
+                    [os.path.basename(fname) for fname in fnames],
+                    ["amplicon-LY9.png", "amplicon-ALK.png",
+                     "amplicon-ALK_.png"])
+                for fname in fnames:
+                    self.assertGreater(os.path.getsize(fname), 0)
+
+    def test_scatter_density(self):
+        """The 'scatter' command with --density."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            png_fname = os.path.join(tmpdir, "density.png")
+            args = commands.parse_args(["scatter", "formats/amplicon.cnr",
+                                        "--density", "-o", png_fname])
+            args.func(args)
+            self.assertGreater(os.path.getsize(png_fname), 0)
+        from cnvlib import scatter
+        cnarr = cnvlib.read("formats/amplicon.cnr")
+        fig = scatter.do_scatter(cnarr, density=True)
+        images = fig.axes[0].get_images()
+        self.assertEqual(len(images), 1)
+        # Each point covers its marker's footprint, not a single pixel
+        alphas = images[0].get_array()[..., 3]
+        self.assertGreater((alphas > 0).sum(), 2 * len(cnarr))
+        # The image has one cell per pixel of the axis at the final size
+        fig = scatter.do_scatter(cnarr, density=True, fig_size=(20, 8))
+        axis = fig.axes[0]
+        bbox = axis.get_window_extent()
+        self.assertEqual(axis.get_images()[0].get_array().shape[:2],
+                         (round(bbox.height), round(bbox.width)))
+
+    def test_serve(self):
+        """Commands run by a 'serve' server."""
+        from cnvlib import serve
+        status, stdout, _stderr = serve.run_command(
+            ["export", "seg", "formats/tr95t.cns"])
+        self.assertEqual(status, 0)
+        self.assertTrue(stdout.startswith("ID\tchrom"))
+        # Output to stdout by default is captured, too
+        status, stdout, _stderr = serve.run_command(
+            ["access", "formats/chrM-Y-trunc.hg19.fa"])
+        self.assertEqual(status, 0)
+        self.assertTrue(stdout.startswith("chrY\t"))
+        status, _stdout, stderr = serve.run_command(["call", "--bogus"])
+        self.assertEqual(status, 2)
+        self.assertIn("error:", stderr)
+        status, _stdout, stderr = serve.run_command(["call", "nonexist.cns"])
+        self.assertEqual(status, 1)
+        self.assertIn("nonexist.cns", stderr)
+
     def test_metrics(self):
         """The 'metrics' command."""
         cnarr = cnvlib.read("formats/amplicon.cnr")
@@ -330,6 +597,41 @@ class CommandTests(unittest.TestCase):
         values = result.loc[0, result.columns[1:]]
         for val in values:
             self.assertGreater(val, 0)
+        # Samples with the same bins are scored together, column-wise
+        cnarrs = [cnvlib.read("formats/p2-20_1.cnr"),
+                  cnvlib.read("formats/p2-20_2.cnr"), cnarr]
+        for segs in (None, segments):
+            result = metrics.do_metrics(cnarrs, segs)
+            self.assertEqual(result.shape, (3, 6))
+            for cna, (_i, row) in zip(cnarrs, result.iterrows()):
+                expect = metrics.ests_of_scale(cna.residuals(segs).values)
+                self.assertTrue(np.allclose(row.values[2:].astype(float),
+                                            expect))
+        # Columns with missing values, down to a single valid value
+        devs = np.array([[0.7, 0.1, -0.2],
+                         [np.nan, -0.3, 0.4],
+                         [np.nan, np.nan, 0.05],
+                         [np.nan, 0.2, -0.6]])
+        result = metrics.ests_of_scale_cols(devs)
+        for i in range(devs.shape[1]):
+            self.assertTrue(np.allclose(result[:, i],
+                                        metrics.ests_of_scale(devs[:, i])))
+
+    def test_sex(self):
+        """The 'sex' command."""
+        cnarrs = [cnvlib.read("formats/p2-20_1.cnr")]
+        # Copies with the same bins, compared column-wise
+        for shift in (-1, 1):
+            cnarr = cnarrs[0].copy()
+            cnarr[cnarr.chromosome == 'chrX', 'log2'] += shift
+            cnarrs.append(cnarr)
+        cnarrs.append(cnvlib.read("formats/m-on-f.cns"))
+        for is_male_reference in (False, True):
+            table = commands.do_sex(cnarrs, is_male_reference)
+            self.assertEqual(len(table), len(cnarrs))
+            for cnarr, (_i, row) in zip(cnarrs, table.iterrows()):
+                expect = sex._sample_row(cnarr, is_male_reference)
+                self.assertEqual(tuple(row), expect)
 
     def test_reference(self):
         """The 'reference' command."""
@@ -339,6 +641,49 @@ class CommandTests(unittest.TestCase):
         self.assertEqual(len(ref), nlines)
         ref = commands.do_reference(["formats/amplicon.cnr"])
         self.assertEqual(len(ref), nlines)
+        # Pooled coverages kept on disk instead of in memory
+        orig_max_cells = reference.MAX_IN_MEMORY_CELLS
+        reference.MAX_IN_MEMORY_CELLS = 0
+        try:
+            ref_mmap = commands.do_reference(["formats/p2-20_1.cnr",
+                                              "formats/p2-20_2.cnr"])
+        finally:
+            reference.MAX_IN_MEMORY_CELLS = orig_max_cells
+        ref = commands.do_reference(["formats/p2-20_1.cnr",
+                                     "formats/p2-20_2.cnr"])
+        ref_parallel = commands.do_reference(["formats/p2-20_1.cnr",
+                                              "formats/p2-20_2.cnr"],
+                                             processes=2)
+        for col in ('log2', 'depth', 'spread'):
+            self.assertTrue(np.allclose(ref_mmap[col], ref[col],
+                                        equal_nan=True))
+            self.assertTrue(np.allclose(ref_parallel[col], ref[col],
+                                        equal_nan=True))
+        # Same reference from an incrementally updated pool
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pool_dir = os.path.join(tmpdir, "pool")
+            commands.do_reference_pool(pool_dir, ["formats/p2-20_1.cnr"])
+            ref_pool = commands.do_reference_pool(pool_dir,
+                                                  ["formats/p2-20_2.cnr"])
+            pool = reference.NormalPool.read(pool_dir)
+            self.assertEqual(pool.sample_ids, ["p2-20_1", "p2-20_2"])
+            self.assertIsInstance(pool.blocks[0][1], np.memmap)
+            self.assertTrue(np.allclose(
+                pool.to_reference()['log2'], ref_pool['log2']))
+            del pool
+            ref_less = commands.do_reference_pool(
+                pool_dir, remove_samples=["p2-20_2"])
+        for col in ('log2', 'depth', 'spread'):
+            self.assertTrue(np.allclose(ref_pool[col], ref[col], atol=1e-3,
+                                        equal_nan=True))
+        self.assertEqual(len(ref_less), len(ref))
+        # Sample clusters
+        ref_clust = commands.do_reference(["formats/p2-20_1.cnr",
+                                           "formats/p2-20_2.cnr"],
+                                          do_cluster=True, min_cluster_size=1)
+        self.assertIn('log2_1', ref_clust)
+        self.assertIn('spread_1', ref_clust)
+        self.assertEqual(len(ref_clust), len(ref))
         # Empty/unspecified antitargets, flat reference
         nlines = linecount("formats/amplicon.bed")
         ref = commands.do_reference_flat("formats/amplicon.bed",
@@ -366,10 +711,16 @@ class CommandTests(unittest.TestCase):
         self.assertGreater(len(segments), n_chroms)
         self.assertTrue((segments.start < segments.end).all())
         varr = tabio.read("formats/na12878_na12882_mix.vcf", "vcf")
-        #TODO - This test is failing... commenting it out for now!
-        # segments = segmentation.do_segmentation(cnarr, "haar", variants=varr)    
-        # self.assertGreater(len(segments), n_chroms)
-        # self.assertTrue((segments.start < segments.end).all())
+        for processes in (1, 2):
+            with self.assertLogs(level='INFO') as logs:
+                segments = segmentation.do_segmentation(
+                    cnarr, "haar", variants=varr, processes=processes)
+            self.assertGreater(len(segments), n_chroms)
+            self.assertTrue((segments.start < segments.end).all())
+            self.assertIn('baf', segments)
+            # One allele frequency model per sample, not per chromosome arm
+            self.assertEqual(sum("Training allele frequency model" in msg
+                                 for msg in logs.output), 1)
 
     def test_segment_hmm(self):
         """The 'segment' command with HMM methods."""
@@ -414,6 +765,50 @@ class CommandTests(unittest.TestCase):
         self.assertTrue((sm['pi_hi'] > sm['median']).all())
         self.assertTrue((sm['ci_lo'] < sm['mean']).all())
         self.assertTrue((sm['ci_hi'] > sm['mean']).all())
+        # Grouped statistics match the per-segment estimators
+        sm = segmetrics.do_segmetrics(cnarr, segarr,
+                                      location_stats=['median'],
+                                      spread_stats=['mad', 'iqr', 'mse'])
+        for (_i, row), (seg, bins) in zip(sm.data.iterrows(),
+                                          cnarr.by_ranges(segarr)):
+            if not len(bins):
+                continue
+            dev = bins['log2'] - seg.log2
+            self.assertAlmostEqual(row['median'], np.median(bins['log2']))
+            self.assertAlmostEqual(
+                row['mad'], descriptives.median_absolute_deviation(dev))
+            self.assertAlmostEqual(
+                row['iqr'], descriptives.interquartile_range(dev))
+            self.assertAlmostEqual(
+                row['mse'], descriptives.mean_squared_error(dev))
+        # Single-bin and empty segments get NaN SEM, quietly
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            sm = segmetrics.do_segmetrics(cnarr.drop_low_coverage(), segarr,
+                                          spread_stats=['sem'])
+        self.assertTrue(sm['sem'].isna().any())
+        self.assertTrue((sm['sem'].dropna() >= 0).all())
+        # Bootstrap blocks are seeded independently of the process count;
+        # segments larger than a block are resampled in chunks of replicates
+        orig_block_size = segmetrics.BOOTSTRAP_BLOCK_SIZE
+        segmetrics.BOOTSTRAP_BLOCK_SIZE = 100
+        try:
+            ci_serial = segmetrics.do_segmetrics(cnarr, segarr,
+                                                 location_stats=['mean'],
+                                                 interval_stats=['ci'])
+            ci_parallel = segmetrics.do_segmetrics(cnarr, segarr,
+                                                   interval_stats=['ci'],
+                                                   processes=2)
+        finally:
+            segmetrics.BOOTSTRAP_BLOCK_SIZE = orig_block_size
+        big = ci_serial[ci_serial['probes'] > 100]
+        self.assertTrue(len(big))
+        self.assertTrue((big['ci_lo'] < big['mean']).all())
+        self.assertTrue((big['ci_hi'] > big['mean']).all())
+        self.assertTrue(np.allclose(ci_serial['ci_lo'], ci_parallel['ci_lo'],
+                                    equal_nan=True))
+        self.assertTrue(np.allclose(ci_serial['ci_hi'], ci_parallel['ci_hi'],
+                                    equal_nan=True))
 
     def test_target(self):
         """The 'target' command."""
@@ -448,6 +843,24 @@ class CommandTests(unittest.TestCase):
             self.assertEqual(len(baits), bait_len)
 
 
+def importtime(statement):
+    """Cumulative import times (in us) of modules loaded by a statement.
+
+    Parsed from the output of ``python -X importtime``.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             statement],
+                            stderr=subprocess.PIPE, check=True,
+                            universal_newlines=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _self_us, cumulative_us, modname = line[12:].split("|")
+            if cumulative_us.strip().isdigit():
+                times[modname.strip()] = int(cumulative_us)
+    return times
+
+
 def linecount(filename):
     i = -1
     with open(filename) as handle:
@@ -143,6 +143,28 @@ class GaryTests(unittest.TestCase):
         self.assertEqual(0, len(list(segarr.iter_ranges_of(mtarr, 'start'))))
         self.assertEqual(88, len(list(mtarr.iter_ranges_of(segarr, 'end'))))
 
+    def test_range_idx(self):
+        cnarr = read("formats/amplicon.cnr")
+        segarr = read("formats/amplicon.cns")
+        # Shift segment boundaries to leave gaps and overlaps
+        shifted = segarr.copy()
+        shifted['start'] += np.where(np.arange(len(segarr)) % 2, 50000, 0)
+        shifted['end'] += np.where(np.arange(len(segarr)) % 3, 50000, -50000)
+        for segs in (segarr, shifted):
+            for mode in ('inner', 'outer'):
+                result = cnarr.range_idx(segs, mode)
+                self.assertEqual(len(result), len(cnarr))
+                # Same bins as slicing by each range, first range first
+                expect = np.repeat(-1, len(cnarr))
+                for i, bins in reversed(list(enumerate(
+                        cnarr.iter_ranges_of(segs, 'log2', mode)))):
+                    expect[bins.index.values] = i
+                self.assertTrue((result == expect).all())
+        # Edge cases
+        mtarr = tabio.read("formats/empty")
+        self.assertEqual(len(cnarr.range_idx(mtarr)), len(cnarr))
+        self.assertEqual(len(mtarr.range_idx(segarr)), 0)
+
     def test_ranges_resize(self):
         baits_fname = 'formats/nv2_baits.interval_list'
         chrom_sizes = {'chr1': 249250621,
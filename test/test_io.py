@@ -86,6 +86,24 @@ class IOTests(unittest.TestCase):
                 seen_lines += len(dframe)
             self.assertEqual(seen_lines, expect_lines)
 
+    def test_read_cache(self):
+        """Reuse parsed files within a read_cache context."""
+        fname = "formats/amplicon.bed"
+        with tabio.read_cache(2) as cache:
+            r1 = tabio.read(fname, "bed")
+            r2 = tabio.read(fname, "bed")
+            self.assertEqual(len(cache), 1)
+            self.assertTrue(r1.data.equals(r2.data))
+            # Each read is an independent copy
+            r2.data.loc[:, "start"] += 1
+            self.assertFalse(r1.data.equals(r2.data))
+            self.assertTrue(r1.data.equals(tabio.read(fname, "bed").data))
+            # Different arguments are cached separately
+            tabio.read(fname, "bed", sample_id="other")
+            tabio.read("formats/amplicon.text", "text")
+            self.assertEqual(len(cache), 2)
+        self.assertIsNone(tabio._READ_CACHE)
+
     def test_read_text(self):
         """Read the text region format."""
         fname = "formats/amplicon.text"